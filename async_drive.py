@@ -0,0 +1,381 @@
+import asyncio
+import logging
+import time
+from typing import AsyncIterable, AsyncIterator, Optional
+
+import httpx
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import Request
+
+import drive
+import metrics
+
+"""
+Asyncio Google Drive v3 client speaking the REST API over a pooled HTTP connection.
+
+Mirrors the functions of `drive.py` and shares its metadata cache and credentials.
+"""
+
+API_URL = "https://www.googleapis.com/drive/v3"
+UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3"
+
+# Size of each resumable upload request, must be a multiple of 256KB
+CHUNK_SIZE = drive.CHUNK_SIZE
+
+DEBUG = False
+
+log = logging.getLogger("async_drive")
+CLIENT: Optional[httpx.AsyncClient] = None
+CREDENTIALS = None
+
+
+class DriveHttpError(Exception):
+    def __init__(self, status_code: int, error_details: str):
+        super().__init__(f"Drive API error {status_code}: {error_details}")
+        self.status_code = status_code
+        self.error_details = error_details
+
+
+async def init(
+    debug: bool = False,
+    max_connections: int = 100,
+    api_endpoint: Optional[str] = None,
+):
+    # Global copy of the HTTP client, credentials and Debug flag
+    global DEBUG, CLIENT, CREDENTIALS, API_URL, UPLOAD_URL
+    DEBUG = debug
+    if debug:
+        log.setLevel(logging.DEBUG)
+
+    if api_endpoint:
+        # an emulated API (see emulator.py) needs no OAuth flow
+        API_URL = f"{api_endpoint.rstrip('/')}/drive/v3"
+        UPLOAD_URL = f"{api_endpoint.rstrip('/')}/upload/drive/v3"
+        CREDENTIALS = AnonymousCredentials()
+    else:
+        loop = asyncio.get_running_loop()
+        # the OAuth flow and token file are blocking, keep them off the event loop
+        CREDENTIALS = await loop.run_in_executor(None, drive.load_credentials)
+    CLIENT = httpx.AsyncClient(
+        timeout=drive.HTTP_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        ),
+    )
+    log.debug("Connection pool ready.")
+
+
+async def _headers() -> dict:
+    if not CREDENTIALS.valid:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, CREDENTIALS.refresh, Request())
+    if CREDENTIALS.token is None:
+        return {}
+    return {"Authorization": f"Bearer {CREDENTIALS.token}"}
+
+
+async def _request(method: str, url: str, **kwargs) -> httpx.Response:
+    # send a call through the scheduler shared with drive.py, retrying failures
+    call = drive.describe_call(method, url)
+    extra_headers = kwargs.pop("headers", {})
+    attempt = 0
+    while True:
+        await _sleep(drive.SCHEDULER.admit(call))
+        headers = await _headers()
+        headers.update(extra_headers)
+        begin, status = time.perf_counter(), "error"
+        try:
+            response = await CLIENT.request(method, url, headers=headers, **kwargs)
+            status = response.status_code
+        except httpx.TransportError:
+            delay = drive.SCHEDULER.retry_delay(call, method, attempt)
+            if delay is None:
+                raise
+        else:
+            delay = drive.SCHEDULER.retry_delay(
+                call,
+                method,
+                attempt,
+                response.status_code,
+                response.content,
+                response.headers.get("retry-after"),
+            )
+            if delay is None:
+                break
+        finally:
+            metrics.drive_call(
+                call,
+                status,
+                time.perf_counter() - begin,
+                len(kwargs.get("content") or b""),
+                len(response.content) if status != "error" else 0,
+            )
+        log.debug("Retrying %s call in %.2f seconds.", call, delay)
+        await _sleep(delay)
+        attempt += 1
+    _raise_for_status(response)
+    return response
+
+
+async def _sleep(delay: float):
+    if delay:
+        await asyncio.sleep(delay)
+
+
+def _raise_for_status(response: httpx.Response):
+    # 308 is how resumable uploads ask for the next chunk
+    if response.status_code >= 300 and response.status_code != 308:
+        raise DriveHttpError(response.status_code, response.text)
+
+
+async def lookup(filename: str, fresh: bool = False):
+    # resolve a filename to its metadata, going to the API only on a cache miss (or
+    # always with `fresh=True`, refreshing the cache)
+    cached = None if fresh else drive.CACHE.get(filename, None)
+    if cached is not None:
+        return None if cached is drive._ABSENT else cached
+
+    response = await _request(
+        "GET",
+        f"{API_URL}/files",
+        params={
+            "q": f"name='{filename}' and trashed=false",
+            "spaces": "drive",
+            "fields": f"nextPageToken, files({drive.METADATA_FIELDS})",
+        },
+    )
+    files = response.json()["files"]
+    if len(files) > 0:
+        return drive._remember(filename, files[0])
+
+    drive.CACHE.set(filename, drive._ABSENT)
+    return None
+
+
+async def find_by_property(key: str, value: str) -> list:
+    # names of every file tagged with the given appProperty value
+    names, page_token = [], None
+    while True:
+        params = {
+            "q": f"appProperties has {{ key='{key}' and value='{value}' }} "
+            "and trashed=false",
+            "spaces": "drive",
+            "fields": f"nextPageToken, files(name, {drive.METADATA_FIELDS})",
+        }
+        if page_token:
+            params["pageToken"] = page_token
+        response = (await _request("GET", f"{API_URL}/files", params=params)).json()
+        for file in response["files"]:
+            drive._remember(file["name"], file)
+            names.append(file["name"])
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return names
+
+
+async def _require(filename: str) -> dict:
+    metadata = await lookup(filename)
+    if metadata is None:
+        raise FileNotFoundError
+    return metadata
+
+
+async def exists(filename: str) -> bool:
+    return await lookup(filename) is not None
+
+
+async def get_properties(filename: str) -> dict:
+    return (await get_versioned_properties(filename))[0]
+
+
+async def get_versioned_properties(filename: str) -> tuple:
+    # appProperties and the version they belong to, see `write_stream`
+    metadata = await _require(filename)
+    try:
+        response = await _request(
+            "GET",
+            f"{API_URL}/files/{metadata['id']}",
+            params={"fields": f"appProperties, {drive.METADATA_FIELDS}"},
+        )
+    except DriveHttpError as err:
+        if err.status_code == 404:
+            drive.invalidate(filename)
+            raise FileNotFoundError
+        raise
+    resource = response.json()
+    drive._remember(filename, resource)
+    return resource.get("appProperties", {}), resource.get("version")
+
+
+async def get_properties_many(filenames: list) -> dict:
+    return {
+        filename: versioned and versioned[0]
+        for filename, versioned in (
+            await get_versioned_properties_many(filenames)
+        ).items()
+    }
+
+
+async def get_versioned_properties_many(filenames: list) -> dict:
+    # the connection pool lets all of the small requests run at the same time
+    async def get_one(filename: str):
+        try:
+            return await get_versioned_properties(filename)
+        except FileNotFoundError:
+            return None
+
+    results = await asyncio.gather(*(get_one(name) for name in filenames))
+    return dict(zip(filenames, results))
+
+
+async def _check_version(filename: str, metadata: dict, expected_version: str):
+    # Drive v3 has no conditional update, the version is compared right before it
+    if metadata is None:
+        raise drive.ConflictError(f"the file `{filename}` was deleted meanwhile.")
+    response = await _request(
+        "GET",
+        f"{API_URL}/files/{metadata['id']}",
+        params={"fields": drive.METADATA_FIELDS},
+    )
+    if drive._remember(filename, response.json())["version"] != expected_version:
+        raise drive.ConflictError(f"the file `{filename}` was changed meanwhile.")
+
+
+async def set_properties(filename: str, properties: dict):
+    metadata = await _require(filename)
+    response = await _request(
+        "PATCH",
+        f"{API_URL}/files/{metadata['id']}",
+        params={"fields": drive.METADATA_FIELDS},
+        json={"appProperties": properties},
+    )
+    drive._remember(filename, response.json())
+    return metadata["id"]
+
+
+async def write_stream(
+    file_name: str,
+    chunks: AsyncIterable[bytes],
+    properties: dict = None,
+    chunksize: int = CHUNK_SIZE,
+    expected_version: str = None,
+):
+    file_metadata = {"name": file_name}
+    metadata = await lookup(file_name)
+    if expected_version is not None:
+        await _check_version(file_name, metadata, expected_version)
+    if metadata is None:
+        if properties:
+            file_metadata["appProperties"] = {
+                k: v for k, v in properties.items() if v is not None
+            }
+        method, url = "POST", f"{UPLOAD_URL}/files"
+    else:
+        if properties:
+            file_metadata["appProperties"] = properties
+        method, url = "PATCH", f"{UPLOAD_URL}/files/{metadata['id']}"
+
+    try:
+        # open a resumable session, then send the content chunk by chunk
+        session = await _request(
+            method,
+            url,
+            params={"uploadType": "resumable", "fields": drive.METADATA_FIELDS},
+            json=file_metadata,
+        )
+        location = session.headers["location"]
+
+        buffer = bytearray()
+        offset = 0
+        response = None
+        async for chunk in chunks:
+            buffer += chunk
+            while len(buffer) > chunksize:
+                response = await _put_chunk(location, buffer[:chunksize], offset, "*")
+                offset += chunksize
+                del buffer[:chunksize]
+        total = offset + len(buffer)
+        response = await _put_chunk(location, buffer, offset, str(total))
+    except DriveHttpError:
+        drive.invalidate(file_name)
+        raise
+
+    log.debug("File <%s> written.", file_name)
+    return drive._remember(file_name, response.json())["id"]
+
+
+async def _put_chunk(location: str, data: bytes, offset: int, total: str):
+    if len(data):
+        content_range = f"bytes {offset}-{offset + len(data) - 1}/{total}"
+    else:
+        content_range = f"bytes */{total}"
+    return await _request(
+        "PUT",
+        location,
+        content=bytes(data),
+        headers={"Content-Range": content_range},
+    )
+
+
+async def read_stream(filename: str) -> AsyncIterator[bytes]:
+    metadata = await _require(filename)
+    attempt = 0
+    while True:
+        await _sleep(drive.SCHEDULER.admit("media"))
+        headers = await _headers()
+        begin, status, received = time.perf_counter(), "error", 0
+        delay = None
+        try:
+            async with CLIENT.stream(
+                "GET",
+                f"{API_URL}/files/{metadata['id']}",
+                params={"alt": "media"},
+                headers=headers,
+            ) as response:
+                status = response.status_code
+                if response.status_code == 404:
+                    drive.invalidate(filename)
+                    raise FileNotFoundError
+                if response.status_code >= 300:
+                    await response.aread()
+                    # only a download that has not started yet can be retried
+                    delay = drive.SCHEDULER.retry_delay(
+                        "media",
+                        "GET",
+                        attempt,
+                        response.status_code,
+                        response.content,
+                        response.headers.get("retry-after"),
+                    )
+                    if delay is None:
+                        _raise_for_status(response)
+                else:
+                    async for chunk in response.aiter_bytes():
+                        received += len(chunk)
+                        yield chunk
+                    return
+        finally:
+            metrics.drive_call(
+                "media", status, time.perf_counter() - begin, 0, received
+            )
+        await _sleep(delay)
+        attempt += 1
+
+
+async def delete(filename: str):
+    metadata = await _require(filename)
+    try:
+        await _request("DELETE", f"{API_URL}/files/{metadata['id']}")
+    except DriveHttpError as err:
+        if err.status_code != 404:
+            raise
+        drive.invalidate(filename)
+        raise FileNotFoundError
+    drive.invalidate(filename)
+    log.debug("File <%s> deleted.", filename)
+
+
+async def close():
+    if CLIENT is not None:
+        await CLIENT.aclose()
@@ -0,0 +1,602 @@
+import asyncio
+import functools
+import json
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from jinja2 import Environment, FileSystemLoader
+
+import async_drive
+import chunking
+import crypto
+import metrics
+import offload
+import profiling
+from definitions import *
+from locks import StripedLocks
+from server import describe_error, new_key_slots, open_key_slots
+import server
+
+"""
+ASGI variant of `server.py`: same routes and request body contract, but every Drive
+call is awaited on a pooled async HTTP client and crypto work runs in an executor, so
+one process can keep thousands of requests in flight.
+
+Run with `uvicorn async_server:app`.
+"""
+
+# Set DEBUG to 'True' to see debug output
+DEBUG = True
+
+# Worker threads for key derivation, encryption and decryption
+CRYPTO_WORKERS = os.cpu_count() or 4
+# Connections kept open to the Drive API
+MAX_CONNECTIONS = 100
+
+crypto_executor = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS)
+
+# Locks held by requests changing a file, see `with_file_locks`
+file_locks = StripedLocks(server.FILE_LOCK_STRIPES, asyncio.Lock)
+
+templates = Environment(loader=FileSystemLoader("templates"))
+templates.globals["url_for"] = lambda endpoint, filename: f"/{endpoint}/{filename}"
+
+routes = dict()
+
+
+def route(endpoint: str):
+    def register(handler):
+        routes["/" + endpoint] = handler
+        return handler
+
+    return register
+
+
+def with_file_locks(handler):
+    # changes of the same file run one at a time, those of other files concurrently
+    @functools.wraps(handler)
+    async def wrapper(body: dict):
+        async with file_locks.hold_async(*server.files_in(body)):
+            return await handler(body)
+
+    return wrapper
+
+
+async def run(function, *args):
+    # keep CPU-bound work off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(crypto_executor, function, *args)
+
+
+async def get_credential_bytes(body: dict) -> bytes:
+    with metrics.span("credentials"):
+        return await run(server.credential_bytes_from, body)
+
+
+async def encrypt_stream(key: bytes, plaintext: bytes, compression: str = None):
+    encryptor = await run(crypto.StreamEncryptor, key, crypto.SEGMENT_SIZE, compression)
+    output = await run(encryptor.update, plaintext)
+    if output:
+        yield output
+    yield await run(encryptor.finalize)
+
+
+async def decrypt_stream(key: bytes, chunks):
+    decryptor = crypto.FileDecryptor(key)
+    async for chunk in chunks:
+        output = await run(decryptor.update, chunk)
+        if output:
+            yield output
+    yield await run(decryptor.finalize)
+
+
+async def unlock_file(file_name: str, credential_bytes: bytes, properties=None):
+    if properties is None:
+        properties = await async_drive.get_properties(file_name)
+    with metrics.span("unlock"):
+        return await run(open_key_slots, credential_bytes, properties)
+
+
+async def verify_credentials(
+    file_name: str, credential_bytes: bytes, remember=True, properties=None
+):
+    data_key, has_key_slots, key_check = await unlock_file(
+        file_name, credential_bytes, properties
+    )
+    if has_key_slots:
+        return data_key, has_key_slots
+    if key_check:
+        await run(crypto.verify_key_check, credential_bytes, key_check)
+        return data_key, has_key_slots
+
+    async for _ in decrypt_stream(credential_bytes, async_drive.read_stream(file_name)):
+        pass
+    if remember:
+        await remember_key_check(file_name, credential_bytes)
+    return data_key, has_key_slots
+
+
+async def remember_key_check(file_name: str, credential_bytes: bytes):
+    check_value = await run(crypto.key_check_value, credential_bytes)
+    await async_drive.set_properties(
+        file_name, {crypto.KEY_CHECK_PROPERTY: check_value}
+    )
+
+
+async def read_encrypted(file_name: str, data_key: bytes) -> bytes:
+    plaintext = bytearray()
+    async for chunk in decrypt_stream(data_key, async_drive.read_stream(file_name)):
+        plaintext += chunk
+    return bytes(plaintext)
+
+
+async def read_chunked(file_name: str, data_key: bytes) -> bytes:
+    chunk_names = chunking.decode_manifest(await read_encrypted(file_name, data_key))
+    chunks = await asyncio.gather(
+        *(read_encrypted(name, data_key) for name in chunk_names)
+    )
+    return b"".join(
+        chunking.verify_chunk(data_key, name, chunk)
+        for name, chunk in zip(chunk_names, chunks)
+    )
+
+
+async def read_content(file_name: str, credential_bytes: bytes, properties=None):
+    if properties is None:
+        properties = await async_drive.get_properties(file_name)
+    data_key, has_key_slots, key_check = await unlock_file(
+        file_name, credential_bytes, properties
+    )
+    if key_check:
+        await run(crypto.verify_key_check, credential_bytes, key_check)
+    with metrics.span("decrypt", exclusive=True):
+        if chunking.is_chunked(properties):
+            plaintext = await read_chunked(file_name, data_key)
+        else:
+            plaintext = await read_encrypted(file_name, data_key)
+    if not has_key_slots and not key_check:
+        await remember_key_check(file_name, credential_bytes)
+    return plaintext
+
+
+async def delete_many(file_names: list):
+    async def delete_one(name: str):
+        try:
+            await async_drive.delete(name)
+        except FileNotFoundError:
+            pass
+
+    await asyncio.gather(*(delete_one(name) for name in set(file_names)))
+
+
+async def write_chunked(
+    file_name: str,
+    data_key: bytes,
+    plaintext: bytes,
+    properties: dict,
+    previous_chunks: list,
+    compression: str = None,
+    version: str = None,
+):
+    chunks = await run(chunking.split, plaintext)
+    chunk_names = [chunking.chunk_name(data_key, chunk) for chunk in chunks]
+
+    # only chunks that are not on the drive yet are uploaded; whether a chunk exists
+    # is asked anew, a cached entry may outlive a chunk deleted by another process
+    names = list(dict.fromkeys(chunk_names))
+    found = await asyncio.gather(*(async_drive.lookup(n, fresh=True) for n in names))
+    existing = {name for name, metadata in zip(names, found) if metadata is not None}
+    missing = {
+        name: chunk for name, chunk in zip(chunk_names, chunks) if name not in existing
+    }
+    await asyncio.gather(
+        *(
+            async_drive.write_stream(
+                name,
+                encrypt_stream(data_key, chunk, compression),
+                {chunking.CHUNK_OF_PROPERTY: file_name},
+            )
+            for name, chunk in missing.items()
+        )
+    )
+
+    # the manifest is only replaced once every chunk it lists exists
+    properties = dict(properties or {})
+    properties[chunking.STORAGE_PROPERTY] = chunking.CHUNKED
+    manifest = chunking.encode_manifest(chunk_names, len(plaintext))
+    await async_drive.write_stream(
+        file_name,
+        encrypt_stream(data_key, manifest),
+        properties,
+        expected_version=version,
+    )
+    await delete_many(list(set(previous_chunks or []) - set(chunk_names)))
+
+
+async def write_content(
+    file_name: str,
+    credential_bytes: bytes,
+    content: str,
+    properties=None,
+    compression: str = None,
+    storage: str = None,
+    version: str = None,
+):
+    # the new version only replaces the one read here, see drive.ConflictError
+    previous_properties = properties
+    if previous_properties is None:
+        previous_properties, version = await async_drive.get_versioned_properties(
+            file_name
+        )
+    data_key, has_key_slots = await verify_credentials(
+        file_name, credential_bytes, False, previous_properties
+    )
+    properties = None
+    if not has_key_slots:
+        data_key, properties = await run(new_key_slots, credential_bytes)
+
+    # keep the storage of the previous version unless the request picks another one
+    was_chunked = chunking.is_chunked(previous_properties)
+    storage = storage or ("chunked" if was_chunked else server.DEFAULT_STORAGE)
+    if storage not in ("whole", "chunked"):
+        raise Exception(f"unknown storage `{storage}`.")
+    with metrics.span("encrypt", exclusive=True):
+        previous_chunks = None
+        if was_chunked:
+            manifest = await read_encrypted(file_name, data_key)
+            previous_chunks = chunking.decode_manifest(manifest)
+
+        plaintext = content.encode("UTF-8")
+        if storage == "chunked":
+            await write_chunked(
+                file_name,
+                data_key,
+                plaintext,
+                properties,
+                previous_chunks,
+                compression,
+                version,
+            )
+            return
+
+        if was_chunked:
+            properties = dict(properties or {})
+            properties[chunking.STORAGE_PROPERTY] = None
+        await async_drive.write_stream(
+            file_name,
+            encrypt_stream(data_key, plaintext, compression),
+            properties,
+            expected_version=version,
+        )
+        if previous_chunks:
+            await delete_many(previous_chunks)
+
+
+async def delete_content(file_name: str, credential_bytes: bytes, properties=None):
+    if properties is None:
+        properties = await async_drive.get_properties(file_name)
+    data_key, _ = await verify_credentials(
+        file_name, credential_bytes, False, properties
+    )
+    # remove the file, and its chunks if it has any
+    if chunking.is_chunked(properties):
+        manifest = await read_encrypted(file_name, data_key)
+        await delete_many(chunking.decode_manifest(manifest))
+    await async_drive.delete(file_name)
+
+
+async def per_file(operation, file_names) -> dict:
+    # run an operation for every file concurrently, collecting per-file outcomes
+    async def outcome(name):
+        try:
+            return await operation(name)
+        except Exception as e:
+            message, status = describe_error(e)
+            return {"status": status, "error": message}
+
+    results = await asyncio.gather(*(outcome(name) for name in file_names))
+    return dict(zip(file_names, results))
+
+
+@route(Endpoint.Create)
+@with_file_locks
+async def create_file(body: dict):
+    file_name = body[RequestBodyField.Filename]
+    credential_bytes = await get_credential_bytes(body)
+
+    if await async_drive.exists(file_name):
+        return f"the file `{file_name}` already exists.", 409
+
+    data_key, properties = await run(new_key_slots, credential_bytes)
+    await async_drive.write_stream(
+        file_name, encrypt_stream(data_key, bytes()), properties
+    )
+    return "", 201
+
+
+@route(Endpoint.Read)
+async def read_file(body: dict):
+    file_name = body[RequestBodyField.Filename]
+    credential_bytes = await get_credential_bytes(body)
+    offset = body.get(RequestBodyField.Offset)
+    length = body.get(RequestBodyField.Length)
+    plaintext = await read_content(file_name, credential_bytes)
+    if offset is not None or length is not None:
+        # the whole file is downloaded, the range is cut from the plaintext
+        start, stop = server.plaintext_span(offset, length, len(plaintext))
+        content = plaintext[start:stop].decode("UTF-8", "replace")
+        return {"content": content, "offset": start, "size": len(plaintext)}, 200
+    return {"content": plaintext.decode("UTF-8")}, 200
+
+
+@route(Endpoint.Update)
+@with_file_locks
+async def update_file(body: dict):
+    file_name = body[RequestBodyField.Filename]
+    new_contents: str = body[RequestBodyField.Content]
+    credential_bytes = await get_credential_bytes(body)
+    compression = body.get(RequestBodyField.Compression)
+    storage = body.get(RequestBodyField.Storage)
+    await write_content(
+        file_name, credential_bytes, new_contents, None, compression, storage
+    )
+    return "", 200
+
+
+@route(Endpoint.Delete)
+@with_file_locks
+async def delete_file(body: dict):
+    file_name = body[RequestBodyField.Filename]
+    credential_bytes = await get_credential_bytes(body)
+    await delete_content(file_name, credential_bytes)
+    return "", 204
+
+
+@route(Endpoint.ChangePassword)
+@with_file_locks
+async def change_password(body: dict):
+    credential_bytes = await get_credential_bytes(body)
+    file_name = body[RequestBodyField.Filename]
+    new_password = body[RequestBodyField.NewPassword]
+    new_credential_bytes = await run(crypto.key_from_password, new_password)
+
+    data_key, has_key_slots, _ = await unlock_file(file_name, credential_bytes)
+    if has_key_slots:
+        wrapped_key = await run(crypto.wrap_key, new_credential_bytes, data_key)
+        await async_drive.set_properties(
+            file_name, {crypto.key_property(KeySlot.Password): wrapped_key}
+        )
+    else:
+        content = await read_content(file_name, credential_bytes)
+        data_key, properties = await run(new_key_slots, new_credential_bytes)
+        await async_drive.write_stream(
+            file_name, encrypt_stream(data_key, content), properties
+        )
+    return "", 200
+
+
+@route(Endpoint.SharedSecrets)
+async def get_shared_secrets(body: dict):
+    password = body[RequestBodyField.Password]
+    shares = int(body[RequestBodyField.Shares])
+    threshold = int(body[RequestBodyField.Threshold])
+    credential_bytes = await run(crypto.key_from_password, password)
+    shared_secrets = await run(
+        crypto.create_shared_secrets, credential_bytes, shares, threshold
+    )
+    return {RequestBodyField.SharedSecrets: shared_secrets}, 200
+
+
+@route(Endpoint.AddSharedSecrets)
+@with_file_locks
+async def add_shared_secrets(body: dict):
+    file_name = body[RequestBodyField.Filename]
+    shares = int(body[RequestBodyField.Shares])
+    threshold = int(body[RequestBodyField.Threshold])
+    credential_bytes = await get_credential_bytes(body)
+
+    data_key, has_key_slots, _ = await unlock_file(file_name, credential_bytes)
+    if not has_key_slots:
+        return "the file must be updated before adding shared secrets.", 409
+
+    shared_secret = crypto.generate_data_key()
+    shared_secrets = await run(
+        crypto.create_shared_secrets, shared_secret, shares, threshold
+    )
+    wrapped_key = await run(crypto.wrap_key, shared_secret, data_key)
+    await async_drive.set_properties(
+        file_name, {crypto.key_property(KeySlot.SharedSecrets): wrapped_key}
+    )
+    return {RequestBodyField.SharedSecrets: shared_secrets}, 200
+
+
+@route(Endpoint.RevokeSharedSecrets)
+@with_file_locks
+async def revoke_shared_secrets(body: dict):
+    file_name = body[RequestBodyField.Filename]
+    credential_bytes = await get_credential_bytes(body)
+    await verify_credentials(file_name, credential_bytes)
+    await async_drive.set_properties(
+        file_name, {crypto.key_property(KeySlot.SharedSecrets): None}
+    )
+    return "", 204
+
+
+@route(Endpoint.BatchRead)
+async def batch_read_files(body: dict):
+    file_names: list = body[RequestBodyField.Filenames]
+    credential_bytes = await get_credential_bytes(body)
+    all_properties = await async_drive.get_properties_many(file_names)
+
+    async def read_one(file_name: str):
+        if all_properties[file_name] is None:
+            raise FileNotFoundError
+        content = await read_content(
+            file_name, credential_bytes, all_properties[file_name]
+        )
+        return {"status": 200, "content": content.decode("UTF-8")}
+
+    return {RequestBodyField.Files: await per_file(read_one, file_names)}, 200
+
+
+@route(Endpoint.BatchUpdate)
+@with_file_locks
+async def batch_update_files(body: dict):
+    new_contents = {
+        entry[RequestBodyField.Filename]: entry[RequestBodyField.Content]
+        for entry in body[RequestBodyField.Files]
+    }
+    compression = body.get(RequestBodyField.Compression)
+    storage = body.get(RequestBodyField.Storage)
+    credential_bytes = await get_credential_bytes(body)
+    all_properties = await async_drive.get_versioned_properties_many(list(new_contents))
+
+    async def update_one(file_name: str):
+        if all_properties[file_name] is None:
+            raise FileNotFoundError
+        properties, version = all_properties[file_name]
+        await write_content(
+            file_name,
+            credential_bytes,
+            new_contents[file_name],
+            properties,
+            compression,
+            storage,
+            version,
+        )
+        return {"status": 200}
+
+    return {RequestBodyField.Files: await per_file(update_one, list(new_contents))}, 200
+
+
+@route(Endpoint.BatchDelete)
+@with_file_locks
+async def batch_delete_files(body: dict):
+    file_names: list = body[RequestBodyField.Filenames]
+    credential_bytes = await get_credential_bytes(body)
+    all_properties = await async_drive.get_properties_many(file_names)
+
+    async def delete_one(file_name: str):
+        if all_properties[file_name] is None:
+            raise FileNotFoundError
+        await delete_content(file_name, credential_bytes, all_properties[file_name])
+        return {"status": 204}
+
+    return {RequestBodyField.Files: await per_file(delete_one, file_names)}, 200
+
+
+@route(Endpoint.CollectGarbage)
+@with_file_locks
+async def collect_garbage(body: dict):
+    file_name = body[RequestBodyField.Filename]
+    credential_bytes = await get_credential_bytes(body)
+    properties = await async_drive.get_properties(file_name)
+    data_key, _ = await verify_credentials(
+        file_name, credential_bytes, properties=properties
+    )
+    if not chunking.is_chunked(properties):
+        return {"deleted": 0}, 200
+
+    # remove chunks of this file that its manifest no longer references
+    manifest = await read_encrypted(file_name, data_key)
+    referenced = set(chunking.decode_manifest(manifest))
+    tagged = await async_drive.find_by_property(chunking.CHUNK_OF_PROPERTY, file_name)
+    orphans = [name for name in tagged if name not in referenced]
+    await delete_many(orphans)
+    return {"deleted": len(orphans)}, 200
+
+
+async def respond(
+    send, status: int, payload, content_type: str = None, extra_headers=()
+):
+    if isinstance(payload, dict):
+        payload, content_type = json.dumps(payload).encode("UTF-8"), "application/json"
+    elif isinstance(payload, str):
+        payload = payload.encode("UTF-8")
+    headers = [
+        (b"content-type", (content_type or "text/html; charset=utf-8").encode()),
+        (b"content-length", str(len(payload)).encode()),
+        (b"access-control-allow-origin", b"*"),
+        *extra_headers,
+    ]
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def read_body(receive) -> bytes:
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return bytes(body)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await async_drive.init(
+                debug=server.configure_logging(DEBUG),
+                max_connections=MAX_CONNECTIONS,
+                api_endpoint=server.DRIVE_API_ENDPOINT,
+            )
+            offload.init(server.CRYPTO_PROCESSES)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_drive.close()
+            crypto_executor.shutdown()
+            offload.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    path, method = scope["path"], scope["method"]
+    if method in ("GET", "POST") and path in ("/", "/login"):
+        page = templates.get_template("index.html").render()
+        return await respond(send, 200, page)
+    if method == "GET" and path.startswith("/static/"):
+        static_path = os.path.normpath(path.lstrip("/"))
+        if not static_path.startswith("static") or not os.path.isfile(static_path):
+            return await respond(send, 404, "not found.")
+        with open(static_path, "rb") as static_file:
+            content_type, _ = mimetypes.guess_type(static_path)
+            return await respond(send, 200, static_file.read(), content_type)
+    if method == "GET" and path == "/metrics":
+        return await respond(send, 200, metrics.render(), "text/plain; version=0.0.4")
+
+    handler = routes.get(path)
+    if handler is None or method != "POST":
+        return await respond(send, 404, "not found.")
+
+    headers = dict(scope["headers"])
+    body = await read_body(receive)
+    if headers.get(b"content-type") != b"application/json":
+        return await respond(send, 415, "")
+    # a profile taken on the event loop also covers the requests running alongside
+    profile_token = headers.get(profiling.HEADER.lower().encode(), b"").decode(
+        "latin-1"
+    )
+    profile = profiling.start(path, profile_token)
+    # every request collects its spans and Drive API calls in a trace
+    token = metrics.start_trace()
+    try:
+        with metrics.span("parse"):
+            body = json.loads(body)
+        payload, status = await handler(body)
+    except Exception as e:
+        payload, status = describe_error(e)
+    trace = metrics.finish_trace(token, path, status)
+    extra_headers = []
+    if server.SERVER_TIMING:
+        extra_headers.append((b"server-timing", trace.server_timing().encode()))
+    if profile is not None:
+        name = profile.finish()
+        if profiling.requested(profile_token):
+            extra_headers.append((profiling.HEADER.lower().encode(), name.encode()))
+    await respond(send, status, payload, extra_headers=extra_headers)
@@ -0,0 +1,323 @@
+import argparse
+import base64
+import datetime
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Iterator, Optional, Tuple
+
+import crypto
+
+"""
+Throughput, latency and memory benchmarks for the functions in `crypto.py`.
+
+Runs offline, no Drive credentials needed:
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json
+The second form exits with status 1 when a case got slower or hungrier than the
+baseline by more than `--tolerance`.
+"""
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+# Payload sizes swept by default, 1KB to 1GB
+SIZES = [KB, 16 * KB, 256 * KB, 4 * MB, 64 * MB, GB]
+# (share count, threshold) pairs swept by default, invalid pairs are skipped
+SHARES = [(2, 2), (3, 2), (5, 3), (10, 5), (20, 10)]
+
+# Each case runs for at least this long, and at least MIN_REPEATS times
+MIN_TIME = 0.5
+MIN_REPEATS = 3
+
+# Relative slowdown (or memory growth) tolerated before a case is a regression
+TOLERANCE = 0.15
+# Peak memory differences below this are noise
+MEMORY_SLACK = 256 * KB
+
+_PASSWORD = "benchmark password"
+
+
+def format_size(size: int) -> str:
+    for unit, scale in (("GB", GB), ("MB", MB), ("KB", KB)):
+        if size >= scale and size % scale == 0:
+            return f"{size // scale}{unit}"
+    return f"{size}B"
+
+
+def payload(size: int) -> bytes:
+    # printable so decrypt_and_verify can decode it, random so it barely compresses
+    return base64.b64encode(os.urandom(size * 3 // 4 + 3))[:size]
+
+
+def measure(function: Callable[[], object], min_time: float, min_repeats: int):
+    # wall clock latency of every run, repeated until both minimums are met
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < min_repeats or time.perf_counter() - started < min_time:
+        begin = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - begin)
+    return latencies
+
+
+def measure_memory(function: Callable[[], object]) -> Tuple[int, int]:
+    # peak traced bytes of one run and the number of allocations it left alive
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+        del result
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    # the snapshots themselves are not counted
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    after, before = after.filter_traces(ignore), before.filter_traces(ignore)
+    retained = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    return peak - baseline, retained
+
+
+def _status(field: str) -> int:
+    # a memory figure of /proc/self/status, in bytes
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * KB
+    raise OSError(f"no {field} in /proc/self/status.")
+
+
+def measure_rss(function: Callable[[], object]) -> Optional[int]:
+    # growth of the peak resident set size over one run, None off Linux; unlike
+    # tracemalloc this also sees buffers allocated by C extensions
+    gc.collect()
+    try:
+        # resets the peak (VmHWM) to the current resident set size
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        baseline = _status("VmRSS")
+    except OSError:
+        return None
+    result = function()
+    peak = _status("VmHWM")
+    del result
+    return peak - baseline
+
+
+def cases(sizes: list, shares: list, compression: str) -> Iterator[tuple]:
+    # (name, function, bytes processed per call or None, parameters)
+    key = crypto.key_from_password(_PASSWORD)
+    salt = os.urandom(16)
+    yield "compute_salted_hash", lambda: crypto.compute_salted_hash(key, salt), None, {}
+    params = crypto.kdf_params(crypto.KDF_SCRYPT)
+    yield (
+        "derive_key/scrypt",
+        lambda: crypto.derive_key_uncached(key, salt, params),
+        None,
+        {"log_n": params[1], "r": params[2], "p": params[3]},
+    )
+    yield "derive_key/cached", lambda: crypto.derive_key(key, salt, params), None, {}
+
+    for share_count, threshold in shares:
+        try:
+            secrets = crypto.create_shared_secrets(key, share_count, threshold)
+        except Exception as e:
+            print(f"[BENCHMARK] skipping {threshold}-of-{share_count} shares: {e}")
+            continue
+        parameters = {"shares": share_count, "threshold": threshold}
+        yield (
+            f"create_shared_secrets/{threshold}-of-{share_count}",
+            lambda n=share_count, k=threshold: crypto.create_shared_secrets(key, n, k),
+            None,
+            parameters,
+        )
+        yield (
+            f"key_from_shared/{threshold}-of-{share_count}",
+            lambda s=secrets[:threshold]: crypto.key_from_shared(s),
+            None,
+            parameters,
+        )
+
+    for size in sizes:
+        plaintext = payload(size)
+        ciphertext = crypto.encrypt_and_digest(key, plaintext, compression)
+        parameters = {"size": size, "compression": compression}
+        yield (
+            f"encrypt_and_digest/{format_size(size)}",
+            lambda p=plaintext: crypto.encrypt_and_digest(key, p, compression),
+            size,
+            parameters,
+        )
+        yield (
+            f"decrypt_and_verify/{format_size(size)}",
+            lambda c=ciphertext: crypto.decrypt_and_verify(key, c),
+            size,
+            parameters,
+        )
+        yield (
+            f"decrypt_buffer/{format_size(size)}",
+            lambda c=ciphertext: crypto.decrypt_buffer(key, c),
+            size,
+            parameters,
+        )
+        del plaintext, ciphertext
+
+
+def run(
+    sizes: list = SIZES,
+    shares: list = SHARES,
+    compression: str = "none",
+    min_time: float = MIN_TIME,
+    min_repeats: int = MIN_REPEATS,
+    memory: bool = True,
+) -> dict:
+    results = dict()
+    for name, function, size, parameters in cases(sizes, shares, compression):
+        latencies = measure(function, min_time, min_repeats)
+        median = statistics.median(latencies)
+        result = dict(parameters)
+        result["repeats"] = len(latencies)
+        result["latency_ms"] = {
+            "min": min(latencies) * 1000,
+            "median": median * 1000,
+            "max": max(latencies) * 1000,
+        }
+        if size is None:
+            result["ops_per_s"] = 1 / median
+        else:
+            result["mb_per_s"] = size / MB / median
+        if memory:
+            result["peak_bytes"], result["retained_allocations"] = measure_memory(
+                function
+            )
+            peak_rss = measure_rss(function)
+            if peak_rss is not None:
+                result["peak_rss_bytes"] = peak_rss
+            if size:
+                # peak memory as a multiple of the payload, 1x is the output alone
+                result["peak_ratio"] = max(result["peak_bytes"], peak_rss or 0) / size
+        results[name] = result
+        print(f"[BENCHMARK] {name:<40} {describe(result)}")
+    return {
+        "meta": {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "segment_size": crypto.SEGMENT_SIZE,
+        },
+        "results": results,
+    }
+
+
+def describe(result: dict) -> str:
+    if "mb_per_s" in result:
+        rate = f"{result['mb_per_s']:10.1f} MB/s"
+    else:
+        rate = f"{result['ops_per_s']:10.1f} op/s"
+    text = f"{rate}  median {result['latency_ms']['median']:10.3f} ms"
+    if "peak_bytes" in result:
+        text += f"  peak {result['peak_bytes'] / MB:8.2f} MB"
+    if "peak_rss_bytes" in result:
+        text += f"  rss {result['peak_rss_bytes'] / MB:8.2f} MB"
+    if "peak_ratio" in result:
+        text += f" ({result['peak_ratio']:.2f}x)"
+    return text
+
+
+def compare(results: dict, baseline: dict, tolerance: float = TOLERANCE) -> list:
+    # descriptions of every case that regressed against the baseline
+    regressions = []
+    for name, result in results["results"].items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            continue
+        for metric in ("mb_per_s", "ops_per_s"):
+            if metric in result and metric in previous:
+                if result[metric] < previous[metric] * (1 - tolerance):
+                    regressions.append(
+                        f"{name}: {metric} {result[metric]:.1f} "
+                        f"< baseline {previous[metric]:.1f}"
+                    )
+        for metric in ("peak_bytes", "peak_rss_bytes"):
+            if metric in result and metric in previous:
+                allowed = previous[metric] * (1 + tolerance) + MEMORY_SLACK
+                if result[metric] > allowed:
+                    regressions.append(
+                        f"{name}: {metric} {result[metric]} "
+                        f"> baseline {previous[metric]}"
+                    )
+    return regressions
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    for unit, scale in (("GB", GB), ("MB", MB), ("KB", KB), ("B", 1)):
+        if text.endswith(unit):
+            return int(float(text[: -len(unit)]) * scale)
+    return int(text)
+
+
+def main(arguments: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark crypto.py.")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(format_size(size) for size in SIZES),
+        help="comma separated payload sizes, e.g. 1KB,1MB,1GB",
+    )
+    parser.add_argument(
+        "--shares",
+        default=",".join(f"{n}:{k}" for n, k in SHARES),
+        help="comma separated share count:threshold pairs",
+    )
+    parser.add_argument("--compression", default="none", choices=list(crypto.CODECS))
+    parser.add_argument("--min-time", type=float, default=MIN_TIME)
+    parser.add_argument("--min-repeats", type=int, default=MIN_REPEATS)
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip tracemalloc and peak RSS"
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(arguments)
+
+    results = run(
+        sizes=[parse_size(size) for size in args.sizes.split(",") if size],
+        shares=[
+            tuple(int(value) for value in pair.split(":"))
+            for pair in args.shares.split(",")
+            if pair
+        ],
+        compression=args.compression,
+        min_time=args.min_time,
+        min_repeats=args.min_repeats,
+        memory=not args.no_memory,
+    )
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print(f"[BENCHMARK] REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("[BENCHMARK] no regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
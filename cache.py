@@ -0,0 +1,359 @@
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, Optional
+
+"""
+In-process and on-disk caches shared by the drive and crypto layers.
+"""
+
+log = logging.getLogger("cache")
+
+
+class LRUCache:
+    """
+    Bounded mapping with least-recently-used eviction and an optional time-to-live.
+
+    ``on_evict`` is called with ``(key, value)`` whenever an entry leaves the cache,
+    whether it was evicted, expired, invalidated or cleared.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: Optional[float] = None,
+        on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        # set to False to bypass the cache entirely (useful when debugging)
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl is not None and time.monotonic() - stored_at > self.ttl
+
+    def _discard(self, key: Hashable):
+        _, value = self._data.pop(key)
+        if self.on_evict:
+            self.on_evict(key, value)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if not self.enabled:
+            return default
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or self._expired(entry[0]):
+                if entry is not None:
+                    self._discard(key)
+                self.misses += 1
+                return default
+            # mark as most recently used
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        if not self.enabled:
+            return
+        with self._lock:
+            if key in self._data:
+                self._discard(key)
+            self._data[key] = (time.monotonic(), value)
+            # evict least recently used entries past the size bound
+            while len(self._data) > self.maxsize:
+                self._discard(next(iter(self._data)))
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            if key in self._data:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._data):
+                self._discard(key)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class NameIndex:
+    """
+    Set of names listed by ``load``, listed again in a background thread once it is
+    older than ``ttl`` seconds.
+
+    Lookups never wait for a listing: until the first one completes ``get`` answers
+    None, afterwards a stale set keeps answering while the next listing runs. Names
+    this process adds or removes are applied right away (and again on top of a
+    listing that was under way), so the index only misses changes made by other
+    clients since its last listing.
+    """
+
+    def __init__(self, load: Callable[[], Iterable[str]], ttl: Optional[float] = 300):
+        self.load = load
+        self.ttl = ttl
+        self._names: Optional[set] = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        # changes made during a listing, name -> present, None while none runs
+        self._pending: Optional[dict] = None
+
+    def _stale(self) -> bool:
+        if self._names is None:
+            return True
+        return self.ttl is not None and time.monotonic() - self._loaded_at > self.ttl
+
+    def get(self, name: str) -> Optional[bool]:
+        # whether `name` is listed, None when the index has not been loaded yet
+        with self._lock:
+            if self._stale():
+                self._start_refresh()
+            if self._names is None:
+                return None
+            return name in self._names
+
+    def __contains__(self, name: str) -> bool:
+        return bool(self.get(name))
+
+    def refresh(self):
+        # list the names in the background ahead of the first lookup
+        with self._lock:
+            self._start_refresh()
+
+    def _start_refresh(self):
+        if self._pending is None:
+            self._pending = {}
+            threading.Thread(target=self._refresh, daemon=True).start()
+
+    def _refresh(self):
+        try:
+            names = set(self.load())
+        except Exception as e:
+            # the previous set keeps answering, the next lookup tries again
+            log.warning("listing the names failed: %s", e)
+            names = None
+        with self._lock:
+            pending, self._pending = self._pending, None
+            if names is None:
+                return
+            for name, present in pending.items():
+                if present:
+                    names.add(name)
+                else:
+                    names.discard(name)
+            self._names = names
+            self._loaded_at = time.monotonic()
+
+    def _change(self, name: str, present: bool):
+        with self._lock:
+            if self._pending is not None:
+                self._pending[name] = present
+            if self._names is not None:
+                if present:
+                    self._names.add(name)
+                else:
+                    self._names.discard(name)
+
+    def add(self, name: str):
+        self._change(name, True)
+
+    def discard(self, name: str):
+        self._change(name, False)
+
+    def clear(self):
+        with self._lock:
+            self._names = None
+
+    def __len__(self) -> int:
+        return len(self._names or ())
+
+
+class BlobWriter:
+    """
+    Streams one blob into a temporary file, it only enters the cache on ``commit``.
+    """
+
+    def __init__(self, cache: "BlobCache"):
+        self.cache = cache
+        self.size = 0
+        self._md5 = hashlib.md5()
+        descriptor, self.path = tempfile.mkstemp(dir=cache.directory, suffix=".tmp")
+        self._file = os.fdopen(descriptor, "wb")
+
+    def write(self, data: bytes):
+        if self._file is None:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_entry_bytes:
+            # too large to be worth caching
+            self.abort()
+            return
+        self._md5.update(data)
+        self._file.write(data)
+
+    def commit(self, key: str, md5: str) -> bool:
+        if self._file is None:
+            return False
+        self._file.close()
+        self._file = None
+        # only a blob matching the checksum reported by the server is kept
+        if self.size == 0 or self._md5.hexdigest() != md5:
+            os.remove(self.path)
+            return False
+        return self.cache._add(key, md5, self.size, self.path)
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.path)
+
+
+class BlobCache:
+    """
+    On-disk cache of blobs keyed by an id and the MD5 checksum of their content.
+
+    Every blob is stored as ``<key>.<md5>`` in ``directory`` and read back through a
+    memory map. The least recently used blobs are removed once the cache grows past
+    ``max_bytes``; the index is rebuilt from the directory on startup.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 512 * 1024 * 1024,
+        max_entry_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        # key -> (md5, size), least recently used first
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith(".tmp"):
+                # left behind by an interrupted download
+                self._remove(path)
+                continue
+            key, _, md5 = name.rpartition(".")
+            if key:
+                stat = os.stat(path)
+                found.append((stat.st_mtime, key, md5, stat.st_size))
+        for _, key, md5, size in sorted(found):
+            self._entries[key] = (md5, size)
+            self.size += size
+        with self._lock:
+            self._evict()
+
+    def _path(self, key: str, md5: str) -> str:
+        return os.path.join(self.directory, f"{key}.{md5}")
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            # still mapped by a reader on some platforms, retried on next startup
+            pass
+
+    def _discard(self, key: str):
+        md5, size = self._entries.pop(key)
+        self.size -= size
+        self._remove(self._path(key, md5))
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            self._discard(next(iter(self._entries)))
+
+    def _add(self, key: str, md5: str, size: int, source: str) -> bool:
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            try:
+                os.replace(source, self._path(key, md5))
+            except OSError:
+                self._remove(source)
+                return False
+            self._entries[key] = (md5, size)
+            self.size += size
+            self._evict()
+        return True
+
+    def get(self, key: str, md5: str) -> Optional[mmap.mmap]:
+        # a read-only memory map of the blob, None unless it matches the checksum
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != md5:
+                if entry is not None:
+                    # a newer revision exists, the cached one is useless now
+                    self._discard(key)
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key, md5), "rb") as blob:
+                    mapped = mmap.mmap(blob.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                self._entries.pop(key)
+                self.size -= entry[1]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return mapped
+
+    def writer(self) -> BlobWriter:
+        return BlobWriter(self)
+
+    def put(self, key: str, md5: str, data: bytes) -> bool:
+        writer = self.writer()
+        writer.write(data)
+        return writer.commit(key, md5)
+
+    def pop(self, key: str):
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._discard(key)
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
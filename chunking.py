@@ -0,0 +1,185 @@
+import hmac
+import json
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from typing import Iterator, List
+
+import crypto
+import drive
+import metrics
+
+"""
+Chunked storage: a file is kept as an encrypted manifest (the file itself) listing
+content-defined chunks, each encrypted on its own and stored as a separate Drive file
+named after a keyed hash of its plaintext. Editing a few lines of a large document
+only changes the chunks around the edit, so an update uploads those and the manifest.
+"""
+
+# appProperty of the manifest file that marks it as chunked
+STORAGE_PROPERTY = "storage"
+CHUNKED = "chunked"
+# appProperty of every chunk naming the file it belongs to, used to sweep orphans
+CHUNK_OF_PROPERTY = "chunk-of"
+CHUNK_PREFIX = ".chunk-"
+
+# Chunk size bounds, boundaries fall on average every AVERAGE_SIZE bytes
+MIN_SIZE = 16 * 1024
+AVERAGE_SIZE = 64 * 1024
+MAX_SIZE = 256 * 1024
+
+# Number of chunks transferred concurrently
+TRANSFER_WORKERS = 8
+
+_NAME_LABEL = b"encrypted-google-drive chunk name"
+
+# Gear table for the rolling hash, fixed so boundaries are stable between runs
+_GEAR = [random.Random(i).getrandbits(64) for i in range(256)]
+_MASK_64 = 2**64 - 1
+# stricter mask before the average size and looser after it (normalized chunking)
+_MASK_SMALL = (1 << ((AVERAGE_SIZE.bit_length() - 1) + 2)) - 1 << 40
+_MASK_LARGE = (1 << ((AVERAGE_SIZE.bit_length() - 1) - 2)) - 1 << 40
+
+transfers = ThreadPoolExecutor(max_workers=TRANSFER_WORKERS)
+
+log = logging.getLogger("chunking")
+
+
+def _boundary(data: memoryview, start: int) -> int:
+    # end of the chunk starting at `start`, found with a gear rolling hash
+    end = min(start + MAX_SIZE, len(data))
+    if end - start <= MIN_SIZE:
+        return end
+    gear, fingerprint = _GEAR, 0
+    middle = min(start + AVERAGE_SIZE, end)
+    for position in range(start + MIN_SIZE, middle):
+        fingerprint = ((fingerprint << 1) + gear[data[position]]) & _MASK_64
+        if not fingerprint & _MASK_SMALL:
+            return position + 1
+    for position in range(middle, end):
+        fingerprint = ((fingerprint << 1) + gear[data[position]]) & _MASK_64
+        if not fingerprint & _MASK_LARGE:
+            return position + 1
+    return end
+
+
+def split(plaintext: bytes) -> List[bytes]:
+    view = memoryview(plaintext)
+    chunks, start = [], 0
+    while start < len(view):
+        end = _boundary(view, start)
+        chunks.append(bytes(view[start:end]))
+        start = end
+    return chunks
+
+
+def chunk_name(data_key: bytes, chunk: bytes) -> str:
+    # keyed so chunk names reveal nothing about content without the data key
+    name_key = hmac.new(data_key, _NAME_LABEL, sha256).digest()
+    return CHUNK_PREFIX + hmac.new(name_key, chunk, sha256).hexdigest()
+
+
+def verify_chunk(data_key: bytes, name: str, chunk: bytes) -> bytes:
+    # a chunk only stands for the name its plaintext hashes to, so chunks encrypted
+    # under the same data key can not be swapped, reordered or replayed
+    if not hmac.compare_digest(chunk_name(data_key, chunk), name):
+        raise ValueError("MAC check failed: the chunk does not match its name.")
+    return chunk
+
+
+def encode_manifest(chunk_names: List[str], size: int) -> bytes:
+    return json.dumps({"chunks": chunk_names, "size": size}).encode("UTF-8")
+
+
+def decode_manifest(manifest: bytes) -> List[str]:
+    return json.loads(manifest)["chunks"]
+
+
+def is_chunked(properties: dict) -> bool:
+    return (properties or {}).get(STORAGE_PROPERTY) == CHUNKED
+
+
+def read_manifest(file_name: str, data_key: bytes) -> List[str]:
+    manifest = b"".join(crypto.decrypt_stream(data_key, drive.read_stream(file_name)))
+    return decode_manifest(manifest)
+
+
+def read_chunked(file_name: str, data_key: bytes) -> bytes:
+    return b"".join(read_chunked_stream(file_name, data_key))
+
+
+def read_chunked_stream(file_name: str, data_key: bytes) -> Iterator[bytes]:
+    chunk_names = read_manifest(file_name, data_key)
+    # resolve every chunk in one batch, then download them concurrently
+    drive.lookup_many(list(set(chunk_names)))
+
+    def read_chunk(name: str) -> bytes:
+        chunk = b"".join(crypto.decrypt_stream(data_key, drive.read_stream(name)))
+        return verify_chunk(data_key, name, chunk)
+
+    yield from transfers.map(metrics.propagate(read_chunk), chunk_names)
+
+
+def write_chunked(
+    file_name: str,
+    data_key: bytes,
+    plaintext: bytes,
+    properties: dict = None,
+    previous_chunks: List[str] = None,
+    compression: str = None,
+    expected_version: str = None,
+):
+    chunks = split(plaintext)
+    chunk_names = [chunk_name(data_key, chunk) for chunk in chunks]
+
+    # only chunks that are not on the drive yet are uploaded; whether a chunk exists
+    # is asked anew, a cached entry may outlive a chunk deleted by another process
+    existing = drive.lookup_many(list(set(chunk_names)), fresh=True)
+    missing = {
+        name: chunk
+        for name, chunk in zip(chunk_names, chunks)
+        if existing.get(name) is None
+    }
+
+    def write_chunk(name: str):
+        drive.write(
+            name,
+            crypto.encrypt_and_digest(data_key, missing[name], compression),
+            {CHUNK_OF_PROPERTY: file_name},
+        )
+
+    list(transfers.map(metrics.propagate(write_chunk), missing))
+    log.debug("%s of %s chunk(s) uploaded.", len(missing), len(chunks))
+
+    # the manifest is only replaced once every chunk it lists exists, a conflicting
+    # write leaves the new chunks for `collect_garbage`
+    properties = dict(properties or {})
+    properties[STORAGE_PROPERTY] = CHUNKED
+    manifest = encode_manifest(chunk_names, len(plaintext))
+    drive.write_stream(
+        file_name,
+        crypto.encrypt_stream(data_key, [manifest]),
+        properties,
+        expected_version=expected_version,
+    )
+
+    # chunks only referenced by the previous version are garbage now
+    unreferenced = set(previous_chunks or []) - set(chunk_names)
+    if unreferenced:
+        drive.delete_many(list(unreferenced))
+
+
+def delete_chunks(file_name: str, data_key: bytes):
+    drive.delete_many(list(set(read_manifest(file_name, data_key))))
+
+
+def collect_garbage(file_name: str, data_key: bytes) -> int:
+    # delete chunks tagged with this file that its manifest no longer lists, such as
+    # those left behind by an interrupted update
+    referenced = set(read_manifest(file_name, data_key))
+    tagged = drive.find_by_property(CHUNK_OF_PROPERTY, file_name)
+    orphans = [name for name in tagged if name not in referenced]
+    if orphans:
+        drive.delete_many(orphans)
+    return len(orphans)
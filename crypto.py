@@ -1,11 +1,19 @@
-import io
-from random import randint
-from typing import List
+import hashlib
+import hmac
+import lzma
+import struct
+import zlib
+from base64 import b64decode, b64encode
+from typing import Iterable, Iterator, List
 from hashlib import sha256
 
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 
+import offload
+import shamir
+from cache import LRUCache
+
 """
 Functions for performing crypographic operations.
 
@@ -13,67 +21,111 @@ in the end this may become a wrapper file for many of the functionalities
 already provided in the pycryptodome package.
 """
 
-# credit to https://github.com/lapets for the intuition on computing shamir secrets in the interger domain with python modulo inverse
-
-# prime modulo close to the 256 bit limit of AES-256
-_PRIME: int = 2**256 - 189
+# data keys double as shamir secrets, so they stay below the field prime
+_PRIME: int = shamir.PRIME
 
+# Segmented file format (version 3):
+#   header   = magic | version | codec | segment size | salt | nonce prefix
+#   segments = ciphertext | tag, for every `segment size` bytes of plaintext
+# each segment nonce is the header nonce prefix followed by the segment counter and a
+# flag set only on the final segment, so segments cannot be reordered or truncated.
+# The legacy (version 1) layout is salt | nonce | tag | ciphertext with no header.
+#
+# Compressed files are written as version 4, same header, where every `segment size`
+# bytes of plaintext are compressed on their own so each segment can be read alone:
+#   frames   = sealed length | ciphertext | tag, for every segment
+#   index    = sealed length | plaintext size and the sealed length of every segment,
+#              encrypted as the final segment
+#   trailer  = sealed length of the index
+# range reads locate segments through the index at the end of the file.
+MAGIC = b"EGDF"
+FORMAT_VERSION = 3
+COMPRESSED_FORMAT_VERSION = 4
+SEGMENT_SIZE = 64 * 1024
+TAG_SIZE = 16
+_HEADERS = {
+    3: struct.Struct(">4sBBI16s7s"),
+    4: struct.Struct(">4sBBI16s7s"),
+}
+# leading bytes of a file that always include its whole header
+HEADER_SIZE = max(header.size for header in _HEADERS.values())
+# length field of version 4 frames and trailer, and the head of its index
+_FRAME = struct.Struct(">I")
+_INDEX_HEAD = struct.Struct(">Q")
+# trailing bytes of a version 4 file read to find its index, enough for the index of
+# a 256MB file; larger indexes take a second read
+INDEX_READ_SIZE = 16 * 1024
 
-def create_shared_secrets(
-    credential_bytes: bytes, share_count: int = 5, shares_sufficient: int = 3
-) -> list:
-    if shares_sufficient > 3:
-        raise Exception("cannot set threshold to a value greater than 3")
+# Compression codecs applied to the plaintext before it is encrypted
+CODEC_NONE, CODEC_ZLIB, CODEC_LZMA = 0, 1, 2
+CODECS = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "lzma": CODEC_LZMA}
+# codec used for new files, and its level (zlib 1-9, lzma preset 0-9)
+COMPRESSION = "zlib"
+COMPRESSION_LEVEL = 6
+# plaintext sampled to decide whether compressing it is worth it
+COMPRESSION_SAMPLE = 64 * 1024
+# samples smaller than this are never compressed
+COMPRESSION_MIN_SIZE = 512
+# compression is skipped when the sample does not shrink below this ratio
+COMPRESSION_MAX_RATIO = 0.9
 
-    if share_count > 5:
-        raise Exception("share count cannot be greater than 5")
+# Envelope encryption: file contents are encrypted under a random data key, and that
+# data key is stored once per unlock method ("key slot") in the file's Drive
+# appProperties as base64(kdf | salt | nonce | tag | wrapped data key), each wrapped
+# under a key derived from the slot's credential. Rotating credentials only rewrites
+# the slot.
+KEY_PROPERTY_PREFIX = "key-"
+_WRAP_LABEL = b"encrypted-google-drive wrapped key"
 
-    if shares_sufficient > share_count:
-        raise Exception("share count should not be less than the sufficient threshold.")
+# Key check value: base64(kdf | salt | truncated MAC over a fixed label), kept in the
+# Drive metadata of files without key slots so credentials can be checked without
+# content.
+KEY_CHECK_PROPERTY = "check"
+_KEY_CHECK_LABEL = b"encrypted-google-drive key check"
 
-    int_secret = int.from_bytes(credential_bytes, "big")
+# Key derivation from credentials, the kdf field (id | log2 n | r | p) records which
+# one and at what cost, so raising the cost only changes newly written values:
+#   KDF_SHA256 (0): the salted SHA-256 chain of `compute_salted_hash`, no parameters
+#   KDF_SCRYPT (1): scrypt with n = 2**log2 n, r and p, using 128 * r * n bytes
+KDF_SHA256, KDF_SCRYPT = 0, 1
+_KDF_FIELD = struct.Struct(">BBBB")
+# KDF and cost of new key slots and key check values, about 50ms and 16MB per key
+KDF = KDF_SCRYPT
+SCRYPT_LOG_N = 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+# highest scrypt memory (128 * r * n bytes) and parallelism accepted from stored
+# values, so a tampered slot costs at most 8 times the defaults above
+_SCRYPT_MAX_MEMORY = 64 * 1024 * 1024
+_SCRYPT_MAX_P = 2
 
-    shares = dict()
-    # Random polynomial coefficients.
-    coefficients: List[int] = [int_secret] + [
-        randint(0, _PRIME - 1) for _ in range(1, shares_sufficient)
-    ]
+# Derived keys by (keyed credential digest, salt, kdf field), so requests on the same
+# file pay the KDF once per KEY_CACHE_TTL seconds. Keys leaving the cache are
+# overwritten, as far as Python allows; copies handed out are the callers' to drop.
+KEY_CACHE_SIZE = 256
+KEY_CACHE_TTL = 300
+_KEY_CACHE_SECRET = get_random_bytes(32)
 
-    # Compute each share such that shares[i] = f(i).
-    for i in range(1, share_count + 1):
-        shares[i] = coefficients[0]
-        for j in range(1, len(coefficients)):
-            shares[i] = (shares[i] + coefficients[j] * pow(i, j)) % _PRIME
 
-    return [f'{i}-{format(s, "x")}' for i, s in shares.items()]
+def create_shared_secrets(
+    credential_bytes: bytes, share_count: int = 5, shares_sufficient: int = 3
+) -> list:
+    return offload.run(
+        "split",
+        share_count * shares_sufficient,
+        shamir.split,
+        credential_bytes,
+        share_count,
+        shares_sufficient,
+    )
 
 
 def key_from_shared(shared_secrets: List[str]) -> bytes:
-    def inv(a: int, prime: int):
-        return pow(a, prime - 2, prime)
-
-    points = dict()
-    for indexed_secret in shared_secrets:
-        index, secret_hex = indexed_secret.split("-")
-        points[int(index)] = int(secret_hex, 16)
-
-    # Compute the Lagrange coefficients at ``0``.
-    coefficients = dict()
-    for i, y_i in enumerate(points.keys(), start=1):
-        coefficients[i] = 1
-        for j, y_j in enumerate(points.keys(), start=1):
-            if y_i != y_j:
-                coefficients[i] = (
-                    coefficients[i] * (-y_j) * inv(y_i - y_j, _PRIME)
-                ) % _PRIME
-
-    key = 0
-    # compute using horners theorem for computing polynomials
-    for i, g in enumerate(points.values(), start=1):
-        key = (key + g * coefficients[i]) % _PRIME
-
-    # return the assembled key, which is equivalent to the bytes of the password
-    return key.to_bytes(32, "big")
+    # the assembled key is equivalent to the bytes of the password
+    shared_secrets = list(shared_secrets)
+    return offload.run(
+        "combine", len(shared_secrets) ** 2, shamir.combine, shared_secrets
+    )
 
 
 def key_from_password(password: str) -> bytes:
@@ -88,45 +140,858 @@ def compute_salted_hash(credential_bytes: bytes, salt: bytes) -> bytes:
     return key
 
 
-def encrypt_and_digest(credential_bytes: bytes, plaintext: bytes) -> bytes:
-    # generate random nonce value
-    nonce = get_random_bytes(16)
-    # generate random salt for hashing
+def _zeroize(_, key: bytearray):
+    key[:] = bytes(len(key))
+
+
+KEYS = LRUCache(maxsize=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL, on_evict=_zeroize)
+
+
+def kdf_params(kdf: int = None) -> tuple:
+    # kdf field of new derivations, with the configured KDF unless `kdf` is given
+    kdf = KDF if kdf is None else kdf
+    if kdf == KDF_SCRYPT:
+        return KDF_SCRYPT, SCRYPT_LOG_N, SCRYPT_R, SCRYPT_P
+    return KDF_SHA256, 0, 0, 0
+
+
+def _split_kdf(raw: bytes) -> tuple:
+    # (kdf field, rest) of a stored key slot or key check value
+    if len(raw) < _KDF_FIELD.size:
+        raise ValueError("MAC check failed: unknown key derivation.")
+    return _KDF_FIELD.unpack(raw[: _KDF_FIELD.size]), raw[_KDF_FIELD.size :]
+
+
+def derive_key_uncached(credential_bytes: bytes, salt: bytes, params: tuple) -> bytes:
+    kdf, log_n, r, p = params
+    if kdf == KDF_SHA256:
+        return compute_salted_hash(credential_bytes, salt)
+    if (
+        kdf == KDF_SCRYPT
+        and 0 < log_n < 32
+        and 0 < r
+        and 0 < p <= _SCRYPT_MAX_P
+        and 128 * r * 2**log_n <= _SCRYPT_MAX_MEMORY
+    ):
+        n = 2**log_n
+        return hashlib.scrypt(
+            credential_bytes,
+            salt=salt,
+            n=n,
+            r=r,
+            p=p,
+            maxmem=128 * r * (n + p + 2) + 1024 * 1024,
+            dklen=32,
+        )
+    raise ValueError("MAC check failed: unknown key derivation.")
+
+
+def _kdf_cost(params: tuple) -> int:
+    # scrypt memory times its parallelism, the SHA-256 chain is free in comparison
+    kdf, log_n, r, p = params
+    if kdf != KDF_SCRYPT:
+        return 0
+    return 128 * r * 2 ** min(log_n, 32) * p
+
+
+def derive_key(credential_bytes: bytes, salt: bytes, params: tuple) -> bytes:
+    # the credentials are never kept, only a digest under a per-process key
+    digest = hmac.new(_KEY_CACHE_SECRET, credential_bytes, sha256).digest()
+    cache_key = (digest, bytes(salt), tuple(params))
+    cached = KEYS.get(cache_key)
+    if cached is not None:
+        return bytes(cached)
+    key = offload.run(
+        "kdf", _kdf_cost(params), derive_key_uncached, credential_bytes, salt, params
+    )
+    KEYS.set(cache_key, bytearray(key))
+    return key
+
+
+def generate_data_key() -> bytes:
+    # random secret that is also a valid shamir secret (below the prime modulus)
+    while True:
+        key = get_random_bytes(32)
+        if int.from_bytes(key, "big") < _PRIME:
+            return key
+
+
+def wrap_key(credential_bytes: bytes, data_key: bytes) -> str:
+    params = kdf_params()
+    salt = get_random_bytes(16)
+    nonce = get_random_bytes(12)
+    cipher = AES.new(
+        derive_key(credential_bytes, salt, params), AES.MODE_GCM, nonce=nonce
+    )
+    cipher.update(_WRAP_LABEL)
+    wrapped, tag = cipher.encrypt_and_digest(data_key)
+    field = _KDF_FIELD.pack(*params)
+    return b64encode(field + salt + nonce + tag + wrapped).decode("ascii")
+
+
+def unwrap_key(credential_bytes: bytes, wrapped_key: str) -> bytes:
+    params, raw = _split_kdf(b64decode(wrapped_key))
+    salt, nonce, tag, wrapped = raw[:16], raw[16:28], raw[28:44], raw[44:]
+    cipher = AES.new(
+        derive_key(credential_bytes, salt, params), AES.MODE_GCM, nonce=nonce
+    )
+    cipher.update(_WRAP_LABEL)
+    return cipher.decrypt_and_verify(wrapped, tag)
+
+
+def wrapped_keys(properties: dict) -> dict:
+    # pick the key slots out of a file's appProperties
+    return {
+        name[len(KEY_PROPERTY_PREFIX) :]: value
+        for name, value in (properties or {}).items()
+        if name.startswith(KEY_PROPERTY_PREFIX) and value
+    }
+
+
+def key_property(slot: str) -> str:
+    return KEY_PROPERTY_PREFIX + slot
+
+
+def unwrap_any(credential_bytes: bytes, slots: dict) -> bytes:
+    # try the credential against every key slot of the file
+    for wrapped_key in slots.values():
+        try:
+            return unwrap_key(credential_bytes, wrapped_key)
+        except ValueError:
+            continue
+    raise ValueError("MAC check failed: no key slot matches the credentials.")
+
+
+def _key_check_mac(credential_bytes: bytes, salt: bytes, params: tuple) -> bytes:
+    key = derive_key(credential_bytes, salt, params)
+    return hmac.new(key, _KEY_CHECK_LABEL, sha256).digest()[:16]
+
+
+def key_check_value(credential_bytes: bytes, kdf: int = None) -> str:
+    params = kdf_params(kdf)
     salt = get_random_bytes(16)
-    # generate key from credentials
+    mac = _key_check_mac(credential_bytes, salt, params)
+    return b64encode(_KDF_FIELD.pack(*params) + salt + mac).decode("ascii")
+
+
+def verify_key_check(credential_bytes: bytes, check_value: str):
+    params, raw = _split_kdf(b64decode(check_value))
+    mac = _key_check_mac(credential_bytes, raw[:16], params)
+    if not hmac.compare_digest(mac, raw[16:]):
+        raise ValueError("MAC check failed: credentials do not match key check.")
+
+
+def _segment_nonce(nonce_prefix: bytes, counter: int, last: bool) -> bytes:
+    return nonce_prefix + struct.pack(">IB", counter, 1 if last else 0)
+
+
+def _open_segment(
+    key: bytes,
+    header: bytes,
+    nonce_prefix: bytes,
+    counter: int,
+    last: bool,
+    segment: bytes,
+) -> bytes:
+    cipher = AES.new(
+        key, AES.MODE_GCM, nonce=_segment_nonce(nonce_prefix, counter, last)
+    )
+    # every segment is bound to the header it was written under
+    cipher.update(header)
+    return cipher.decrypt_and_verify(segment[:-TAG_SIZE], segment[-TAG_SIZE:])
+
+
+def _seal_into(
+    key: bytes,
+    header: bytes,
+    nonce_prefix: bytes,
+    counter: int,
+    last: bool,
+    segment: bytes,
+    output: memoryview,
+):
+    # encrypt a segment into the front of `output`, its tag right after it
+    cipher = AES.new(
+        key, AES.MODE_GCM, nonce=_segment_nonce(nonce_prefix, counter, last)
+    )
+    cipher.update(header)
+    cipher.encrypt(segment, output=output[: len(segment)])
+    output[len(segment) : len(segment) + TAG_SIZE] = cipher.digest()
+
+
+def _open_into(
+    key: bytes,
+    header: bytes,
+    nonce_prefix: bytes,
+    counter: int,
+    last: bool,
+    segment: memoryview,
+    output: memoryview,
+):
+    # decrypt a sealed segment into the front of `output`, then verify it; on a
+    # failed check `output` holds unauthenticated data and must be dropped
+    if len(segment) < TAG_SIZE:
+        raise ValueError("MAC check failed: file is truncated.")
+    cipher = AES.new(
+        key, AES.MODE_GCM, nonce=_segment_nonce(nonce_prefix, counter, last)
+    )
+    cipher.update(header)
+    cipher.decrypt(segment[:-TAG_SIZE], output=output[: len(segment) - TAG_SIZE])
+    cipher.verify(segment[-TAG_SIZE:])
+
+
+def sealed_size(size: int, segment_size: int = SEGMENT_SIZE) -> int:
+    # bytes taken by the segments of `size` bytes of (compressed) plaintext, there
+    # is always at least one
+    return size + max(1, -(-size // segment_size)) * TAG_SIZE
+
+
+def is_segmented(file_data: bytes) -> bool:
+    return file_data[:4] == MAGIC and len(file_data) > 4 and file_data[4] in _HEADERS
+
+
+def choose_codec(sample: bytes, compression: str = None) -> int:
+    # skip small or incompressible (already compressed, encrypted, media) plaintext
+    compression = compression or COMPRESSION
+    if compression not in CODECS:
+        raise Exception(f"unknown compression codec `{compression}`.")
+    codec = CODECS[compression]
+    if codec == CODEC_NONE or len(sample) < COMPRESSION_MIN_SIZE:
+        return CODEC_NONE
+    trial = zlib.compress(sample[:COMPRESSION_SAMPLE], 1)
+    if len(trial) > COMPRESSION_MAX_RATIO * min(len(sample), COMPRESSION_SAMPLE):
+        return CODEC_NONE
+    return codec
+
+
+def _compress_segment(codec: int, level: int, segment: bytes) -> bytes:
+    if codec == CODEC_ZLIB:
+        return zlib.compress(segment, level)
+    return lzma.compress(segment, preset=level)
+
+
+def _decompressor(codec: int):
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    return lzma.LZMADecompressor()
+
+
+def _check_codec(version: int, codec: int):
+    # only version 4 files are compressed, every segment on its own
+    if codec not in CODECS.values() or (codec != CODEC_NONE) != (
+        version == COMPRESSED_FORMAT_VERSION
+    ):
+        raise ValueError("MAC check failed: unknown compression codec.")
+
+
+def _decompress_segment(codec: int, data: bytes, limit: int) -> bytes:
+    # a segment compressed on its own, holding at most `limit` bytes of plaintext
+    decompressor = _decompressor(codec)
+    plaintext = decompressor.decompress(data, limit + 1)
+    if len(plaintext) > limit or not decompressor.eof or decompressor.unused_data:
+        raise ValueError("MAC check failed: compressed segment is corrupt.")
+    return plaintext
+
+
+def _pack_index(size: int, sealed_sizes: List[int]) -> bytes:
+    return struct.pack(f">Q{len(sealed_sizes)}I", size, *sealed_sizes)
+
+
+class StreamEncryptor:
+    """
+    Incrementally encrypts plaintext into the segmented file format.
+
+    ``update`` returns the bytes that are ready to be written and ``finalize`` the
+    remaining ones, so at most one segment of plaintext is ever buffered (plus the
+    compression sample until the codec has been chosen).
+    """
+
+    def __init__(
+        self,
+        credential_bytes: bytes,
+        segment_size: int = SEGMENT_SIZE,
+        compression: str = None,
+        level: int = None,
+    ):
+        self._salt = get_random_bytes(16)
+        self._nonce_prefix = get_random_bytes(7)
+        self._key = compute_salted_hash(credential_bytes, self._salt)
+        self._segment_size = segment_size
+        self._compression = compression
+        self._level = COMPRESSION_LEVEL if level is None else level
+        self._codec = CODEC_NONE
+        self._counter = 0
+        self._buffer = bytearray()
+        self._pending = bytearray()
+        # plaintext size and sealed segment lengths, indexed at the end of a
+        # compressed file
+        self._size = 0
+        self._sealed_sizes = []
+        # plaintext held back until the codec (and so the header) is decided
+        self._sample = bytearray()
+        self.header = None
+
+    def _start(self):
+        self._codec = choose_codec(self._sample, self._compression)
+        version = COMPRESSED_FORMAT_VERSION if self._codec else FORMAT_VERSION
+        self.header = _HEADERS[version].pack(
+            MAGIC,
+            version,
+            self._codec,
+            self._segment_size,
+            self._salt,
+            self._nonce_prefix,
+        )
+        self._pending += self.header
+        sample, self._sample = bytes(self._sample), None
+        return sample
+
+    def _seal(self, segment: bytes, last: bool):
+        nonce = _segment_nonce(self._nonce_prefix, self._counter, last)
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=nonce)
+        # bind every segment to the header it was written under
+        cipher.update(self.header)
+        self._pending += cipher.encrypt(segment)
+        self._pending += cipher.digest()
+        self._counter += 1
+
+    def _seal_frame(self, data: bytes, last: bool):
+        # compressed files frame every sealed segment with its length
+        self._pending += _FRAME.pack(len(data) + TAG_SIZE)
+        self._seal(data, last)
+
+    def _seal_segment(self, segment: bytes):
+        if not self._codec:
+            self._seal(segment, False)
+            return
+        data = _compress_segment(self._codec, self._level, segment)
+        self._size += len(segment)
+        self._sealed_sizes.append(len(data) + TAG_SIZE)
+        self._seal_frame(data, False)
+
+    def update(self, plaintext: bytes) -> bytes:
+        if self.header is None:
+            self._sample += plaintext
+            if len(self._sample) < COMPRESSION_SAMPLE:
+                return bytes()
+            plaintext = self._start()
+        self._buffer += plaintext
+        return self._drain()
+
+    def _drain(self) -> bytes:
+        # keep the last segment back until we know whether it is the final one,
+        # compressed files end with their index instead
+        count = len(self._buffer) // self._segment_size
+        if not self._codec:
+            count = (len(self._buffer) - 1) // self._segment_size
+        if count > 0:
+            with memoryview(self._buffer) as view:
+                for index in range(count):
+                    start = index * self._segment_size
+                    self._seal_segment(view[start : start + self._segment_size])
+            del self._buffer[: count * self._segment_size]
+        output, self._pending = bytes(self._pending), bytearray()
+        return output
+
+    def finalize(self) -> bytes:
+        if self.header is None:
+            self._buffer += self._start()
+        # the remaining data may still span several segments
+        output = self._drain()
+        if not self._codec:
+            self._seal(self._buffer, True)
+        else:
+            # every file has at least one segment, even an empty one
+            if self._buffer or not self._counter:
+                self._seal_segment(self._buffer)
+            index = _pack_index(self._size, self._sealed_sizes)
+            self._seal_frame(index, True)
+            self._pending += _FRAME.pack(len(index) + TAG_SIZE)
+        self._buffer = bytearray()
+        return output + bytes(self._pending)
+
+
+class StreamDecryptor:
+    """
+    Incrementally decrypts the segmented file format, verifying every segment.
+
+    Data is only returned once its segment has been authenticated; ``finalize``
+    raises ``ValueError`` if the stream was truncated or tampered with.
+    """
+
+    def __init__(self, credential_bytes: bytes):
+        self._credential_bytes = credential_bytes
+        self._buffer = bytearray()
+        self._counter = 0
+        self._size = 0
+        self._sealed_sizes = []
+        self.header = None
+
+    def _read_header(self) -> bool:
+        if len(self._buffer) < 5:
+            return False
+        if not is_segmented(self._buffer):
+            raise ValueError("MAC check failed: unknown file format.")
+        header_format = _HEADERS[self._buffer[4]]
+        if len(self._buffer) < header_format.size:
+            return False
+
+        self.header = bytes(self._buffer[: header_format.size])
+        fields = header_format.unpack(self.header)
+        _check_codec(fields[1], fields[2])
+        self._codec = fields[2]
+        self._framed = fields[1] == COMPRESSED_FORMAT_VERSION
+        self._segment_size, salt, self._nonce_prefix = fields[-3:]
+        self._key = compute_salted_hash(self._credential_bytes, salt)
+        del self._buffer[: header_format.size]
+        return True
+
+    def _open(self, segment: bytes, last: bool) -> bytes:
+        plaintext = _open_segment(
+            self._key, self.header, self._nonce_prefix, self._counter, last, segment
+        )
+        self._counter += 1
+        return plaintext
+
+    def _open_frame(self, segment: bytes) -> bytes:
+        # a segment compressed on its own, only the last one may hold less than a
+        # full segment of plaintext
+        if self._size % self._segment_size:
+            raise ValueError("MAC check failed: segment index does not match.")
+        plaintext = _decompress_segment(
+            self._codec, self._open(segment, False), self._segment_size
+        )
+        self._size += len(plaintext)
+        self._sealed_sizes.append(len(segment))
+        return plaintext
+
+    def _update_frames(self) -> bytes:
+        output = bytearray()
+        position = 0
+        with memoryview(self._buffer) as view:
+            while len(view) - position >= _FRAME.size:
+                (sealed,) = _FRAME.unpack_from(view, position)
+                end = position + _FRAME.size + sealed
+                # the index is followed by the trailer alone, a frame with more
+                # data after it holds a segment
+                if len(view) - end <= _FRAME.size:
+                    break
+                output += self._open_frame(view[position + _FRAME.size : end])
+                position = end
+        del self._buffer[:position]
+        return bytes(output)
+
+    def update(self, data: bytes) -> bytes:
+        self._buffer += data
+        if self.header is None and not self._read_header():
+            return bytes()
+        if self._framed:
+            return self._update_frames()
+
+        output = bytearray()
+        sealed_size = self._segment_size + TAG_SIZE
+        # keep the last sealed segment back, it may be the final one
+        count = (len(self._buffer) - 1) // sealed_size
+        if count > 0:
+            with memoryview(self._buffer) as view:
+                for index in range(count):
+                    start = index * sealed_size
+                    output += self._open(view[start : start + sealed_size], False)
+            del self._buffer[: count * sealed_size]
+        return bytes(output)
+
+    def _finalize_frames(self):
+        # what is left is the index and the trailer, which must match the segments
+        if len(self._buffer) < 2 * _FRAME.size + TAG_SIZE:
+            raise ValueError("MAC check failed: file is truncated.")
+        (sealed,) = _FRAME.unpack_from(self._buffer)
+        if self._buffer[-_FRAME.size :] != _FRAME.pack(sealed):
+            raise ValueError("MAC check failed: file is truncated.")
+        if len(self._buffer) != 2 * _FRAME.size + sealed:
+            raise ValueError("MAC check failed: file is truncated.")
+        index = self._open(self._buffer[_FRAME.size : -_FRAME.size], True)
+        if not self._sealed_sizes or index != _pack_index(
+            self._size, self._sealed_sizes
+        ):
+            raise ValueError("MAC check failed: segment index does not match.")
+
+    def finalize(self) -> bytes:
+        if self.header is None or len(self._buffer) < TAG_SIZE:
+            raise ValueError("MAC check failed: file is truncated.")
+        if self._framed:
+            self._finalize_frames()
+            self._buffer = bytearray()
+            return bytes()
+        output = self._open(self._buffer, True)
+        self._buffer = bytearray()
+        return output
+
+
+class SegmentReader:
+    """
+    Random access to the plaintext of a segmented file, built from its first
+    ``HEADER_SIZE`` bytes and its stored size.
+
+    ``ciphertext_range`` names the bytes holding a plaintext range and ``decrypt``
+    authenticates and decrypts only those segments, ``decrypt_all`` decrypts a
+    complete file. Compressed (version 4) files are
+    ``indexed``: their segments are located once ``load_index`` was given the bytes
+    named by ``index_range``.
+    """
+
+    def __init__(self, credential_bytes: bytes, head: bytes, file_size: int):
+        if not is_segmented(head) or len(head) < _HEADERS[head[4]].size:
+            raise ValueError("MAC check failed: unknown file format.")
+        header_format = _HEADERS[head[4]]
+        self.header = bytes(head[: header_format.size])
+        fields = header_format.unpack(self.header)
+        _check_codec(fields[1], fields[2])
+        self.codec = fields[2]
+        self.indexed = fields[1] == COMPRESSED_FORMAT_VERSION
+        self.segment_size, salt, self._nonce_prefix = fields[-3:]
+        self._key = compute_salted_hash(credential_bytes, salt)
+        self._sealed_size = self.segment_size + TAG_SIZE
+        self._file_size = file_size
+        body_size = file_size - len(self.header)
+        # the final segment may be short (or empty), every segment has a tag; the
+        # index of an indexed file tells these two apart instead
+        self.segments = max(1, -(-body_size // self._sealed_size))
+        self.size = max(0, body_size - self.segments * TAG_SIZE)
+        # start of every frame of an indexed file, and of its index
+        self._offsets = None
+        self._index_size = None
+
+    def index_range(self) -> tuple:
+        # trailing bytes of the file holding its index and trailer, a guess until
+        # the trailer has been read
+        if self._index_size is None:
+            size = INDEX_READ_SIZE
+        else:
+            size = self._index_size + _FRAME.size
+        return max(len(self.header), self._file_size - size), self._file_size - 1
+
+    def load_index(self, tail: bytes) -> bool:
+        # read the index out of the bytes named by `index_range`, False when they
+        # turned out too short and `index_range` must be read again
+        if len(tail) < _FRAME.size:
+            raise ValueError("MAC check failed: file is truncated.")
+        (sealed,) = _FRAME.unpack(tail[-_FRAME.size :])
+        count, extra = divmod(sealed - TAG_SIZE - _INDEX_HEAD.size, _FRAME.size)
+        body_size = self._file_size - len(self.header)
+        if count < 1 or extra or sealed + 2 * _FRAME.size > body_size:
+            raise ValueError("MAC check failed: file is truncated.")
+        self._index_size = sealed
+        if len(tail) < sealed + _FRAME.size:
+            return False
+
+        with memoryview(tail) as view:
+            index = _open_segment(
+                self._key,
+                self.header,
+                self._nonce_prefix,
+                count,
+                True,
+                view[len(view) - _FRAME.size - sealed : len(view) - _FRAME.size],
+            )
+        size, *sealed_sizes = struct.unpack(f">Q{count}I", index)
+        offsets = [len(self.header)]
+        for segment in sealed_sizes:
+            offsets.append(offsets[-1] + _FRAME.size + segment)
+        # the frames, the index and the trailer must fill the file exactly
+        if (
+            offsets[-1] + 2 * _FRAME.size + sealed != self._file_size
+            or max(1, -(-size // self.segment_size)) != count
+        ):
+            raise ValueError("MAC check failed: segment index does not match.")
+        self._offsets = offsets
+        self.segments, self.size = count, size
+        return True
+
+    def _span(self, offset: int, length: int) -> tuple:
+        # first and last segment holding a non-empty plaintext range
+        return offset // self.segment_size, (offset + length - 1) // self.segment_size
+
+    def ciphertext_range(self, offset: int, length: int) -> tuple:
+        # first and last byte of the file to fetch, inclusive as in an HTTP Range
+        first, last = self._span(offset, length)
+        if self.indexed:
+            return self._frames()[first], self._frames()[last + 1] - 1
+        start = len(self.header) + first * self._sealed_size
+        end = min(len(self.header) + (last + 1) * self._sealed_size, self._file_size)
+        return start, end - 1
+
+    def _frames(self) -> list:
+        if self._offsets is None:
+            raise ValueError("MAC check failed: segment index was not loaded.")
+        return self._offsets
+
+    def _open_frames(self, first: int, last: int, data: bytes) -> bytearray:
+        # plaintext of the compressed segments `first` to `last`, framed back to back
+        # in `data`
+        offsets = self._frames()
+        size = (
+            min(self.size, (last + 1) * self.segment_size) - first * self.segment_size
+        )
+        plaintext = bytearray(size)
+        with memoryview(data) as view:
+            for index in range(first, last + 1):
+                start = offsets[index] - offsets[first]
+                end = offsets[index + 1] - offsets[first]
+                if view[start : start + _FRAME.size] != _FRAME.pack(
+                    end - start - _FRAME.size
+                ):
+                    raise ValueError("MAC check failed: segment index does not match.")
+                segment = _decompress_segment(
+                    self.codec,
+                    _open_segment(
+                        self._key,
+                        self.header,
+                        self._nonce_prefix,
+                        index,
+                        False,
+                        view[start + _FRAME.size : end],
+                    ),
+                    self.segment_size,
+                )
+                position = (index - first) * self.segment_size
+                if len(segment) != min(self.segment_size, len(plaintext) - position):
+                    raise ValueError("MAC check failed: segment index does not match.")
+                plaintext[position : position + len(segment)] = segment
+        return plaintext
+
+    def _open_segments(self, first: int, last: int, data: bytes) -> bytearray:
+        # plaintext of segments `first` to `last`, sealed back to back in `data`,
+        # decrypted into a single buffer
+        if self.indexed:
+            return self._open_frames(first, last, data)
+        count = last - first + 1
+        plaintext = bytearray(max(0, len(data) - count * TAG_SIZE))
+        with memoryview(data) as view, memoryview(plaintext) as output:
+            for index in range(first, last + 1):
+                position = index - first
+                _open_into(
+                    self._key,
+                    self.header,
+                    self._nonce_prefix,
+                    index,
+                    index == self.segments - 1,
+                    view[position * self._sealed_size :][: self._sealed_size],
+                    output[position * self.segment_size :],
+                )
+        return plaintext
+
+    def decrypt(self, offset: int, length: int, data: bytes) -> bytearray:
+        # the plaintext range, out of the bytes named by `ciphertext_range`
+        first, last = self._span(offset, length)
+        plaintext = self._open_segments(first, last, data)
+        skip = offset - first * self.segment_size
+        # trimmed in place rather than sliced into a copy
+        del plaintext[skip + length :]
+        del plaintext[:skip]
+        return plaintext
+
+    def decrypt_all(self, file_data: bytes) -> bytearray:
+        # the whole plaintext, out of the complete file, decrypted into one buffer
+        # allocated up front
+        if self.indexed:
+            self.load_index(file_data)
+        with memoryview(file_data) as view:
+            return self._open_segments(0, self.segments - 1, view[len(self.header) :])
+
+
+def encrypt_stream(
+    credential_bytes: bytes,
+    chunks: Iterable[bytes],
+    segment_size: int = SEGMENT_SIZE,
+    compression: str = None,
+) -> Iterator[bytes]:
+    encryptor = StreamEncryptor(credential_bytes, segment_size, compression)
+    for chunk in chunks:
+        output = encryptor.update(chunk)
+        if output:
+            yield output
+    yield encryptor.finalize()
+
+
+class FileDecryptor:
+    """
+    Decrypts either file format incrementally, picking it from the first bytes.
+
+    The legacy layout is authenticated as a whole, so it is buffered until
+    ``finalize``; the segmented format streams segment by segment.
+    """
+
+    def __init__(self, credential_bytes: bytes):
+        self._credential_bytes = credential_bytes
+        self._head = bytearray()
+        self._decryptor = None
+        self._legacy = False
+
+    def update(self, data: bytes) -> bytes:
+        if self._decryptor is not None:
+            return self._decryptor.update(data)
+        self._head += data
+        # read enough to tell the segmented format apart from the legacy layout
+        if self._legacy or len(self._head) < len(MAGIC) + 1:
+            return bytes()
+        if not is_segmented(self._head):
+            self._legacy = True
+            return bytes()
+        self._decryptor = StreamDecryptor(self._credential_bytes)
+        head, self._head = bytes(self._head), bytearray()
+        return self._decryptor.update(head)
+
+    def finalize(self) -> bytes:
+        if self._decryptor is not None:
+            return self._decryptor.finalize()
+        return _decrypt_legacy(self._credential_bytes, bytes(self._head))
+
+
+def decrypt_stream(credential_bytes: bytes, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    decryptor = FileDecryptor(credential_bytes)
+    for chunk in chunks:
+        output = decryptor.update(chunk)
+        if output:
+            yield output
+    yield decryptor.finalize()
+
+
+def verify_stream(credential_bytes: bytes, chunks: Iterable[bytes]):
+    # authenticate a whole file without keeping any of the plaintext
+    for _ in decrypt_stream(credential_bytes, chunks):
+        pass
+
+
+def encrypt_and_digest(
+    credential_bytes: bytes,
+    plaintext: bytes,
+    compression: str = None,
+    segment_size: int = SEGMENT_SIZE,
+) -> bytearray:
+    # large payloads are encrypted by a worker process, see offload.py
+    return offload.run(
+        "encrypt",
+        len(plaintext),
+        _encrypt_and_digest,
+        credential_bytes,
+        plaintext,
+        compression,
+        segment_size,
+    )
+
+
+def _encrypt_and_digest(
+    credential_bytes: bytes,
+    plaintext: bytes,
+    compression: str = None,
+    segment_size: int = SEGMENT_SIZE,
+) -> bytearray:
+    # the whole file in one buffer allocated up front, every segment is encrypted
+    # straight into it from a view of the plaintext
+    view = memoryview(plaintext)
+    codec = choose_codec(view[:COMPRESSION_SAMPLE], compression)
+    version = COMPRESSED_FORMAT_VERSION if codec else FORMAT_VERSION
+    salt, nonce_prefix = get_random_bytes(16), get_random_bytes(7)
+    header = _HEADERS[version].pack(
+        MAGIC, version, codec, segment_size, salt, nonce_prefix
+    )
     key = compute_salted_hash(credential_bytes, salt)
-    # create the AES-GCM cipher
-    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
-    # encrypt the data
-    ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+    if codec:
+        return _encrypt_frames(key, header, nonce_prefix, codec, view, segment_size)
+
+    file_data = bytearray(len(header) + sealed_size(len(view), segment_size))
+    file_data[: len(header)] = header
+    segments = max(1, -(-len(view) // segment_size))
+    with memoryview(file_data) as output:
+        for counter in range(segments):
+            start = counter * segment_size
+            _seal_into(
+                key,
+                header,
+                nonce_prefix,
+                counter,
+                counter == segments - 1,
+                view[start : start + segment_size],
+                output[len(header) + counter * (segment_size + TAG_SIZE) :],
+            )
+    return file_data
 
-    # IO buffer to hold the encrypted file data
-    file_data = io.BytesIO()
-    # write metadata and content to file buffer (salt | nonce | tag | ciphertext)
-    file_data.write(salt + nonce + tag + ciphertext)
 
-    # reset the reading pointer
-    file_data.seek(0)
-    # return all of the bytes of this file
-    return file_data.read()
+def _encrypt_frames(
+    key: bytes,
+    header: bytes,
+    nonce_prefix: bytes,
+    codec: int,
+    view: memoryview,
+    segment_size: int,
+) -> bytearray:
+    # segments are compressed first, the buffer is allocated once their sizes are
+    # known
+    segments = [
+        _compress_segment(codec, COMPRESSION_LEVEL, view[start : start + segment_size])
+        for start in range(0, len(view), segment_size)
+    ] or [_compress_segment(codec, COMPRESSION_LEVEL, bytes())]
+    index = _pack_index(len(view), [len(data) + TAG_SIZE for data in segments])
+    frames = segments + [index]
+    file_data = bytearray(
+        len(header)
+        + sum(_FRAME.size + len(data) + TAG_SIZE for data in frames)
+        + _FRAME.size
+    )
+    file_data[: len(header)] = header
+    position = len(header)
+    with memoryview(file_data) as output:
+        for counter, data in enumerate(frames):
+            sealed = len(data) + TAG_SIZE
+            _FRAME.pack_into(output, position, sealed)
+            _seal_into(
+                key,
+                header,
+                nonce_prefix,
+                counter,
+                counter == len(segments),
+                data,
+                output[position + _FRAME.size :],
+            )
+            position += _FRAME.size + sealed
+        _FRAME.pack_into(output, position, len(index) + TAG_SIZE)
+    return file_data
 
 
-def decrypt_and_verify(credential_bytes: bytes, file_data: bytes) -> str:
-    # read the data through a byte buffer
-    file_bytes = io.BytesIO(file_data)
-    # read all of the components from the file data
-    salt, nonce, tag, ciphertext = (
-        file_bytes.read(16),
-        file_bytes.read(16),
-        file_bytes.read(16),
-        file_bytes.read(),
+def decrypt_buffer(credential_bytes: bytes, file_data: bytes) -> bytes:
+    # large files are decrypted by a worker process, see offload.py
+    return offload.run(
+        "decrypt", len(file_data), _decrypt_buffer, credential_bytes, file_data
     )
+
+
+def _decrypt_buffer(credential_bytes: bytes, file_data: bytes) -> bytes:
+    # the plaintext of a whole file held in memory
+    head = bytes(file_data[:HEADER_SIZE])
+    if not is_segmented(head):
+        return _decrypt_legacy(credential_bytes, file_data)
+    return SegmentReader(credential_bytes, head, len(file_data)).decrypt_all(file_data)
+
+
+def _decrypt_legacy(credential_bytes: bytes, file_data: bytes) -> bytearray:
+    if len(file_data) < 48:
+        raise ValueError("MAC check failed: file is truncated.")
+    # read all of the components from the file data, without copying the ciphertext
+    view = memoryview(file_data)
+    salt, nonce, tag, ciphertext = view[:16], view[16:32], view[32:48], view[48:]
     # compute hashed key
-    key = compute_salted_hash(credential_bytes, salt)
+    key = compute_salted_hash(credential_bytes, bytes(salt))
     # create cipher using stored nonce
-    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=bytes(nonce))
     # decrypt and verify
-    plaintext: bytes = cipher.decrypt_and_verify(ciphertext, tag)
+    plaintext = bytearray(len(ciphertext))
+    cipher.decrypt(ciphertext, output=plaintext)
+    cipher.verify(tag)
+    return plaintext
+
+
+def decrypt_and_verify(credential_bytes: bytes, file_data: bytes) -> str:
+    plaintext = decrypt_buffer(credential_bytes, file_data)
     # return the contents of the file
     return plaintext.decode("UTF-8")
 
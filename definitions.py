@@ -8,12 +8,32 @@ Design definitions/aspects of the backend service.
 
 class RequestBodyField:
     Filename = "file_name"
+    # list of file names for the batch endpoints
+    Filenames = "file_names"
+    # batch update input (list of file name/content objects) and batch results
+    Files = "files"
     Password = "password"
     SharedSecrets = "shared_secrets"
     NewPassword = "new_password"
     Content = "content"
     Shares = "shares"
     Threshold = "threshold"
+    # optional compression codec for new content ("none", "zlib" or "lzma")
+    Compression = "compression"
+    # optional storage for new content ("whole" or "chunked")
+    Storage = "storage"
+    # optional byte range of a read, a negative offset counts from the end
+    Offset = "offset"
+    Length = "length"
+
+
+class RequestHeader:
+    # credentials of the binary endpoints, whose body is the file content itself
+    Password = "X-Password"
+    # comma separated, like the shared_secrets body field
+    SharedSecrets = "X-Shared-Secrets"
+    # optional compression codec for uploaded content
+    Compression = "X-Compression"
 
 
 class Endpoint:
@@ -30,3 +50,26 @@ class Endpoint:
     SharedSecrets = "shared-secrets"
     # change the password for the currently open document
     ChangePassword = "change-password"
+    # generate shared secrets that unlock only the given file, replacing older ones
+    AddSharedSecrets = "add-shared-secrets"
+    # remove the file-specific shared secrets of a file
+    RevokeSharedSecrets = "revoke-shared-secrets"
+
+    # read, update or delete many files sharing the same credentials at once
+    BatchRead = "batch-read"
+    BatchUpdate = "batch-update"
+    BatchDelete = "batch-delete"
+
+    # delete chunks of a chunked file that are no longer referenced
+    CollectGarbage = "collect-garbage"
+
+    # store or fetch binary content as the raw body, the file name is a query parameter
+    Upload = "upload"
+    Download = "download"
+
+
+class KeySlot:
+    # data key wrapped under the password (and the shares generated from it)
+    Password = "password"
+    # data key wrapped under an independent secret split into shares
+    SharedSecrets = "shared"
@@ -3,42 +3,317 @@ from __future__ import print_function
 import os.path
 import datetime
 import io
+import functools
+import json
+import logging
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional
 
+import httplib2
+from google.auth.credentials import AnonymousCredentials
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
 from googleapiclient.discovery import Resource
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.http import MediaUpload
+
+import metrics
+from cache import BlobCache, LRUCache, NameIndex
+from pool import PrefetchPool, ServicePool
+from scheduler import Scheduler
 
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 
+# File metadata kept for every cached name lookup, `version` grows with every change
+METADATA_FIELDS = "id, md5Checksum, modifiedTime, version, size"
 
-def init(debug: bool = False):
-    # Global copy of Google Drive API service and Debug flag
-    global DEBUG, API
-    DEBUG = debug
+# Marker cached for names known not to exist on the drive
+_ABSENT = object()
+
+# In-process cache of filename -> {id, md5Checksum, modifiedTime, version, size}
+CACHE = LRUCache(maxsize=1024, ttl=60)
+
+# On-disk cache of downloaded ciphertext keyed by file id and md5Checksum, the
+# content is already encrypted so keeping it locally exposes nothing new
+BLOB_CACHE_DIR = "ciphertext-cache"
+BLOB_CACHE_SIZE = 512 * 1024 * 1024
+BLOBS: Optional[BlobCache] = None
+
+# Size of each resumable upload/download request, must be a multiple of 256KB
+CHUNK_SIZE = 1024 * 1024
+
+# Maximum number of calls the Drive API accepts in one batch request
+BATCH_LIMIT = 100
+
+# File ids reserved per files.generateIds call (at most 1000), creates take one from
+# the pool so a new file is a single files.create call
+ID_BATCH = 100
+IDS = PrefetchPool(lambda: _generate_ids(), low=ID_BATCH // 4)
+# Service of the fetches that refill IDS, apart from POOL: the creates waiting for
+# those ids may hold every pooled service
+BACKGROUND: Optional[ServicePool] = None
+
+# Every file name on the drive, listed in the background at startup and again once
+# older than NAME_INDEX_TTL seconds. Creates check it instead of sending a list query
+# per name; it does not see files other clients created since it was listed.
+NAME_INDEX_TTL = 300
+NAMES: Optional[NameIndex] = NameIndex(lambda: _list_names(), NAME_INDEX_TTL)
+
+# Seconds before an HTTP connection to the Drive API times out
+HTTP_TIMEOUT = 60
+
+# Drive API calls per second the whole process allows itself, shared by every thread
+# (and by async_drive.py) so bursts stay under the per-user Drive quota
+RATE_LIMIT = 100
+# Tries of a call failing with a transient error before the error is raised
+MAX_ATTEMPTS = 5
+SCHEDULER = Scheduler(RATE_LIMIT, max_attempts=MAX_ATTEMPTS)
+# Request header, stripped before sending, on calls SCHEDULER may repeat although
+# their method is not idempotent
+REPEATABLE_HEADER = "X-Repeatable"
+
+# Drive services checked out by one thread at a time, httplib2 is not thread-safe
+POOL = ServicePool(lambda: _build_service(), size=16)
+
+# Serializes refreshes of the credentials shared by every pooled service
+_REFRESH_LOCK = threading.Lock()
+
+# Root URL of a Drive API stand-in (see emulator.py), None for Google Drive itself
+API_ENDPOINT: Optional[str] = None
+
+DEBUG = False
+
+log = logging.getLogger("drive")
+
+metrics.register(
+    metrics.Gauge(
+        "egd_metadata_cache",
+        "Entries, hits and misses of the filename metadata cache.",
+        ("stat",),
+        lambda: {(k,): CACHE.stats()[k] for k in ("size", "hits", "misses")},
+    )
+)
+metrics.register(
+    metrics.Gauge(
+        "egd_ciphertext_cache",
+        "Entries, bytes, hits and misses of the on-disk ciphertext cache.",
+        ("stat",),
+        lambda: {
+            (k,): v
+            for k, v in (BLOBS.stats() if BLOBS is not None else {}).items()
+            if k != "directory"
+        },
+    )
+)
+metrics.register(
+    metrics.Gauge(
+        "egd_file_names",
+        "Pre-allocated file ids left in the pool and names in the name index.",
+        ("stat",),
+        lambda: {("ids",): len(IDS), ("names",): len(NAMES or ())},
+    )
+)
+metrics.register(
+    metrics.Gauge(
+        "egd_drive_services",
+        "Size of the Drive service pool and the services created and idle.",
+        ("stat",),
+        lambda: {(k,): v for k, v in POOL.stats().items()},
+    )
+)
+
+
+# `expected_version` of a write that must create the file, see `_check_version`
+NEW_FILE = "new"
+
+
+class ConflictError(Exception):
+    """
+    The file changed on the drive since the version a conditional write expected.
+    """
+
+
+class IterableUpload(MediaUpload):
+    """
+    Resumable upload fed by an iterator of byte chunks of unknown total size.
+
+    Only the bytes that have not yet been acknowledged by the server are buffered.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], chunksize: int = CHUNK_SIZE):
+        self._chunks = iter(chunks)
+        self._chunksize = chunksize
+        self._buffer = bytearray()
+        # stream offset of the first byte held in the buffer
+        self._offset = 0
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return "application/octet-stream"
+
+    def resumable(self):
+        return True
+
+    def getbytes(self, begin, length):
+        # drop everything the server has already acknowledged
+        del self._buffer[: begin - self._offset]
+        self._offset = begin
+        for chunk in self._chunks:
+            self._buffer += chunk
+            if len(self._buffer) >= length:
+                break
+        return bytes(self._buffer[:length])
 
+
+class BufferReader(io.RawIOBase):
+    """
+    Seekable file object reading from a bytes-like object in place.
+
+    Unlike ``io.BytesIO``, which copies a ``bytearray`` up front, only the bytes
+    asked for by each ``read`` are copied out of the buffer.
+    """
+
+    def __init__(self, data: bytes):
+        self._view = memoryview(data).cast("B")
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        chunk = self._view[self._position : self._position + len(buffer)]
+        buffer[: len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+
+class InstrumentedHttp(httplib2.Http):
+    """
+    HTTP connection that sends every Drive API call through `SCHEDULER`, retrying
+    transient failures, and reports every try to `metrics`.
+    """
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        call = describe_call(method, uri)
+        if headers and REPEATABLE_HEADER in headers:
+            # never sent, marks a call that is safe to send again whatever its method
+            headers = {k: v for k, v in headers.items() if k != REPEATABLE_HEADER}
+            retry_method = "PUT"
+        else:
+            retry_method = method
+        if hasattr(body, "read"):
+            # one chunk of a streamed upload, read once so every try sends it whole
+            body = body.read()
+        attempt = 0
+        while True:
+            delay = SCHEDULER.admit(call)
+            if delay:
+                time.sleep(delay)
+            try:
+                response, content = self._send(
+                    call, uri, method, body, headers, *args, **kwargs
+                )
+            except (ConnectionError, TimeoutError):
+                delay = SCHEDULER.retry_delay(call, retry_method, attempt)
+                if delay is None:
+                    raise
+            else:
+                delay = SCHEDULER.retry_delay(
+                    call,
+                    retry_method,
+                    attempt,
+                    response.status,
+                    content,
+                    response.get("retry-after"),
+                )
+                if delay is None:
+                    return response, content
+            log.debug("Retrying %s call in %.2f seconds.", call, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def _send(self, call, uri, method, body, headers, *args, **kwargs):
+        begin = time.perf_counter()
+        status, received = "error", 0
+        try:
+            response, content = super().request(
+                uri, method, body, headers, *args, **kwargs
+            )
+            status, received = response.status, len(content or b"")
+            return response, content
+        finally:
+            metrics.drive_call(
+                call,
+                status,
+                time.perf_counter() - begin,
+                len(body) if body else 0,
+                received,
+            )
+
+
+def describe_call(method: str, uri: str) -> str:
+    # short name of a Drive API call, used as a metric label
+    path, _, query = uri.partition("?")
+    path = path.rstrip("/")
+    if "/batch/" in path:
+        return "batch"
+    if "/upload/" in path:
+        return "upload" if method in ("POST", "PATCH") else "upload-chunk"
+    if "alt=media" in query:
+        return "media"
+    if path.endswith("/files/generateIds"):
+        return "generate-ids"
+    if path.endswith("/files"):
+        return "list" if method == "GET" else "create"
+    return {"GET": "get", "PATCH": "update", "DELETE": "delete"}.get(
+        method, method.lower()
+    )
+
+
+def load_credentials() -> Credentials:
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
     if os.path.exists("token.json"):
-        if DEBUG:
-            print("[DRIVE] Authorizing user...")
+        log.debug("Authorizing user...")
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            if DEBUG:
-                print("[DRIVE] Re-authorizing user...")
+            log.debug("Re-authorizing user...")
             creds.refresh(Request())
         else:
-            if DEBUG:
-                print("[DRIVE] Authorizing new user...")
+            log.debug("Authorizing new user...")
             flow = InstalledAppFlow.from_client_secrets_file(
                 "client_secret.json",
                 SCOPES,
@@ -48,164 +323,886 @@ def init(debug: bool = False):
         with open("token.json", "w") as token:
             token.write(creds.to_json())
 
+    return creds
+
+
+def init(
+    debug: bool = False,
+    use_cache: bool = True,
+    cache_size: int = 1024,
+    cache_ttl: float = 60,
+    pool_size: int = 16,
+    blob_cache_dir: Optional[str] = BLOB_CACHE_DIR,
+    blob_cache_size: int = BLOB_CACHE_SIZE,
+    api_endpoint: Optional[str] = None,
+    rate_limit: Optional[float] = RATE_LIMIT,
+    max_attempts: int = MAX_ATTEMPTS,
+    name_index_ttl: Optional[float] = NAME_INDEX_TTL,
+):
+    # Global copy of the Google Drive API service pool, credentials and Debug flag
+    global DEBUG, POOL, BACKGROUND, CREDENTIALS, BLOBS, API_ENDPOINT, SCHEDULER
+    global IDS, NAMES
+    DEBUG = debug
+    if debug:
+        log.setLevel(logging.DEBUG)
+    API_ENDPOINT = api_endpoint
+
+    # `rate_limit=None` sends calls as fast as they come, retries still apply
+    SCHEDULER = Scheduler(rate_limit, max_attempts=max_attempts)
+
+    # configure the metadata cache, `use_cache=False` sends every lookup to the API
+    CACHE.enabled = use_cache
+    CACHE.maxsize = cache_size
+    CACHE.ttl = cache_ttl
+    CACHE.clear()
+
+    # `blob_cache_dir=None` downloads the content of every read
+    BLOBS = None
+    if blob_cache_dir:
+        BLOBS = BlobCache(blob_cache_dir, max_bytes=blob_cache_size)
+
+    # `name_index_ttl=None` checks every new name with a list query instead
+    NAMES = None
+    if name_index_ttl:
+        NAMES = NameIndex(_list_names, name_index_ttl)
+    IDS = PrefetchPool(_generate_ids, low=ID_BATCH // 4)
+
+    # an emulated API needs no OAuth flow
+    CREDENTIALS = AnonymousCredentials() if api_endpoint else load_credentials()
     try:
-        # try to return the service
-        API = build("drive", "v3", credentials=creds)
-        if DEBUG:
-            print("[DRIVE] Connected to Google Drive service successfully!")
-        return API
+        # build the first service now so connection problems surface at startup
+        POOL = ServicePool(_build_service, size=pool_size)
+        BACKGROUND = ServicePool(_build_service, size=1)
+        with POOL.checkout():
+            pass
+        IDS.prefetch()
+        if NAMES is not None:
+            NAMES.refresh()
+        log.debug("Connected to Google Drive service successfully!")
+        return POOL
 
     except HttpError as error:
         # TODO(developer) - Handle errors from drive API.
-        print(f"Unable to connect. Error occurred: {error}")
+        log.critical("Unable to connect. Error occurred: %s", error)
         exit(1)
 
 
+def _build_service() -> Resource:
+    # every service keeps its own keep-alive connections but shares the credentials
+    http = InstrumentedHttp(timeout=HTTP_TIMEOUT)
+    # a 308 answers an upload chunk, it is not a redirect (as in `build_http`)
+    http.redirect_codes = set(http.redirect_codes) - {308}
+    http = AuthorizedHttp(CREDENTIALS, http=http)
+    if API_ENDPOINT:
+        return build_from_document(_emulated_discovery(API_ENDPOINT), http=http)
+    return build("drive", "v3", http=http)
+
+
+def _emulated_discovery(api_endpoint: str) -> dict:
+    # the bundled discovery document with every URL moved over to `api_endpoint`
+    document = json.loads(get_static_doc("drive", "v3"))
+    root_url = api_endpoint.rstrip("/") + "/"
+    document["rootUrl"] = document["mtlsRootUrl"] = root_url
+    document["baseUrl"] = root_url + document["servicePath"]
+    return document
+
+
+def _refresh_credentials():
+    # refresh once for every thread instead of racing on the shared credentials
+    if CREDENTIALS.valid:
+        return
+    with _REFRESH_LOCK:
+        if not CREDENTIALS.valid:
+            log.debug("Refreshing credentials...")
+            CREDENTIALS.refresh(Request())
+
+
+def _uses_service(function):
+    # hold a pooled service for the duration of the call
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with POOL.checkout():
+            _refresh_credentials()
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def _api() -> Resource:
+    # the service checked out by the calling thread
+    service = POOL.current()
+    if service is None:
+        raise RuntimeError("no Drive service checked out by this thread.")
+    return service
+
+
+def _batch(requests: Dict[str, object]) -> Dict[str, tuple]:
+    # run many API calls in as few batch HTTP requests as possible
+    results = dict()
+
+    def on_response(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    pending, attempt = dict(requests), 0
+    while pending:
+        keys = list(pending)
+        for start in range(0, len(keys), BATCH_LIMIT):
+            batch = _api().new_batch_http_request(callback=on_response)
+            for key in keys[start : start + BATCH_LIMIT]:
+                batch.add(pending[key], request_id=key)
+            batch.execute()
+
+        # calls of the batch that failed transiently go out again in the next one
+        retries, delay = dict(), 0.0
+        for key in keys:
+            _, exception = results[key]
+            if not isinstance(exception, HttpError):
+                continue
+            call = pending[key]
+            call_delay = SCHEDULER.retry_delay(
+                describe_call(call.method, call.uri),
+                call.method,
+                attempt,
+                exception.status_code,
+                exception.content,
+                exception.resp.get("retry-after"),
+            )
+            if call_delay is not None:
+                retries[key] = call
+                delay = max(delay, call_delay)
+        if retries:
+            time.sleep(delay)
+        pending, attempt = retries, attempt + 1
+    return results
+
+
 def convert_to_RFC_datetime(year=1900, month=1, day=1, hour=0, minute=0):
     dt = datetime.datetime(year, month, day, hour, minute, 0).isoformat() + "Z"
     return dt
 
 
-def exists(filename: str):
-    try:
+def _remember(filename: str, response: dict):
+    # store the metadata returned by any list/create/update call
+    metadata = {
+        "id": response.get("id"),
+        "md5Checksum": response.get("md5Checksum"),
+        "modifiedTime": response.get("modifiedTime"),
+        "version": response.get("version"),
+        "size": response.get("size"),
+    }
+    CACHE.set(filename, metadata)
+    if NAMES is not None:
+        NAMES.add(filename)
+    return metadata
+
+
+def _forget(filename: str):
+    # the name is known not to exist on the drive (anymore)
+    CACHE.set(filename, _ABSENT)
+    if NAMES is not None:
+        NAMES.discard(filename)
+
+
+def _generate_ids() -> List[str]:
+    with BACKGROUND.checkout() as service:
+        _refresh_credentials()
+        response = service.files().generateIds(count=ID_BATCH, space="drive")
+        return response.execute()["ids"]
+
+
+@_uses_service
+def _list_names() -> List[str]:
+    # every file name on the drive, a page holds up to 1000 of them
+    names, page_token = [], None
+    while True:
         response = (
-            API.files()
+            _api()
+            .files()
             .list(
-                q=f"name='{filename}' and trashed=false",
+                q="trashed=false",
                 spaces="drive",
-                fields="nextPageToken, files(id)",
+                pageSize=1000,
+                fields="nextPageToken, files(name)",
+                pageToken=page_token,
             )
             .execute()
         )
-        if len(response["files"]) > 0:
-            if DEBUG:
-                print(f"[DRIVE] File <{filename}> already exists.")
-            return True
+        names.extend(file["name"] for file in response["files"])
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            log.debug("Name index loaded, %s file(s).", len(names))
+            return names
+
+
+@_uses_service
+def lookup(filename: str, fresh: bool = False):
+    # resolve a filename to its metadata, going to the API only on a cache miss;
+    # `fresh=True` always lists the name, refreshing the cache
+    cached = None if fresh else CACHE.get(filename, None)
+    if cached is not None:
+        log.debug("Metadata for <%s> served from cache.", filename)
+        return None if cached is _ABSENT else cached
+
+    response = (
+        _api()
+        .files()
+        .list(
+            q=f"name='{filename}' and trashed=false",
+            spaces="drive",
+            fields=f"nextPageToken, files({METADATA_FIELDS})",
+        )
+        .execute()
+    )
+    if len(response["files"]) > 0:
+        return _remember(filename, response["files"][0])
+
+    _forget(filename)
+    return None
+
+
+@_uses_service
+def lookup_many(filenames: List[str], fresh: bool = False) -> dict:
+    # resolve many filenames at once, cache misses are listed in batched requests;
+    # `fresh=True` lists every name, refreshing the cache
+    results = dict()
+    misses = dict()
+    for filename in filenames:
+        cached = None if fresh else CACHE.get(filename, None)
+        if cached is None:
+            misses[str(len(misses))] = filename
         else:
-            if DEBUG:
-                print(f"[DRIVE] File <{filename}> doesn't exists.")
-            return False
-    except HttpError as err:
-        print(
-            "[DRIVE] <exists()> error. Status code: {0}, Reason: {1}".format(
-                err.status_code, err.error_details
+            results[filename] = None if cached is _ABSENT else cached
+
+    responses = _batch(
+        {
+            key: _api()
+            .files()
+            .list(
+                q=f"name='{filename}' and trashed=false",
+                spaces="drive",
+                fields=f"nextPageToken, files({METADATA_FIELDS})",
             )
-        )
+            for key, filename in misses.items()
+        }
+    )
+    for key, filename in misses.items():
+        response, exception = responses[key]
+        if exception is not None:
+            raise exception
+        if len(response["files"]) > 0:
+            results[filename] = _remember(filename, response["files"][0])
+        else:
+            _forget(filename)
+            results[filename] = None
+    return results
 
 
-def get_id(filename: str):
-    try:
+@_uses_service
+def find_by_property(key: str, value: str) -> List[str]:
+    # names of every file tagged with the given appProperty value
+    names, page_token = [], None
+    while True:
         response = (
-            API.files()
+            _api()
+            .files()
             .list(
-                q=f"name='{filename}' and trashed=false",
+                q=f"appProperties has {{ key='{key}' and value='{value}' }} "
+                "and trashed=false",
                 spaces="drive",
-                fields="nextPageToken, files(id)",
+                fields=f"nextPageToken, files(name, {METADATA_FIELDS})",
+                pageToken=page_token,
             )
             .execute()
         )
-        if DEBUG:
-            print(f"[DRIVE] ID for <{filename}> retrieved.")
-        return response["files"][0]["id"]
+        for file in response["files"]:
+            _remember(file["name"], file)
+            names.append(file["name"])
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return names
+
+
+def invalidate(filename: str):
+    CACHE.pop(filename)
+
+
+def cache_stats() -> dict:
+    stats = CACHE.stats()
+    if BLOBS is not None:
+        stats["blobs"] = BLOBS.stats()
+    return stats
+
+
+def _current_revision(filename: str, metadata: dict) -> dict:
+    # one small metadata call tells whether the cached ciphertext is still current
+    response = (
+        _api().files().get(fileId=metadata["id"], fields=METADATA_FIELDS).execute()
+    )
+    return _remember(filename, response)
+
+
+@_uses_service
+def exists(filename: str, fresh: bool = False):
+    # `fresh=True` confirms a name that is not known to be taken with a list query
+    try:
+        cached = None if fresh else CACHE.get(filename, None)
+        if cached is not None:
+            found = cached is not _ABSENT
+        else:
+            # the name index answers "taken" without a list query; a name it lacks
+            # may have been created by another client since its last listing
+            found = NAMES is not None and bool(NAMES.get(filename))
+            if not found:
+                found = lookup(filename, fresh) is not None
+        if found:
+            log.debug("File <%s> already exists.", filename)
+            return True
+        else:
+            log.debug("File <%s> doesn't exists.", filename)
+            return False
     except HttpError as err:
-        print(
-            "[DRIVE] <get_id()> error. Status code: {0}, Reason: {1}".format(
-                err.status_code, err.error_details
-            )
+        log.error(
+            "<exists()> error. Status code: %s, Reason: %s",
+            err.status_code,
+            err.error_details,
+        )
+        raise
+
+
+@_uses_service
+def get_id(filename: str):
+    try:
+        metadata = lookup(filename)
+        log.debug("ID for <%s> retrieved.", filename)
+        return metadata["id"] if metadata else None
+    except HttpError as err:
+        log.error(
+            "<get_id()> error. Status code: %s, Reason: %s",
+            err.status_code,
+            err.error_details,
         )
+        raise
 
 
-def write(file_name: str, file_content: bytes):
+@_uses_service
+def create(file_name: str, file_content: bytes, properties: dict = None) -> str:
+    # a new file in a single files.create call under an id from the pool; a name
+    # the index does not list is confirmed absent first, another client may have
+    # created it since
+    if exists(file_name, fresh=True):
+        raise FileExistsError(f"the file `{file_name}` already exists.")
     file_metadata = {"name": file_name}
-    file_io_buffer = io.BytesIO(file_content)
-    media = MediaIoBaseUpload(file_io_buffer, mimetype="text/plain")
+    file_id = IDS.take()
+    if file_id is not None:
+        # without a reserved id Drive picks one
+        file_metadata["id"] = file_id
+    if properties:
+        file_metadata["appProperties"] = {
+            k: v for k, v in properties.items() if v is not None
+        }
+    media = MediaIoBaseUpload(BufferReader(file_content), mimetype="text/plain")
+    request = (
+        _api()
+        .files()
+        .create(body=file_metadata, media_body=media, fields=METADATA_FIELDS)
+    )
     try:
-        if not exists(file_name):
-            # Create new file
-            response = (
-                API.files()
+        response = _execute_create(request, file_id)
+        _remember(file_name, response)
+        log.debug("File <%s> created.", file_name)
+        return response["id"]
+    except HttpError as e:
+        invalidate(file_name)
+        log.error(
+            "<create()> error. Status code: %s, Reason: %s",
+            e.status_code,
+            e.error_details,
+        )
+        raise
+
+
+def _execute_create(request, file_id: Optional[str]) -> dict:
+    # unlike other creates one under a reserved id is safe to send again, that id
+    # can not be given to a second file
+    if file_id is None:
+        return request.execute()
+    request.headers[REPEATABLE_HEADER] = "1"
+    try:
+        return request.execute()
+    except HttpError as e:
+        if e.status_code != 409:
+            raise
+        # the id is ours alone, an earlier try went through after all
+        return _api().files().get(fileId=file_id, fields=METADATA_FIELDS).execute()
+
+
+def write(
+    file_name: str,
+    file_content: bytes,
+    properties: dict = None,
+    expected_version: str = None,
+):
+    # uploaded from the buffer itself, in resumable chunks once it is larger than one
+    media = MediaIoBaseUpload(
+        BufferReader(file_content),
+        mimetype="text/plain",
+        chunksize=CHUNK_SIZE,
+        resumable=len(file_content) > CHUNK_SIZE,
+    )
+    return _upload(file_name, media, properties, expected_version)
+
+
+def write_stream(
+    file_name: str,
+    chunks: Iterable[bytes],
+    properties: dict = None,
+    chunksize: int = CHUNK_SIZE,
+    expected_version: str = None,
+):
+    chunks = iter(chunks)
+    head = bytearray()
+    for chunk in chunks:
+        head += chunk
+        if len(head) > chunksize:
+            break
+    else:
+        # everything fits in a single request, skip the resumable session setup
+        return write(file_name, bytes(head), properties, expected_version)
+
+    media = IterableUpload(_prepend(bytes(head), chunks), chunksize)
+    del head
+    return _upload(file_name, media, properties, expected_version)
+
+
+def write_file(
+    file_name: str,
+    file: io.IOBase,
+    properties: dict = None,
+    expected_version: str = None,
+):
+    # upload a seekable file object, in resumable chunks once it is larger than one
+    size = file.seek(0, io.SEEK_END)
+    file.seek(0)
+    media = MediaIoBaseUpload(
+        file,
+        mimetype="application/octet-stream",
+        chunksize=CHUNK_SIZE,
+        resumable=size > CHUNK_SIZE,
+    )
+    return _upload(file_name, media, properties, expected_version)
+
+
+def _prepend(first: bytes, rest: Iterator[bytes]) -> Iterator[bytes]:
+    yield first
+    yield from rest
+
+
+@_uses_service
+def _upload(
+    file_name: str,
+    media: MediaUpload,
+    properties: dict = None,
+    expected_version: str = None,
+):
+    file_metadata = {"name": file_name}
+    if properties:
+        file_metadata["appProperties"] = properties
+    try:
+        # a file that must be new is confirmed absent, not taken from the cache
+        metadata = lookup(file_name, fresh=expected_version == NEW_FILE)
+        if expected_version is not None:
+            _check_version(file_name, metadata, expected_version)
+        if metadata is None:
+            if properties:
+                # removing properties (None values) only makes sense on updates
+                file_metadata["appProperties"] = {
+                    k: v for k, v in properties.items() if v is not None
+                }
+            # Create new file under an id reserved ahead of time, if one is left
+            file_id = IDS.take()
+            if file_id is not None:
+                file_metadata["id"] = file_id
+            request = (
+                _api()
+                .files()
                 .create(
                     body=file_metadata,
                     media_body=media,
+                    fields=METADATA_FIELDS,
                 )
-                .execute()
             )
-            if DEBUG:
-                print(f"[DRIVE] File <{file_name}> created.")
+            response = _execute_create(request, file_id)
+            log.debug("File <%s> created.", file_name)
         else:
             # Update existing file
             response = (
-                API.files()
+                _api()
+                .files()
                 .update(
-                    fileId=get_id(file_name),
+                    fileId=metadata["id"],
                     body=file_metadata,
                     media_body=media,
+                    fields=METADATA_FIELDS,
                 )
                 .execute()
             )
-            if DEBUG:
-                print(f"[DRIVE] File <{file_name}> updated.")
+            log.debug("File <%s> updated.", file_name)
+        _remember(file_name, response)
         return response["id"]
     except HttpError as e:
-        print(
-            "[DRIVE] <write()> error. Status code: {0}, Reason: {1}".format(
-                e.status_code, e.error_details
-            )
+        # a failed write may mean the cached id is stale
+        invalidate(file_name)
+        log.error(
+            "<write()> error. Status code: %s, Reason: %s",
+            e.status_code,
+            e.error_details,
         )
+        raise
 
 
-def read(filename: str):
+def _check_version(filename: str, metadata: dict, expected_version: str):
+    # Drive v3 has no conditional update, the version is compared right before it
+    if expected_version == NEW_FILE:
+        if metadata is not None:
+            raise ConflictError(f"the file `{filename}` was created meanwhile.")
+        return
+    if metadata is None:
+        raise ConflictError(f"the file `{filename}` was deleted meanwhile.")
+    current = _current_revision(filename, metadata)
+    if current["version"] != expected_version:
+        raise ConflictError(f"the file `{filename}` was changed meanwhile.")
+
+
+def get_properties(filename: str) -> dict:
+    # fetch only the appProperties of a file, never its content
+    return get_versioned_properties(filename)[0]
+
+
+@_uses_service
+def get_versioned_properties(filename: str) -> tuple:
+    # appProperties and the version they belong to, see `write(expected_version=)`
     try:
-        if exists(filename):
-            response = (
-                API.files()
-                .get_media(
-                    fileId=get_id(filename),
+        metadata = lookup(filename)
+        if metadata is None:
+            raise FileNotFoundError
+        response = (
+            _api()
+            .files()
+            .get(fileId=metadata["id"], fields=f"appProperties, {METADATA_FIELDS}")
+            .execute()
+        )
+        _remember(filename, response)
+        log.debug("Properties for <%s> retrieved.", filename)
+        return response.get("appProperties", {}), response.get("version")
+    except HttpError as err:
+        if err.status_code == 404:
+            invalidate(filename)
+            raise FileNotFoundError
+        log.error(
+            "<get_properties()> error. Status code: %s, Reason: %s",
+            err.status_code,
+            err.error_details,
+        )
+        raise
+
+
+def get_properties_many(filenames: List[str]) -> dict:
+    # appProperties of many files in one batch, None for files that do not exist
+    return {
+        filename: versioned and versioned[0]
+        for filename, versioned in get_versioned_properties_many(filenames).items()
+    }
+
+
+@_uses_service
+def get_versioned_properties_many(filenames: List[str]) -> dict:
+    # (appProperties, version) of many files in one batch, None for missing files
+    try:
+        found = {
+            filename: metadata
+            for filename, metadata in lookup_many(filenames).items()
+            if metadata is not None
+        }
+        names = dict(enumerate(found))
+        responses = _batch(
+            {
+                str(key): _api()
+                .files()
+                .get(
+                    fileId=found[filename]["id"],
+                    fields=f"appProperties, {METADATA_FIELDS}",
                 )
-                .execute()
+                for key, filename in names.items()
+            }
+        )
+        results = {filename: None for filename in filenames}
+        for key, filename in names.items():
+            response, exception = responses[str(key)]
+            if exception is not None:
+                if exception.status_code != 404:
+                    raise exception
+                invalidate(filename)
+                continue
+            _remember(filename, response)
+            results[filename] = (
+                response.get("appProperties", {}),
+                response.get("version"),
             )
-            if DEBUG:
-                print(f"[DRIVE] CONTENT for <{filename}> retrieved.")
-            return response
-        else:
-            raise FileNotFoundError
+        log.debug("Properties for %s file(s) retrieved.", len(found))
+        return results
     except HttpError as err:
-        print(
-            "[DRIVE] <read()> error. Status code: {0}, Reason: {1}".format(
-                err.status_code, err.error_details
+        log.error(
+            "<get_properties_many()> error. Status code: %s, Reason: %s",
+            err.status_code,
+            err.error_details,
+        )
+        raise
+
+
+@_uses_service
+def set_properties(filename: str, properties: dict):
+    # update appProperties in place, a value of None removes that property
+    try:
+        metadata = lookup(filename)
+        if metadata is None:
+            raise FileNotFoundError
+        response = (
+            _api()
+            .files()
+            .update(
+                fileId=metadata["id"],
+                body={"appProperties": properties},
+                fields=METADATA_FIELDS,
             )
+            .execute()
+        )
+        _remember(filename, response)
+        log.debug("Properties for <%s> updated.", filename)
+        return response["id"]
+    except HttpError as err:
+        invalidate(filename)
+        log.error(
+            "<set_properties()> error. Status code: %s, Reason: %s",
+            err.status_code,
+            err.error_details,
+        )
+        raise
+
+
+@_uses_service
+def read(filename: str):
+    try:
+        metadata = lookup(filename)
+        if metadata is None:
+            raise FileNotFoundError
+        try:
+            response = _read_content(filename, metadata)
+        except HttpError as err:
+            if err.status_code != 404:
+                raise
+            # the cached id went stale, resolve the name again once
+            invalidate(filename)
+            metadata = lookup(filename)
+            if metadata is None:
+                raise FileNotFoundError
+            response = _read_content(filename, metadata)
+        log.debug("CONTENT for <%s> retrieved.", filename)
+        return response
+    except HttpError as err:
+        log.error(
+            "<read()> error. Status code: %s, Reason: %s",
+            err.status_code,
+            err.error_details,
         )
+        raise
+
+
+def _read_content(filename: str, metadata: dict) -> bytes:
+    if BLOBS is None:
+        return _api().files().get_media(fileId=metadata["id"]).execute()
+    metadata = _current_revision(filename, metadata)
+    blob = BLOBS.get(metadata["id"], metadata["md5Checksum"])
+    if blob is not None:
+        with blob:
+            return blob[:]
+    response = _api().files().get_media(fileId=metadata["id"]).execute()
+    BLOBS.put(metadata["id"], metadata["md5Checksum"], response)
+    return response
+
 
+@_uses_service
+def size(filename: str) -> int:
+    # bytes stored, as of the last metadata call for the file
+    metadata = lookup(filename)
+    if metadata is None:
+        raise FileNotFoundError
+    return int(metadata["size"] or 0)
 
+
+@_uses_service
+def _get_media(file_id: str, start: int, end: int) -> bytes:
+    # bytes `start` to `end` (inclusive) of a file's content, in one Range request
+    request = _api().files().get_media(fileId=file_id)
+    request.headers["Range"] = f"bytes={start}-{end}"
+    return request.execute()
+
+
+def read_range(filename: str, start: int, end: int) -> bytes:
+    # bytes `start` to `end` (inclusive) of the stored content, in one Range request
+    try:
+        metadata = lookup(filename)
+        if metadata is None:
+            raise FileNotFoundError
+        response = _get_media(metadata["id"], start, end)
+        log.debug("Bytes %s-%s of <%s> retrieved.", start, end, filename)
+        return response
+    except HttpError as err:
+        if err.status_code == 404:
+            invalidate(filename)
+            raise FileNotFoundError
+        log.error(
+            "<read_range()> error. Status code: %s, Reason: %s",
+            err.status_code,
+            err.error_details,
+        )
+        raise
+
+
+def read_stream(filename: str, chunksize: int = CHUNK_SIZE) -> Iterator[bytes]:
+    try:
+        yield from _read_chunks(filename, chunksize)
+        log.debug("CONTENT for <%s> streamed.", filename)
+    except HttpError as err:
+        if err.status_code == 404:
+            invalidate(filename)
+        log.error(
+            "<read_stream()> error. Status code: %s, Reason: %s",
+            err.status_code,
+            err.error_details,
+        )
+        # a partial stream must never look like a complete file
+        raise
+
+
+def _read_chunks(filename: str, chunksize: int) -> Iterator[bytes]:
+    # a pooled service is only held while a chunk is fetched, never while the caller
+    # consumes it, so slow clients cannot tie up the pool
+    with POOL.checkout():
+        metadata = lookup(filename)
+        if metadata is None:
+            raise FileNotFoundError
+        if BLOBS is not None:
+            metadata = _current_revision(filename, metadata)
+    writer = None
+    if BLOBS is not None:
+        blob = BLOBS.get(metadata["id"], metadata["md5Checksum"])
+        if blob is not None:
+            with blob:
+                for start in range(0, len(blob), chunksize):
+                    yield blob[start : start + chunksize]
+            return
+        # keep a copy of the ciphertext on disk while it is downloaded
+        writer = BLOBS.writer()
+
+    # chunks are handed out as soon as they arrive instead of being accumulated,
+    # each one fetched with its own Range request
+    try:
+        start, done = 0, False
+        while not done:
+            try:
+                chunk = _get_media(metadata["id"], start, start + chunksize - 1)
+            except HttpError as err:
+                # content ending on a chunk boundary (or empty) has nothing past it
+                if err.status_code != 416:
+                    raise
+                chunk = bytes()
+            start += len(chunk)
+            done = len(chunk) < chunksize
+            if writer:
+                writer.write(chunk)
+            if chunk or start == 0:
+                yield chunk
+        if writer:
+            writer.commit(metadata["id"], metadata["md5Checksum"])
+    finally:
+        if writer:
+            writer.abort()
+
+
+@_uses_service
 def delete(filename: str):
     try:
-        if exists(filename):
-            response = (
-                API.files()
-                .delete(
-                    fileId=get_id(filename),
-                )
-                .execute()
-            )
-            if DEBUG:
-                print(f"[DRIVE] File <{filename}> deleted.")
-            return response
-        else:
+        metadata = lookup(filename)
+        if metadata is None:
             raise FileNotFoundError
+        try:
+            response = _api().files().delete(fileId=metadata["id"]).execute()
+        except HttpError as err:
+            if err.status_code != 404:
+                raise
+            # already gone on the drive side
+            _forget(filename)
+            raise FileNotFoundError
+        _forget(filename)
+        if BLOBS is not None:
+            BLOBS.pop(metadata["id"])
+        log.debug("File <%s> deleted.", filename)
+        return response
     except HttpError as err:
-        print(
-            "[DRIVE] <delete()> error. Status code: {0}, Reason: {1}".format(
-                err.status_code, err.error_details
-            )
+        log.error(
+            "<delete()> error. Status code: %s, Reason: %s",
+            err.status_code,
+            err.error_details,
         )
+        raise
+
+
+@_uses_service
+def delete_many(filenames: List[str]) -> dict:
+    # delete many files in batched requests, returns whether each file was deleted
+    try:
+        found = {
+            filename: metadata
+            for filename, metadata in lookup_many(filenames).items()
+            if metadata is not None
+        }
+        names = dict(enumerate(found))
+        responses = _batch(
+            {
+                str(key): _api().files().delete(fileId=found[filename]["id"])
+                for key, filename in names.items()
+            }
+        )
+        results = {filename: False for filename in filenames}
+        for key, filename in names.items():
+            _, exception = responses[str(key)]
+            if BLOBS is not None:
+                BLOBS.pop(found[filename]["id"])
+            if exception is not None and exception.status_code != 404:
+                invalidate(filename)
+                raise exception
+            _forget(filename)
+            results[filename] = exception is None
+        log.debug("%s file(s) deleted.", sum(results.values()))
+        return results
+    except HttpError as err:
+        log.error(
+            "<delete_many()> error. Status code: %s, Reason: %s",
+            err.status_code,
+            err.error_details,
+        )
+        raise
 
 
 def close():
+    # shut the pool down, closing the connections of every service it created
     try:
-        API.close()
+        POOL.close(lambda service: service.close())
+        if BACKGROUND is not None:
+            BACKGROUND.close(lambda service: service.close())
     except HttpError as err:
-        print(
-            "[DRIVE] <close()> error. Status code: {0}, Reason: {1}".format(
-                err.status_code, err.error_details
-            )
+        log.error(
+            "<close()> error. Status code: %s, Reason: %s",
+            err.status_code,
+            err.error_details,
         )
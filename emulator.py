@@ -0,0 +1,554 @@
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from typing import Optional
+from urllib.parse import parse_qs
+
+from flask import Flask, Response, request
+from werkzeug.serving import make_server
+
+"""
+Offline stand-in for the subset of the Google Drive v3 REST API used by `drive.py` and
+`async_drive.py`: name and appProperties queries, files.get/create/update/delete,
+media downloads (with Range), multipart and resumable uploads, and batch requests.
+
+Latency, bandwidth caps, quota errors and server errors can be injected so the whole
+stack can be benchmarked without network access. Run it with `python emulator.py`
+and point the backend at it with `drive.init(api_endpoint="http://127.0.0.1:8099")`.
+"""
+
+# Set DEBUG to 'True' to see debug output
+DEBUG = False
+
+log = logging.getLogger("emulator")
+
+DEFAULT_PORT = 8099
+
+# Fields returned when a request does not ask for any
+DEFAULT_FIELDS = "kind, id, name, mimeType"
+
+PAGE_SIZE = 100
+
+# Bytes sent between two bandwidth throttling pauses
+THROTTLE_CHUNK = 64 * 1024
+
+
+class Faults:
+    """
+    Conditions applied to every emulated API call.
+
+    ``latency`` (plus up to ``jitter``) seconds are added to every HTTP request,
+    media transfers are capped at ``bandwidth`` bytes per second, ``error_rate`` and
+    ``quota_rate`` are the odds of a call failing with a 5xx or a 403 rate limit
+    error, and ``requests_per_second`` answers 429 once the call budget is spent.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        bandwidth: Optional[float] = None,
+        error_rate: float = 0.0,
+        quota_rate: float = 0.0,
+        requests_per_second: Optional[float] = None,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.requests_per_second = requests_per_second
+        self._random = random.Random(seed)
+        self._tokens = requests_per_second or 0
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self._lock:
+                extra = self._random.uniform(0, self.jitter)
+            time.sleep(self.latency + extra)
+
+    def throttle(self, size: int):
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    def _rate_limited(self) -> bool:
+        # token bucket refilled at `requests_per_second`, one second of burst
+        now = time.monotonic()
+        self._tokens = min(
+            self.requests_per_second,
+            self._tokens + (now - self._refilled_at) * self.requests_per_second,
+        )
+        self._refilled_at = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    def failure(self) -> Optional[tuple]:
+        # the (status, reason, headers) of an injected failure, None to proceed
+        with self._lock:
+            if self.requests_per_second and self._rate_limited():
+                return 429, "rateLimitExceeded", {"Retry-After": "1"}
+            if self._random.random() < self.quota_rate:
+                return 403, "userRateLimitExceeded", {}
+            if self._random.random() < self.error_rate:
+                return self._random.choice((500, 502, 503)), "backendError", {}
+        return None
+
+
+class DriveError(Exception):
+    def __init__(self, status: int, reason: str, message: str = "", headers=None):
+        super().__init__(message or reason)
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+
+
+class Store:
+    """
+    In-memory files, pending resumable uploads and call statistics.
+    """
+
+    def __init__(self):
+        self.files = dict()
+        self.uploads = dict()
+        self.stats = dict()
+        self.lock = threading.Lock()
+
+    def count(self, call: str, amount: int = 1):
+        with self.lock:
+            self.stats[call] = self.stats.get(call, 0) + amount
+
+    def reset(self):
+        with self.lock:
+            self.files.clear()
+            self.uploads.clear()
+            self.stats.clear()
+
+
+app = Flask(__name__)
+store = Store()
+faults = Faults()
+
+
+def _now() -> str:
+    return datetime.datetime.utcnow().isoformat(timespec="milliseconds") + "Z"
+
+
+def _split_fields(fields: str) -> list:
+    # split "a, files(b, c)" on the commas outside of parentheses
+    parts, depth, current = [], 0, ""
+    for character in fields:
+        if character == "," and depth == 0:
+            parts.append(current.strip())
+            current = ""
+            continue
+        depth += {"(": 1, ")": -1}.get(character, 0)
+        current += character
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def _select(resource: dict, fields: str) -> dict:
+    selected = dict()
+    for field in _split_fields(fields):
+        name, _, nested = field.partition("(")
+        if name not in resource:
+            continue
+        if nested:
+            selected[name] = [_select(item, nested[:-1]) for item in resource[name]]
+        else:
+            selected[name] = resource[name]
+    return selected
+
+
+def _resource(file: dict) -> dict:
+    return {
+        "kind": "drive#file",
+        "id": file["id"],
+        "name": file["name"],
+        "mimeType": file["mimeType"],
+        "md5Checksum": hashlib.md5(file["content"]).hexdigest(),
+        "modifiedTime": file["modifiedTime"],
+        "version": str(file["version"]),
+        "size": str(len(file["content"])),
+        "appProperties": dict(file["appProperties"]),
+    }
+
+
+def _metadata(file: dict, fields: Optional[str]) -> dict:
+    return _select(_resource(file), fields or DEFAULT_FIELDS)
+
+
+def _find(file_id: str) -> dict:
+    file = store.files.get(file_id)
+    if file is None:
+        raise DriveError(404, "notFound", f"File not found: {file_id}.")
+    return file
+
+
+def _apply(file: dict, body: dict):
+    # apply request metadata, a None appProperty value removes that property
+    if "name" in body:
+        file["name"] = body["name"]
+    if "mimeType" in body:
+        file["mimeType"] = body["mimeType"]
+    for key, value in (body.get("appProperties") or {}).items():
+        if value is None:
+            file["appProperties"].pop(key, None)
+        else:
+            file["appProperties"][key] = value
+    file["modifiedTime"] = _now()
+
+
+def _save(file_id: Optional[str], body: dict, content: bytes) -> dict:
+    with store.lock:
+        if file_id is None:
+            file_id = body.get("id") or uuid.uuid4().hex
+            if file_id in store.files:
+                raise DriveError(409, "duplicate", "A file already exists with the id.")
+            file = {
+                "id": file_id,
+                "name": "Untitled",
+                "mimeType": "application/octet-stream",
+                "appProperties": {},
+            }
+        else:
+            file = dict(_find(file_id))
+            file["appProperties"] = dict(file["appProperties"])
+        _apply(file, body)
+        file["version"] = file.get("version", 0) + 1
+        if content is not None:
+            file["content"] = content
+        file.setdefault("content", b"")
+        store.files[file_id] = file
+    return file
+
+
+def _matches(file: dict, query: str) -> bool:
+    for clause in re.findall(
+        r"appProperties has \{ key='(.*?)' and value='(.*?)' \}", query
+    ):
+        if file["appProperties"].get(clause[0]) != clause[1]:
+            return False
+    name = re.search(r"(?<![\w'])name\s*=\s*'(.*?)'", query)
+    if name and file["name"] != name.group(1):
+        return False
+    return True
+
+
+def list_files(params: dict) -> dict:
+    store.count("files.list")
+    query = params.get("q", "")
+    with store.lock:
+        found = [file for file in store.files.values() if _matches(file, query)]
+    start = int(params.get("pageToken") or 0)
+    size = int(params.get("pageSize") or PAGE_SIZE)
+    resource = {
+        "kind": "drive#fileList",
+        "files": [_resource(file) for file in found[start : start + size]],
+    }
+    if start + size < len(found):
+        resource["nextPageToken"] = str(start + size)
+    return _select(resource, params.get("fields") or "kind, files(%s)" % DEFAULT_FIELDS)
+
+
+def _content_range(content: bytes, header: Optional[str]):
+    # the (status, headers, body) of a media download honouring a Range header
+    match = re.match(r"bytes=(\d+)-(\d*)", header or "")
+    if not match or not content:
+        return 200, {}, content
+    first = int(match.group(1))
+    last = min(int(match.group(2) or len(content) - 1), len(content) - 1)
+    if first >= len(content):
+        raise DriveError(416, "requestedRangeNotSatisfiable", "Bad range.")
+    headers = {"Content-Range": f"bytes {first}-{last}/{len(content)}"}
+    return 206, headers, content[first : last + 1]
+
+
+def _multipart(body: bytes, content_type: str) -> tuple:
+    # (metadata, media) of a multipart/related upload body
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+    parts = body.split(b"--" + boundary)[1:-1]
+    sections = []
+    for part in parts:
+        part = part[2:] if part.startswith(b"\r\n") else part[1:]
+        separator = b"\r\n\r\n" if b"\r\n\r\n" in part.split(b"\n\n")[0] else b"\n\n"
+        _, _, payload = part.partition(separator)
+        # only the line break the part is written with precedes the boundary, a
+        # payload may itself end with "\r"
+        newline = separator[: len(separator) // 2]
+        if payload.endswith(newline):
+            payload = payload[: -len(newline)]
+        sections.append(payload)
+    return json.loads(sections[0] or b"{}"), sections[1]
+
+
+def upload(file_id: Optional[str], params: dict, headers, body: bytes):
+    upload_type = params.get("uploadType", "media")
+    if file_id is not None:
+        _find(file_id)
+    if upload_type == "resumable":
+        store.count("upload.session")
+        session = uuid.uuid4().hex
+        with store.lock:
+            store.uploads[session] = {
+                "file_id": file_id,
+                "metadata": json.loads(body or b"{}"),
+                "content": bytearray(),
+                "fields": params.get("fields"),
+            }
+        location = f"{request.host_url}upload/session/{session}"
+        return 200, {"Location": location}, b""
+
+    store.count("upload." + upload_type)
+    faults.throttle(len(body))
+    store.count("bytes.uploaded", len(body))
+    if upload_type == "multipart":
+        metadata, content = _multipart(body, headers.get("Content-Type", ""))
+    else:
+        metadata, content = {}, body
+    file = _save(file_id, metadata, content)
+    return 200, {}, _metadata(file, params.get("fields"))
+
+
+def upload_chunk(session: str, headers, body: bytes):
+    store.count("upload.chunk")
+    pending = store.uploads.get(session)
+    if pending is None:
+        raise DriveError(404, "notFound", "Upload session not found.")
+    faults.throttle(len(body))
+    store.count("bytes.uploaded", len(body))
+
+    match = re.match(
+        r"bytes (\*|(\d+)-(\d+))/(\*|\d+)", headers.get("Content-Range", "")
+    )
+    if match is None:
+        raise DriveError(400, "badContent", "Missing Content-Range.")
+    if match.group(2) is not None:
+        # a resent chunk overwrites whatever followed its offset
+        del pending["content"][int(match.group(2)) :]
+        pending["content"] += body
+    total = match.group(4)
+    received = len(pending["content"])
+    if total == "*" or received < int(total):
+        progress = {"Range": f"bytes=0-{received - 1}"} if received else {}
+        return 308, progress, b""
+
+    with store.lock:
+        store.uploads.pop(session, None)
+    file = _save(pending["file_id"], pending["metadata"], bytes(pending["content"]))
+    return 200, {}, _metadata(file, pending["fields"])
+
+
+def dispatch(method: str, path: str, params: dict, headers, body: bytes):
+    # the (status, headers, body) of one API call, body is a dict for JSON responses
+    failure = faults.failure()
+    if failure is not None:
+        status, reason, failure_headers = failure
+        store.count("faults." + str(status))
+        raise DriveError(status, reason, "Injected failure.", failure_headers)
+
+    path = "/" + path.strip("/")
+    if path == "/drive/v3/files":
+        if method == "GET":
+            return 200, {}, list_files(params)
+        if method == "POST":
+            store.count("files.create")
+            file = _save(None, json.loads(body or b"{}"), b"")
+            return 200, {}, _metadata(file, params.get("fields"))
+
+    if path == "/drive/v3/files/generateIds" and method == "GET":
+        store.count("files.generateIds")
+        count = int(params.get("count") or 10)
+        ids = [uuid.uuid4().hex for _ in range(count)]
+        return 200, {}, {"kind": "drive#generatedIds", "space": "drive", "ids": ids}
+
+    match = re.fullmatch(r"/drive/v3/files/([^/]+)", path)
+    if match:
+        file_id = match.group(1)
+        if method == "GET" and params.get("alt") == "media":
+            store.count("files.get_media")
+            content = _find(file_id)["content"]
+            status, range_headers, content = _content_range(
+                content, headers.get("Range")
+            )
+            store.count("bytes.downloaded", len(content))
+            return status, range_headers, content
+        if method == "GET":
+            store.count("files.get")
+            return 200, {}, _metadata(_find(file_id), params.get("fields"))
+        if method == "PATCH":
+            store.count("files.update")
+            file = _save(file_id, json.loads(body or b"{}"), None)
+            return 200, {}, _metadata(file, params.get("fields"))
+        if method == "DELETE":
+            store.count("files.delete")
+            with store.lock:
+                _find(file_id)
+                store.files.pop(file_id)
+            return 204, {}, b""
+
+    match = re.fullmatch(r"/upload/drive/v3/files(?:/([^/]+))?", path)
+    if match and method in ("POST", "PATCH"):
+        return upload(match.group(1), params, headers, body)
+
+    match = re.fullmatch(r"/upload/session/([^/]+)", path)
+    if match and method == "PUT":
+        return upload_chunk(match.group(1), headers, body)
+
+    raise DriveError(404, "notFound", f"No emulated method for {method} {path}.")
+
+
+def _error_body(error: DriveError) -> dict:
+    domain = "usageLimits" if error.status in (403, 429) else "global"
+    return {
+        "error": {
+            "code": error.status,
+            "message": str(error),
+            "errors": [
+                {"domain": domain, "reason": error.reason, "message": str(error)}
+            ],
+        }
+    }
+
+
+def call(method: str, path: str, params: dict, headers, body: bytes):
+    try:
+        status, response_headers, response_body = dispatch(
+            method, path, params, headers, body
+        )
+    except DriveError as error:
+        status, response_headers, response_body = (
+            error.status,
+            error.headers,
+            _error_body(error),
+        )
+    if isinstance(response_body, dict):
+        response_headers = dict(
+            response_headers, **{"Content-Type": "application/json"}
+        )
+        response_body = json.dumps(response_body).encode("UTF-8")
+    return status, response_headers, response_body
+
+
+def batch(body: bytes, content_type: str) -> Response:
+    store.count("batch")
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1)
+    text = body.decode("UTF-8")
+    responses = []
+    for part in text.split("--" + boundary)[1:-1]:
+        part_headers, _, inner = (
+            part.strip("\r\n").replace("\r\n", "\n").partition("\n\n")
+        )
+        content_id = re.search(r"Content-ID: <(.*)>", part_headers).group(1)
+        request_line, _, rest = inner.partition("\n")
+        inner_headers, _, inner_body = rest.partition("\n\n")
+        method, target, _ = request_line.split(" ", 2)
+        path, _, query = target.partition("?")
+        params = {key: values[0] for key, values in parse_qs(query).items()}
+        status, response_headers, response_body = call(
+            method, path, params, {}, inner_body.encode("UTF-8")
+        )
+        # the client expects headers in every part, even for an empty body
+        response_headers["Content-Length"] = str(len(response_body))
+        header_lines = "".join(f"{k}: {v}\r\n" for k, v in response_headers.items())
+        responses.append(
+            f"--{boundary}\r\nContent-Type: application/http\r\n"
+            f"Content-ID: <response-{content_id}>\r\n\r\n"
+            f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\n"
+            f"{header_lines}\r\n{response_body.decode('UTF-8')}\r\n"
+        )
+    payload = "".join(responses) + f"--{boundary}--\r\n"
+    return Response(payload, 200, content_type=f"multipart/mixed; boundary={boundary}")
+
+
+def _throttled(content: bytes):
+    for start in range(0, len(content), THROTTLE_CHUNK):
+        piece = content[start : start + THROTTLE_CHUNK]
+        faults.throttle(len(piece))
+        yield piece
+
+
+@app.get("/emulator/stats")
+def get_stats():
+    with store.lock:
+        return {"files": len(store.files), "calls": dict(store.stats)}, 200
+
+
+@app.post("/emulator/reset")
+def reset():
+    store.reset()
+    return "", 204
+
+
+@app.route("/<path:path>", methods=["GET", "POST", "PATCH", "PUT", "DELETE"])
+def api(path: str):
+    faults.delay()
+    body = request.get_data()
+    if path.strip("/") == "batch/drive/v3":
+        return batch(body, request.headers.get("Content-Type", ""))
+
+    params = request.args.to_dict()
+    status, headers, content = call(request.method, path, params, request.headers, body)
+    log.debug("%s /%s -> %s", request.method, path, status)
+    if params.get("alt") == "media" and faults.bandwidth:
+        return Response(_throttled(content), status, headers)
+    return Response(content, status, headers)
+
+
+def start(host: str = "127.0.0.1", port: int = 0, **fault_settings) -> tuple:
+    """
+    Serve the emulator from a background thread, returns ``(server, endpoint)``.
+
+    Call ``server.shutdown()`` to stop it.
+    """
+    global faults
+    faults = Faults(**fault_settings)
+    if not DEBUG:
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline Google Drive v3 emulator.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random delay")
+    parser.add_argument("--bandwidth", type=float, help="media bytes per second")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="odds of a 5xx")
+    parser.add_argument("--quota-rate", type=float, default=0.0, help="odds of a 403")
+    parser.add_argument("--requests-per-second", type=float, help="429 past this rate")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    DEBUG = args.debug
+    logging.basicConfig(
+        level=logging.DEBUG if DEBUG else logging.INFO,
+        format="[%(name)s] %(levelname)s %(message)s",
+    )
+    faults = Faults(
+        latency=args.latency,
+        jitter=args.jitter,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        quota_rate=args.quota_rate,
+        requests_per_second=args.requests_per_second,
+        seed=args.seed,
+    )
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,325 @@
+import argparse
+import json
+import random
+import string
+import sys
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import requests
+
+from definitions import *
+
+"""
+Concurrent load generator for the backend.
+
+Virtual users run a weighted mix of endpoint calls against a running server, each on
+its own set of files, and the run reports throughput, latency percentiles and error
+rates per endpoint:
+    python loadtest.py --users 50 --duration 60 --ramp-up 10 \\
+        --mix read=60,update=25,create=5,delete=5,change-password=3,shared-secrets=2 \\
+        --sizes 1KB=70,64KB=25,1MB=5
+Point the server at `emulator.py` to load test without touching Google Drive.
+"""
+
+SERVER_URL = "http://127.0.0.1:5000/"
+
+HEADERS = {"Content-Type": "application/json"}
+
+# Relative weight of every operation in the default mix
+MIX = {
+    Endpoint.Read: 60,
+    Endpoint.Update: 25,
+    Endpoint.Create: 5,
+    Endpoint.Delete: 5,
+    Endpoint.ChangePassword: 3,
+    Endpoint.SharedSecrets: 2,
+}
+# Relative weight of every content size written by updates
+SIZES = {1024: 70, 64 * 1024: 25, 1024 * 1024: 5}
+
+# Files a virtual user keeps around, creates stop past this many
+FILES_PER_USER = 4
+
+# Status code a successful call of every endpoint answers with
+EXPECTED_STATUS = {
+    Endpoint.Create: 201,
+    Endpoint.Read: 200,
+    Endpoint.Update: 200,
+    Endpoint.Delete: 204,
+    Endpoint.ChangePassword: 200,
+    Endpoint.SharedSecrets: 200,
+}
+
+
+class Recorder:
+    """
+    Latencies and outcomes of every call, grouped by endpoint.
+    """
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = dict()
+        self.errors: Dict[str, Dict[str, int]] = dict()
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, latency: float, error: Optional[str] = None):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            if error is not None:
+                errors = self.errors.setdefault(endpoint, dict())
+                errors[error] = errors.get(error, 0) + 1
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = dict()
+        with self._lock:
+            for endpoint, latencies in sorted(self.latencies.items()):
+                failed = sum(self.errors.get(endpoint, {}).values())
+                endpoints[endpoint] = {
+                    "requests": len(latencies),
+                    "throughput": len(latencies) / elapsed,
+                    "error_rate": failed / len(latencies),
+                    "errors": dict(self.errors.get(endpoint, {})),
+                    "latency_ms": {
+                        name: percentile(latencies, fraction) * 1000
+                        for name, fraction in (
+                            ("p50", 0.5),
+                            ("p95", 0.95),
+                            ("p99", 0.99),
+                            ("max", 1.0),
+                        )
+                    },
+                }
+        total = sum(endpoint["requests"] for endpoint in endpoints.values())
+        failed = sum(
+            sum(endpoint["errors"].values()) for endpoint in endpoints.values()
+        )
+        return {
+            "elapsed": elapsed,
+            "requests": total,
+            "throughput": total / elapsed if elapsed else 0,
+            "error_rate": failed / total if total else 0,
+            "endpoints": endpoints,
+        }
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    # nearest-rank percentile
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def pick(weights: dict, generator: random.Random):
+    return generator.choices(list(weights), weights=list(weights.values()))[0]
+
+
+class VirtualUser:
+    """
+    Runs the operation mix on files of its own, tracking the password of each file.
+    """
+
+    def __init__(self, number: int, run_id: str, options, recorder: Recorder):
+        self.name = f"loadtest-{run_id}-{number}"
+        self.options = options
+        self.recorder = recorder
+        self.random = random.Random(
+            None if options.seed is None else options.seed + number
+        )
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        # file name -> current password
+        self.files: Dict[str, str] = dict()
+        self.created = 0
+
+    def post(self, endpoint: str, data: dict, record: bool = True):
+        begin = time.perf_counter()
+        error = None
+        try:
+            response = self.session.post(
+                url=self.options.url + endpoint,
+                json=data,
+                timeout=self.options.timeout,
+            )
+            if response.status_code != EXPECTED_STATUS.get(endpoint, 200):
+                error = str(response.status_code)
+        except requests.RequestException as e:
+            response, error = None, type(e).__name__
+        if record:
+            self.recorder.record(endpoint, time.perf_counter() - begin, error)
+        return response if error is None else None
+
+    def content(self) -> str:
+        size = pick(self.options.sizes, self.random)
+        return "".join(self.random.choices(string.ascii_letters, k=size))
+
+    def create(self):
+        file_name = f"{self.name}-{self.created}"
+        self.created += 1
+        password = uuid.uuid4().hex
+        data = {
+            RequestBodyField.Filename: file_name,
+            RequestBodyField.Password: password,
+        }
+        if self.post(Endpoint.Create, data) is not None:
+            self.files[file_name] = password
+
+    def step(self):
+        operation = pick(self.options.mix, self.random)
+        if operation == Endpoint.Create and len(self.files) >= self.options.files:
+            operation = Endpoint.Update
+        if not self.files or operation == Endpoint.Create:
+            return self.create()
+
+        file_name = self.random.choice(sorted(self.files))
+        password = self.files[file_name]
+        data = {
+            RequestBodyField.Filename: file_name,
+            RequestBodyField.Password: password,
+        }
+        if operation == Endpoint.Update:
+            data[RequestBodyField.Content] = self.content()
+        elif operation == Endpoint.ChangePassword:
+            data[RequestBodyField.NewPassword] = uuid.uuid4().hex
+        elif operation == Endpoint.SharedSecrets:
+            data[RequestBodyField.Shares] = 5
+            data[RequestBodyField.Threshold] = 3
+
+        response = self.post(operation, data)
+        if response is None:
+            return
+        if operation == Endpoint.Delete:
+            self.files.pop(file_name)
+        elif operation == Endpoint.ChangePassword:
+            self.files[file_name] = data[RequestBodyField.NewPassword]
+
+    def run(self, start: float, stop: float):
+        time.sleep(max(0.0, start - time.monotonic()))
+        while time.monotonic() < stop:
+            self.step()
+            if self.options.think_time:
+                time.sleep(self.random.expovariate(1 / self.options.think_time))
+
+    def cleanup(self):
+        for file_name, password in self.files.items():
+            data = {
+                RequestBodyField.Filename: file_name,
+                RequestBodyField.Password: password,
+            }
+            self.post(Endpoint.Delete, data, record=False)
+        self.session.close()
+
+
+def parse_weights(text: str, parse_key=str) -> dict:
+    weights = dict()
+    for entry in text.split(","):
+        if entry:
+            key, _, weight = entry.partition("=")
+            weights[parse_key(key.strip())] = float(weight or 1)
+    return weights
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    for unit, scale in (("MB", 1024 * 1024), ("KB", 1024), ("B", 1)):
+        if text.endswith(unit):
+            return int(float(text[: -len(unit)]) * scale)
+    return int(text)
+
+
+def run(options) -> dict:
+    recorder = Recorder()
+    run_id = uuid.uuid4().hex[:8]
+    users = [VirtualUser(i, run_id, options, recorder) for i in range(options.users)]
+
+    # users start evenly spread over the ramp-up period
+    began = time.monotonic()
+    stop = began + options.ramp_up + options.duration
+    threads = []
+    for i, user in enumerate(users):
+        start = began + options.ramp_up * i / max(1, options.users)
+        thread = threading.Thread(target=user.run, args=(start, stop), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    report = recorder.report(time.monotonic() - began)
+    report["users"] = options.users
+
+    for user in users:
+        user.cleanup()
+    return report
+
+
+def print_report(report: dict):
+    print(
+        f"{'endpoint':<18}{'requests':>10}{'req/s':>10}{'errors':>9}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    )
+    for endpoint, result in report["endpoints"].items():
+        latency = result["latency_ms"]
+        print(
+            f"{endpoint:<18}{result['requests']:>10}{result['throughput']:>10.1f}"
+            f"{result['error_rate']:>9.1%}{latency['p50']:>10.1f}"
+            f"{latency['p95']:>10.1f}{latency['p99']:>10.1f}{latency['max']:>10.1f}"
+        )
+        for error, count in result["errors"].items():
+            print(f"{'':<18}{count:>10} x {error}")
+    print(
+        f"{report['requests']} requests in {report['elapsed']:.1f}s from "
+        f"{report['users']} users: {report['throughput']:.1f} req/s, "
+        f"{report['error_rate']:.1%} errors"
+    )
+
+
+def main(arguments: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test the backend.")
+    parser.add_argument("--url", default=SERVER_URL)
+    parser.add_argument("--users", type=int, default=10, help="concurrent users")
+    parser.add_argument(
+        "--duration", type=float, default=30, help="seconds at full load"
+    )
+    parser.add_argument(
+        "--ramp-up", type=float, default=0, help="seconds to start users"
+    )
+    parser.add_argument(
+        "--mix",
+        default=",".join(f"{k}={v}" for k, v in MIX.items()),
+        help="weighted endpoints, e.g. read=80,update=20",
+    )
+    parser.add_argument(
+        "--sizes",
+        default=",".join(f"{k}B={v}" for k, v in SIZES.items()),
+        help="weighted content sizes, e.g. 1KB=90,1MB=10",
+    )
+    parser.add_argument("--files", type=int, default=FILES_PER_USER)
+    parser.add_argument("--think-time", type=float, default=0, help="mean pause, s")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument(
+        "--max-error-rate",
+        type=float,
+        help="exit with status 1 when the overall error rate is higher",
+    )
+    options = parser.parse_args(arguments)
+    options.url = options.url.rstrip("/") + "/"
+    options.mix = parse_weights(options.mix)
+    options.sizes = parse_weights(options.sizes, parse_size)
+    unknown = set(options.mix) - set(EXPECTED_STATUS)
+    if unknown:
+        parser.error(f"unsupported endpoints in the mix: {', '.join(sorted(unknown))}")
+
+    report = run(options)
+    print_report(report)
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if options.max_error_rate is not None:
+        return int(report["error_rate"] > options.max_error_rate)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+import threading
+import zlib
+from contextlib import AsyncExitStack, ExitStack, asynccontextmanager, contextmanager
+from typing import Callable, Iterable, List
+
+"""
+Striped per-name locks.
+
+A fixed number of locks is shared by every file name, a name always maps to the same
+stripe. Operations on one file are serialized while unrelated files (bar the odd
+stripe collision) proceed in parallel, and memory use does not grow with the number
+of files ever seen.
+"""
+
+
+class StripedLocks:
+    """
+    ``stripes`` locks built by ``factory``, e.g. ``asyncio.Lock`` for coroutines.
+
+    Several names are always locked in stripe order, so callers locking overlapping
+    sets of names cannot deadlock each other.
+    """
+
+    def __init__(self, stripes: int = 256, factory: Callable = threading.Lock):
+        self._locks = [factory() for _ in range(stripes)]
+
+    def _index(self, name: str) -> int:
+        return zlib.crc32(name.encode("UTF-8")) % len(self._locks)
+
+    def stripes(self, names: Iterable[str]) -> List:
+        # the locks guarding `names`, each once and in lock order
+        return [self._locks[i] for i in sorted({self._index(n) for n in names})]
+
+    @contextmanager
+    def hold(self, *names: str):
+        with ExitStack() as stack:
+            for lock in self.stripes(names):
+                stack.enter_context(lock)
+            yield
+
+    @asynccontextmanager
+    async def hold_async(self, *names: str):
+        async with AsyncExitStack() as stack:
+            for lock in self.stripes(names):
+                await stack.enter_async_context(lock)
+            yield
@@ -0,0 +1,348 @@
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+"""
+Request tracing and Prometheus metrics.
+
+Every request runs inside a `Trace` that collects the spans of its phases and the
+Drive API calls it made; finishing the trace feeds the counters and histograms that
+`render()` exposes in the Prometheus text format.
+"""
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+# Upper bounds of the Drive-calls-per-request histogram buckets
+CALL_COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21, 34, 55, 100)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """
+    Monotonic total per combination of label values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[tuple, float] = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {value}"
+            for key, value in values
+        ]
+
+
+class Histogram:
+    """
+    Cumulative bucket counts, sum and count of observations per label values.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Iterable[str] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per bucket counts (plus +Inf), sum, count]
+        self._values: Dict[tuple, list] = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(
+                (key, [list(e[0]), e[1], e[2]]) for key, e in self._values.items()
+            )
+        lines = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                bucket = _format_labels(self.labels, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge:
+    """
+    Values read from a callback returning ``{label values: value}`` at render time.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Iterable[str],
+        callback: Callable[[], Dict[tuple, float]],
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        try:
+            values = self.callback()
+        except Exception:
+            return []
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {value}"
+            for key, value in sorted(values.items())
+        ]
+
+
+REGISTRY: list = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+REQUESTS = register(
+    Counter("egd_requests_total", "Requests served.", ("endpoint", "status"))
+)
+REQUEST_SECONDS = register(
+    Histogram("egd_request_seconds", "Request latency.", ("endpoint",))
+)
+SPAN_SECONDS = register(
+    Histogram(
+        "egd_span_seconds",
+        "Time spent in each request phase.",
+        ("endpoint", "span"),
+    )
+)
+DRIVE_CALLS_PER_REQUEST = register(
+    Histogram(
+        "egd_drive_calls_per_request",
+        "Drive API calls made while serving one request.",
+        ("endpoint",),
+        CALL_COUNT_BUCKETS,
+    )
+)
+DRIVE_CALLS = register(
+    Counter("egd_drive_calls_total", "Drive API calls.", ("call", "status"))
+)
+DRIVE_CALL_SECONDS = register(
+    Histogram("egd_drive_call_seconds", "Drive API call latency.", ("call",))
+)
+DRIVE_BYTES = register(
+    Counter(
+        "egd_drive_bytes_total",
+        "Bytes sent to and received from the Drive API.",
+        ("call", "direction"),
+    )
+)
+DRIVE_RETRIES = register(
+    Counter(
+        "egd_drive_retries_total",
+        "Drive API calls sent again after a transient failure.",
+        ("call", "reason"),
+    )
+)
+DRIVE_WAIT_SECONDS = register(
+    Histogram(
+        "egd_drive_wait_seconds",
+        "Time Drive API calls spent queued for the rate limit or backing off.",
+        ("call", "cause"),
+    )
+)
+
+
+class Trace:
+    """
+    Spans and Drive API calls recorded while serving one request.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # span name -> [seconds, occurrences]
+        self.spans: Dict[str, list] = dict()
+        self.drive_calls = 0
+        self.drive_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, seconds: float):
+        with self._lock:
+            entry = self.spans.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def add_drive_call(self, call: str, seconds: float):
+        with self._lock:
+            self.drive_calls += 1
+            self.drive_seconds += seconds
+        self.add_span("drive-" + call, seconds)
+
+    def add_drive_wait(self, seconds: float):
+        # waiting on the scheduler is Drive time too, not time of the phase around it
+        with self._lock:
+            self.drive_seconds += seconds
+        self.add_span("drive-wait", seconds)
+
+    def server_timing(self) -> str:
+        # Server-Timing header value, one metric per span name
+        with self._lock:
+            spans = sorted(self.spans.items())
+        entries = [
+            f'{name};dur={seconds * 1000:.2f};desc="{count}x"'
+            for name, (seconds, count) in spans
+        ]
+        total = (time.perf_counter() - self.started) * 1000
+        entries.append(f"total;dur={total:.2f}")
+        return ", ".join(entries)
+
+
+_TRACE: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def current() -> Optional[Trace]:
+    return _TRACE.get()
+
+
+def start_trace():
+    # returns the token `finish_trace` needs to restore the previous state
+    return _TRACE.set(Trace())
+
+
+def finish_trace(token, endpoint: str, status) -> Optional[Trace]:
+    trace = _TRACE.get()
+    _TRACE.reset(token)
+    if trace is None:
+        return None
+    REQUESTS.inc(endpoint=endpoint, status=status)
+    REQUEST_SECONDS.observe(time.perf_counter() - trace.started, endpoint=endpoint)
+    DRIVE_CALLS_PER_REQUEST.observe(trace.drive_calls, endpoint=endpoint)
+    for name, (seconds, _) in trace.spans.items():
+        if not name.startswith("drive-"):
+            SPAN_SECONDS.observe(seconds, endpoint=endpoint, span=name)
+    return trace
+
+
+@contextmanager
+def span(name: str, exclusive: bool = False):
+    """
+    Time a phase of the current request.
+
+    An ``exclusive`` span leaves out the time spent in Drive API calls it made, so
+    the crypto work of a streamed download is told apart from the download.
+    """
+    trace = _TRACE.get()
+    if trace is None:
+        yield
+        return
+    begin, drive_before = time.perf_counter(), trace.drive_seconds
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - begin
+        if exclusive:
+            seconds = max(0.0, seconds - (trace.drive_seconds - drive_before))
+        trace.add_span(name, seconds)
+
+
+def drive_call(call: str, status, seconds: float, sent: int = 0, received: int = 0):
+    DRIVE_CALLS.inc(call=call, status=status)
+    DRIVE_CALL_SECONDS.observe(seconds, call=call)
+    if sent:
+        DRIVE_BYTES.inc(sent, call=call, direction="sent")
+    if received:
+        DRIVE_BYTES.inc(received, call=call, direction="received")
+    trace = _TRACE.get()
+    if trace is not None:
+        trace.add_drive_call(call, seconds)
+
+
+def drive_retry(call: str, reason: str):
+    DRIVE_RETRIES.inc(call=call, reason=reason)
+
+
+def drive_wait(call: str, cause: str, seconds: float):
+    DRIVE_WAIT_SECONDS.observe(seconds, call=call, cause=cause)
+    trace = _TRACE.get()
+    if trace is not None:
+        trace.add_drive_wait(seconds)
+
+
+def propagate(function: Callable) -> Callable:
+    # run `function` in another thread within the trace of the calling request
+    context = copy_context()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,244 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Dict, List, Optional
+
+import metrics
+
+"""
+Process pool for CPU-heavy crypto jobs. Work that holds the GIL in a request thread
+stalls every other request of the worker, in the pool it runs on other cores.
+
+Each kind of job has a threshold below which it runs inline, since handing it to
+another process would cost more than the work. Large arguments and results travel
+through shared memory instead of being pickled through the pool's pipes.
+"""
+
+# Worker processes started by `init`, on demand
+PROCESSES = min(4, os.cpu_count() or 1)
+
+# Smallest job of each kind that is sent to the pool, None keeps it inline:
+#   "encrypt", "decrypt": payload bytes
+#   "kdf": scrypt cost, 128 * r * n * p
+#   "split": shares times threshold, "combine": shares squared
+# AES-GCM, zlib, lzma and scrypt release the GIL while they run, so by default only
+# the shamir arithmetic (pure Python) is offloaded; sending a 50MB encryption to the
+# pool roughly doubles its latency with the shared memory copies and frees nothing
+THRESHOLDS = {
+    "encrypt": None,
+    "decrypt": None,
+    "kdf": None,
+    "split": 64 * 64,
+    "combine": 64 * 64,
+}
+
+# Bytes-like arguments and results of at least this size go through shared memory
+SHARED_MIN_SIZE = 64 * 1024
+
+log = logging.getLogger("offload")
+
+JOB_SECONDS = metrics.register(
+    metrics.Histogram(
+        "egd_crypto_job_seconds",
+        "Time from starting a crypto job to its result, by job and where it ran.",
+        ("job", "where"),
+    )
+)
+QUEUE_SECONDS = metrics.register(
+    metrics.Histogram(
+        "egd_crypto_queue_seconds",
+        "Time crypto jobs waited for a worker process.",
+        ("job",),
+    )
+)
+metrics.register(
+    metrics.Gauge(
+        "egd_crypto_jobs",
+        "Crypto jobs queued for and running in worker processes, and the pool size.",
+        ("state",),
+        lambda: {(k,): v for k, v in (EXECUTOR.stats() if EXECUTOR else {}).items()},
+    )
+)
+
+# Pool running the jobs above their threshold, None runs every job inline
+EXECUTOR: Optional["CryptoExecutor"] = None
+
+
+class _Shared:
+    """
+    Name and size of a shared memory block standing in for a bytes-like value.
+    """
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+
+
+def _is_large(value) -> bool:
+    return (
+        isinstance(value, (bytes, bytearray, memoryview))
+        and memoryview(value).nbytes >= SHARED_MIN_SIZE
+    )
+
+
+def _share(value) -> SharedMemory:
+    # a new block holding a copy of `value`, the only copy made of it
+    with memoryview(value) as view, view.cast("B") as data:
+        block = SharedMemory(create=True, size=len(data))
+        block.buf[: len(data)] = data
+    return block
+
+
+def _close(block: SharedMemory):
+    try:
+        block.close()
+    except BufferError:
+        # a view of the block outlived the job (kept by a traceback), the mapping
+        # goes away with the process
+        pass
+
+
+def _work(function: Callable, args: list) -> tuple:
+    # runs in a worker process: (result, wall clock time the job started)
+    started = time.time()
+    blocks: List[SharedMemory] = []
+    views: List[memoryview] = []
+    try:
+        for index, arg in enumerate(args):
+            if isinstance(arg, _Shared):
+                blocks.append(SharedMemory(name=arg.name))
+                views.append(blocks[-1].buf[: arg.size])
+                args[index] = views[-1]
+        result = function(*args)
+        if _is_large(result):
+            block = _share(result)
+            result = _Shared(block.name, memoryview(result).nbytes)
+            _close(block)
+        return result, started
+    finally:
+        del args
+        for view in views:
+            view.release()
+        for block in blocks:
+            _close(block)
+
+
+class CryptoExecutor:
+    """
+    Worker processes for crypto jobs, started on demand and never forked from the
+    (threaded) server.
+
+    ``run`` blocks the calling thread until the job is done, like running it inline
+    would, but leaves the GIL to the other requests meanwhile.
+    """
+
+    def __init__(self, processes: int = PROCESSES, thresholds: dict = None):
+        self.processes = processes
+        self.thresholds = dict(THRESHOLDS, **(thresholds or {}))
+        self._context = multiprocessing.get_context("spawn")
+        self._pool = self._start()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def _start(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(self.processes, mp_context=self._context)
+
+    def offloads(self, job: str, amount: float) -> bool:
+        threshold = self.thresholds.get(job)
+        return threshold is not None and amount >= threshold
+
+    def run(self, job: str, function: Callable, *args):
+        submitted = time.time()
+        blocks: List[SharedMemory] = []
+        try:
+            shared_args = []
+            for arg in args:
+                if _is_large(arg):
+                    blocks.append(_share(arg))
+                    arg = _Shared(blocks[-1].name, memoryview(arg).nbytes)
+                shared_args.append(arg)
+            with self._lock:
+                self._in_flight += 1
+            try:
+                future = self._pool.submit(_work, function, shared_args)
+                result, started = future.result()
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+        except BrokenProcessPool:
+            # a worker died (killed, out of memory), later jobs get a fresh pool
+            log.error("Crypto worker process lost, restarting the pool.")
+            self._restart()
+            return function(*args)
+        finally:
+            for block in blocks:
+                _close(block)
+                block.unlink()
+        QUEUE_SECONDS.observe(max(0.0, started - submitted), job=job)
+
+        if isinstance(result, _Shared):
+            # copied out once, the block is gone when this returns
+            block = SharedMemory(name=result.name)
+            try:
+                result = bytearray(block.buf[: result.size])
+            finally:
+                _close(block)
+                block.unlink()
+        return result
+
+    def _restart(self):
+        with self._lock:
+            pool, self._pool = self._pool, self._start()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, int]:
+        # jobs beyond the number of processes wait in the pool's queue
+        in_flight = self._in_flight
+        return {
+            "queued": max(0, in_flight - self.processes),
+            "running": min(in_flight, self.processes),
+            "processes": self.processes,
+        }
+
+    def close(self):
+        self._pool.shutdown()
+
+
+def init(processes: int = PROCESSES, thresholds: dict = None):
+    # start offloading jobs above their threshold, 0 processes runs all of them inline
+    global EXECUTOR
+    close()
+    if processes > 0:
+        EXECUTOR = CryptoExecutor(processes, thresholds)
+        log.debug("Crypto jobs offloaded to up to %s processes.", processes)
+
+
+def close():
+    global EXECUTOR
+    if EXECUTOR is not None:
+        EXECUTOR.close()
+        EXECUTOR = None
+
+
+def offloads(job: str, amount: float) -> bool:
+    # whether a job of this size would run in a worker process
+    return EXECUTOR is not None and EXECUTOR.offloads(job, amount)
+
+
+def run(job: str, amount: float, function: Callable, *args):
+    # function(*args), in a worker process if the pool is running and `amount`
+    # reaches the threshold of `job`, in the calling thread otherwise
+    executor = EXECUTOR
+    where = "process" if executor and executor.offloads(job, amount) else "inline"
+    started = time.perf_counter()
+    try:
+        if where == "process":
+            return executor.run(job, function, *args)
+        return function(*args)
+    finally:
+        JOB_SECONDS.observe(time.perf_counter() - started, job=job, where=where)
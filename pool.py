@@ -0,0 +1,147 @@
+import collections
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Optional
+
+"""
+Bounded pool of objects that may only be used by one thread at a time, and a pool of
+values fetched ahead of time in batches.
+"""
+
+log = logging.getLogger("pool")
+
+
+class ServicePool:
+    """
+    Hands out at most ``size`` objects built by ``factory``, creating them lazily.
+
+    Checkouts are reentrant: a thread that already holds an object gets the same one
+    back, so helpers can check out inside each other without exhausting the pool.
+    """
+
+    def __init__(self, factory: Callable[[], Any], size: int = 16):
+        self.factory = factory
+        self.size = size
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._created = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._closed = False
+
+    def _acquire(self):
+        if self._closed:
+            raise RuntimeError("the service pool has been shut down.")
+        # reuse an idle object first, it keeps its open connections
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._created) < self.size:
+                service = self.factory()
+                self._created.append(service)
+                return service
+        # every object is checked out, wait for one to come back
+        return self._idle.get()
+
+    @contextmanager
+    def checkout(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            self._local.service = self._acquire()
+        self._local.depth = depth + 1
+        try:
+            yield self._local.service
+        finally:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                service, self._local.service = self._local.service, None
+                self._idle.put(service)
+
+    def current(self):
+        # the object checked out by the calling thread, if any
+        return getattr(self._local, "service", None)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "created": len(self._created),
+            "idle": self._idle.qsize(),
+        }
+
+    def close(self, closer: Callable[[Any], None] = None):
+        self._closed = True
+        with self._lock:
+            for service in self._created:
+                if closer:
+                    closer(service)
+            self._created = []
+
+
+class PrefetchPool:
+    """
+    Values fetched in batches by ``fetch``, each handed out once.
+
+    A background thread fetches the next batch once fewer than ``low`` values are
+    left, so takers only wait for a fetch when the pool ran dry. ``take`` answers
+    None when the pool ran dry and that fetch failed or came back empty.
+    """
+
+    def __init__(self, fetch: Callable[[], Iterable[Any]], low: int = 20):
+        self.fetch = fetch
+        self.low = low
+        self._values = collections.deque()
+        self._condition = threading.Condition()
+        self._refilling = False
+
+    def take(self) -> Optional[Any]:
+        with self._condition:
+            # a refill already under way is waited for rather than duplicated
+            self._condition.wait_for(lambda: self._values or not self._refilling)
+            if self._values:
+                value = self._values.popleft()
+                if len(self._values) < self.low:
+                    self._start_refill()
+                return value
+            self._refilling = True
+        # the pool ran dry, fetch a batch in the calling thread
+        values = []
+        try:
+            values = list(self.fetch())
+        except Exception as e:
+            # the taker goes without a value rather than failing
+            log.warning("fetching for the pool failed: %s", e)
+        finally:
+            with self._condition:
+                self._values.extend(values[1:])
+                self._refilling = False
+                self._condition.notify_all()
+        return values[0] if values else None
+
+    def prefetch(self):
+        # fill the pool in the background ahead of the first `take`
+        with self._condition:
+            if len(self._values) < self.low:
+                self._start_refill()
+
+    def _start_refill(self):
+        if not self._refilling:
+            self._refilling = True
+            threading.Thread(target=self._refill, daemon=True).start()
+
+    def _refill(self):
+        try:
+            values = list(self.fetch())
+        except Exception as e:
+            # takers fetch for themselves until a later refill succeeds
+            log.warning("refilling the pool failed: %s", e)
+            values = []
+        with self._condition:
+            self._values.extend(values)
+            self._refilling = False
+            self._condition.notify_all()
+
+    def __len__(self) -> int:
+        return len(self._values)
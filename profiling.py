@@ -0,0 +1,107 @@
+import cProfile
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+"""
+On-demand profiling of individual requests.
+
+A request is profiled when it carries the `X-Profile` header with the configured
+token, or when it falls in the sampled fraction of requests. Every profile is written
+to `PROFILE_DIR` twice: a cProfile dump (`.prof`, for pstats or snakeviz) and stacks
+sampled from the request thread in collapsed form (`.collapsed`, for flamegraph.pl or
+speedscope). Requests that are not profiled pay for one random number at most.
+"""
+
+# Header that asks for a profile of a single request, its value must be PROFILE_TOKEN
+HEADER = "X-Profile"
+# Secret the header must match, header-triggered profiles are disabled without it
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+# Fraction of all requests to profile, 0.01 profiles one request in a hundred
+SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+# Where profiles are written
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Seconds between two stack samples
+STACK_INTERVAL = 0.005
+
+log = logging.getLogger("profiling")
+
+# Only one request is profiled at a time, profilers of different threads interfere
+_ACTIVE = threading.Lock()
+
+
+class Profile:
+    """
+    cProfile and sampled stacks of the thread serving one request.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.thread_id = threading.get_ident()
+        self.profiler = cProfile.Profile()
+        self.stacks: Counter = Counter()
+        self.started = time.time()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._sampler.start()
+        self.profiler.enable()
+
+    def _sample(self):
+        while not self._stopped.wait(STACK_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def finish(self) -> str:
+        # stop profiling and write both files, returns their common name
+        try:
+            self.profiler.disable()
+            self._stopped.set()
+            self._sampler.join()
+
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+            label = re.sub(r"[^\w.-]+", "_", self.name).strip("_") or "request"
+            stem = f"{stamp}-{label}-{os.getpid()}-{threading.get_ident()}"
+            path = os.path.join(PROFILE_DIR, stem)
+            self.profiler.dump_stats(path + ".prof")
+            with open(path + ".collapsed", "w") as collapsed:
+                for stack, count in self.stacks.items():
+                    collapsed.write(f"{stack} {count}\n")
+            log.info("profile of %s written to %s.{prof,collapsed}", self.name, path)
+            return stem
+        finally:
+            _ACTIVE.release()
+
+
+def requested(header_value: Optional[str]) -> bool:
+    if not PROFILE_TOKEN or not header_value:
+        return False
+    return hmac.compare_digest(header_value.encode(), PROFILE_TOKEN.encode())
+
+
+def start(name: str, header_value: Optional[str] = None) -> Optional[Profile]:
+    # a running profile if this request should be profiled, None otherwise
+    if not requested(header_value):
+        if not SAMPLE_RATE or random.random() >= SAMPLE_RATE:
+            return None
+    if not _ACTIVE.acquire(blocking=False):
+        log.debug("skipping a profile of %s, another one is running", name)
+        return None
+    profile = Profile(name)
+    profile.start()
+    return profile
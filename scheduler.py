@@ -0,0 +1,159 @@
+import datetime
+import email.utils
+import random
+import threading
+import time
+from typing import Optional, Union
+
+import metrics
+
+"""
+Scheduling of Drive API calls shared by every thread and task of the process.
+
+A token bucket spreads calls out so the process stays under the Drive quota instead
+of bursting into throttling, and calls failing with a transient error (429, a 403
+rate limit, a 5xx or a dropped connection) are retried with jittered exponential
+backoff, waiting at least as long as a `Retry-After` header asks.
+
+The scheduler only hands out delays; `drive.py` sleeps and `async_drive.py` awaits.
+"""
+
+# Statuses of calls that may succeed when sent again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Reasons that turn a 403 into a rate limit error
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+# Methods that can be repeated after a failure without changing the outcome, other
+# calls are only retried when the API rejected them without acting on them
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "PATCH", "DELETE")
+
+
+def transient(status: int, content: Union[bytes, str, None] = None) -> Optional[str]:
+    # why a failed call is worth another try, None when it is not
+    if status == 429:
+        return "rate-limit"
+    if status == 403 and content:
+        if isinstance(content, bytes):
+            content = content.decode("utf-8", "replace")
+        if any(reason in content for reason in RATE_LIMIT_REASONS):
+            return "rate-limit"
+    if status in RETRY_STATUSES:
+        return "server-error"
+    return None
+
+
+def retry_after(value: Optional[str]) -> Optional[float]:
+    # seconds a `Retry-After` header asks to wait, either delay-seconds or a date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(date.tzinfo or datetime.timezone.utc)
+    return max(0.0, (date - now).total_seconds())
+
+
+class TokenBucket:
+    """
+    Calls per second limit shared across threads, `reserve` hands out send times.
+
+    A reservation takes its token right away, so waiting callers queue up in order
+    instead of racing for the next token.
+    """
+
+    def __init__(self, rate: Optional[float], burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or rate or 0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        # nothing is sent before this time, set by `hold`
+        self._not_before = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # seconds to wait before sending one call
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self._not_before - now)
+            if self.rate:
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                self._tokens -= 1
+                delay = max(delay, -self._tokens / self.rate)
+            return delay
+
+    def hold(self, seconds: float):
+        # the API asked to back off, no call of any thread is sent in that time
+        with self._lock:
+            self._not_before = max(self._not_before, time.monotonic() + seconds)
+
+
+class Scheduler:
+    """
+    Rate limit and retry policy applied to every Drive API call.
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        max_attempts: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 32.0,
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._random = random.Random()
+
+    def admit(self, call: str) -> float:
+        # seconds `call` has to wait for the rate limit
+        delay = self.bucket.reserve()
+        if delay:
+            metrics.drive_wait(call, "rate-limit", delay)
+        return delay
+
+    def backoff(self, attempt: int) -> float:
+        # full jitter keeps retrying clients from hitting the API in lockstep
+        ceiling = min(self.max_delay, self.base_delay * 2**attempt)
+        return self._random.uniform(0, ceiling)
+
+    def retry_delay(
+        self,
+        call: str,
+        method: str,
+        attempt: int,
+        status: Optional[int] = None,
+        content: Union[bytes, str, None] = None,
+        retry_after_header: Optional[str] = None,
+    ) -> Optional[float]:
+        """
+        Seconds to wait before sending a failed call again, None to give up.
+
+        ``attempt`` counts the tries made so far minus one, a ``status`` of None
+        stands for a connection that failed before any response arrived.
+        """
+        if attempt + 1 >= self.max_attempts:
+            return None
+        reason = "connection" if status is None else transient(status, content)
+        if reason is None:
+            return None
+        if reason != "rate-limit" and method.upper() not in IDEMPOTENT_METHODS:
+            # a failed create may still have happened, repeating it could duplicate
+            return None
+
+        delay = self.backoff(attempt)
+        requested = retry_after(retry_after_header)
+        if requested is not None:
+            self.bucket.hold(requested)
+            delay = max(delay, requested)
+        metrics.drive_retry(call, reason)
+        metrics.drive_wait(call, "backoff", delay)
+        return delay
@@ -1,4 +1,5 @@
-from flask import Flask, request, render_template, redirect, url_for
+from flask import Flask, Response, g, request, render_template, redirect, url_for
+from flask import stream_with_context
 from flask_cors import CORS
 from googleapiclient.errors import HttpError
 from googleapiclient.discovery import build
@@ -6,69 +7,535 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 
+import functools
+import itertools
+import logging
 import os
+import signal
+import tempfile
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData
+
+import chunking
 import crypto
 import drive
+import metrics
+import offload
+import profiling
+import scheduler
+import shamir
 from definitions import *
+from locks import StripedLocks
+from writeback import PendingWrite, WriteBehind
 
 # Set DEBUG to 'True' to see debug output
 DEBUG = True
 
+# Number of files transferred concurrently by the batch endpoints
+TRANSFER_WORKERS = 8
+# Number of locks shared by all file names, operations on one file are serialized
+FILE_LOCK_STRIPES = 256
+# Number of Drive connections shared by request threads and transfer workers
+DRIVE_POOL_SIZE = 16
+# How new files are stored, "whole" or "chunked" (see chunking.py)
+DEFAULT_STORAGE = "whole"
+# Drive API stand-in to use instead of Google Drive, e.g. http://127.0.0.1:8099
+DRIVE_API_ENDPOINT = os.environ.get("DRIVE_API_ENDPOINT")
+# Set SERVER_TIMING=1 to return the per-phase timings of every request to the client
+SERVER_TIMING = os.environ.get("SERVER_TIMING") == "1"
+# Seconds updates of a file are held in memory and coalesced before only the newest
+# one is stored, set WRITE_BEHIND_DELAY=0 to store every update before answering
+WRITE_BEHIND_DELAY = float(os.environ.get("WRITE_BEHIND_DELAY", "0"))
+# Bytes of the request body read at a time by the binary endpoints
+UPLOAD_READ_SIZE = crypto.SEGMENT_SIZE
+# Encrypted uploads are kept in memory up to this size, in a temporary file above it,
+# until they are stored (only ciphertext ever reaches the disk)
+UPLOAD_SPOOL_SIZE = 8 * 1024 * 1024
+# Worker processes for large encryptions, decryptions and key derivations (see
+# offload.py), CRYPTO_PROCESSES=0 runs all crypto in the request threads
+CRYPTO_PROCESSES = int(os.environ.get("CRYPTO_PROCESSES", offload.PROCESSES))
+# Longest shared_secrets value read, room for shamir.MAX_SHARES comma separated shares
+SHARED_SECRETS_MAX_LENGTH = shamir.MAX_SHARES * 80
+# Format of the log output, LOG_LEVEL=INFO in the environment drops the debug messages
+LOG_FORMAT = "[%(name)s] %(levelname)s %(message)s"
+
+log = logging.getLogger("server")
+
 app = Flask(__name__)
 CORS(app)
 
+# Worker threads for the media transfers of the batch endpoints
+transfers = ThreadPoolExecutor(max_workers=TRANSFER_WORKERS)
+
+# Locks held by requests changing a file, see `with_file_locks`
+file_locks = StripedLocks(FILE_LOCK_STRIPES)
+
+# Queue of updates not stored yet, None when every update is stored right away
+WRITES: WriteBehind = None
+
+
+def configure_logging(debug: bool) -> bool:
+    # returns whether debug messages are logged, LOG_LEVEL overrides `debug`
+    level = os.environ.get("LOG_LEVEL") or ("DEBUG" if debug else "INFO")
+    logging.basicConfig(level=level.upper(), format=LOG_FORMAT)
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+def files_in(body: dict) -> list:
+    # names of the files a request body is about
+    if RequestBodyField.Filename in body:
+        return [body[RequestBodyField.Filename]]
+    if RequestBodyField.Filenames in body:
+        return list(body[RequestBodyField.Filenames])
+    return [
+        entry[RequestBodyField.Filename]
+        for entry in body.get(RequestBodyField.Files, [])
+    ]
+
+
+def with_file_locks(endpoint):
+    # changes of the same file run one at a time, those of other files in parallel
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        body = request.get_json(silent=True) or request.args
+        with file_locks.hold(*files_in(body)):
+            return endpoint(*args, **kwargs)
+
+    return wrapper
+
 
 def get_credential_bytes():
-    if DEBUG:
-        print("[SERVER] checking for authentication credentials.")
+    with metrics.span("credentials"):
+        return credential_bytes_from(request.json)
+
+
+def get_header_credential_bytes():
+    # the binary endpoints take the credentials from headers, the body is content
+    with metrics.span("credentials"):
+        return credential_bytes_from(
+            {
+                RequestBodyField.Password: request.headers.get(
+                    RequestHeader.Password, ""
+                ),
+                RequestBodyField.SharedSecrets: request.headers.get(
+                    RequestHeader.SharedSecrets, ""
+                ),
+            }
+        )
+
+
+def credential_bytes_from(body: dict):
+    log.debug("checking for authentication credentials.")
     # prepare credential byte array
     credential_bytes: bytes = None
 
-    if RequestBodyField.Password in request.json and len(
-        request.json[RequestBodyField.Password]
-    ):
-        if DEBUG:
-            print("[SERVER] using password authentication.")
+    if RequestBodyField.Password in body and len(body[RequestBodyField.Password]):
+        log.debug("using password authentication.")
         # read the password json field
-        password = request.json[RequestBodyField.Password]
+        password = body[RequestBodyField.Password]
         # turn the password into valid credential bytes
         credential_bytes = crypto.key_from_password(password)
 
-    elif RequestBodyField.SharedSecrets in request.json and len(
-        request.json[RequestBodyField.SharedSecrets]
+    elif RequestBodyField.SharedSecrets in body and len(
+        body[RequestBodyField.SharedSecrets]
     ):
-        if DEBUG:
-            print("[SERVER] using shared-secret authentication.")
-        # read shared secret list
-        shared_secrets: list = request.json[RequestBodyField.SharedSecrets].split(",")
+        log.debug("using shared-secret authentication.")
+        # read shared secret list, refusing more shares than a secret is split in
+        # before any of them is parsed
+        if len(body[RequestBodyField.SharedSecrets]) > SHARED_SECRETS_MAX_LENGTH:
+            raise Exception("too many shared secrets given.")
+        shared_secrets: list = body[RequestBodyField.SharedSecrets].split(
+            ",", shamir.MAX_SHARES
+        )
         # create credentials key from shared secrets
         credential_bytes = crypto.key_from_shared(shared_secrets)
 
     if not credential_bytes:
-        if DEBUG:
-            print("[SERVER] failed to find authentication method.")
+        log.debug("failed to find authentication method.")
         # there were not authentication methods
         raise Exception("no authentication method given in request.")
 
     return credential_bytes
 
 
+def unlock_file(file_name: str, credential_bytes: bytes, properties: dict = None):
+    # fetch the wrapped data keys of the file, without touching its content
+    if properties is None:
+        properties = drive.get_properties(file_name)
+    with metrics.span("unlock"):
+        return open_key_slots(credential_bytes, properties)
+
+
+def open_key_slots(credential_bytes: bytes, properties: dict):
+    # content key, whether it came from a key slot, and the key check value if not
+    slots = crypto.wrapped_keys(properties)
+    if not slots:
+        # files written before key slots existed are encrypted with the credentials
+        return credential_bytes, False, properties.get(crypto.KEY_CHECK_PROPERTY)
+    log.debug("unlocking data key from %s key slot(s).", len(slots))
+    return crypto.unwrap_any(credential_bytes, slots), True, None
+
+
+def verify_credentials(
+    file_name: str, credential_bytes: bytes, remember=True, properties: dict = None
+):
+    # prove the caller can unlock the file using only its metadata where possible
+    data_key, has_key_slots, key_check = unlock_file(
+        file_name, credential_bytes, properties
+    )
+    if has_key_slots:
+        # unwrapping the data key already authenticated the credentials
+        return data_key, has_key_slots
+    if key_check:
+        crypto.verify_key_check(credential_bytes, key_check)
+        return data_key, has_key_slots
+
+    log.debug("no key check value, verifying the full file.")
+    with metrics.span("verify", exclusive=True):
+        crypto.verify_stream(credential_bytes, drive.read_stream(file_name))
+    if remember:
+        remember_key_check(file_name, credential_bytes)
+    return data_key, has_key_slots
+
+
+def remember_key_check(file_name: str, credential_bytes: bytes):
+    # store a key check value once the credentials are known to be correct
+    drive.set_properties(
+        file_name,
+        {crypto.KEY_CHECK_PROPERTY: crypto.key_check_value(credential_bytes)},
+    )
+
+
+def new_key_slots(credential_bytes: bytes):
+    # generate a fresh data key and wrap it under the password credentials
+    data_key = crypto.generate_data_key()
+    properties = {
+        crypto.key_property(KeySlot.Password): crypto.wrap_key(
+            credential_bytes, data_key
+        ),
+        # key slots replace the key check value of older files
+        crypto.KEY_CHECK_PROPERTY: None,
+    }
+    return data_key, properties
+
+
+def load_content(file_name: str, data_key: bytes, properties: dict) -> bytes:
+    with metrics.span("decrypt", exclusive=True):
+        if not chunking.is_chunked(properties):
+            if offload.offloads("decrypt", drive.size(file_name)):
+                # a large file is downloaded first, then decrypted in one piece by a
+                # crypto worker process
+                return crypto.decrypt_buffer(data_key, drive.read(file_name))
+        # decrypt the file (or its chunks) while it is being downloaded
+        return b"".join(stream_content(file_name, data_key, properties))
+
+
+def stream_content(file_name: str, data_key: bytes, properties: dict) -> Iterator:
+    # plaintext handed out as soon as each part of it has been verified
+    if chunking.is_chunked(properties):
+        return chunking.read_chunked_stream(file_name, data_key)
+    return crypto.decrypt_stream(data_key, drive.read_stream(file_name))
+
+
+def plaintext_span(offset: int, length: int, size: int) -> tuple:
+    # start and stop of a byte range within `size` bytes
+    if not all(isinstance(value, (int, type(None))) for value in (offset, length)):
+        raise Exception("the offset and length must be integers.")
+    offset = offset or 0
+    if length is not None and length < 0:
+        raise Exception("the length cannot be negative.")
+    start = max(0, size + offset) if offset < 0 else min(offset, size)
+    stop = size if length is None else min(size, start + length)
+    return start, stop
+
+
+def load_range(file_name: str, data_key: bytes, properties: dict, offset, length):
+    # (plaintext range, its start, plaintext size); for whole files only the
+    # segments holding the range are downloaded and decrypted
+    with metrics.span("decrypt", exclusive=True):
+        if not chunking.is_chunked(properties):
+            head = drive.read_range(file_name, 0, crypto.HEADER_SIZE - 1)
+            if crypto.is_segmented(head):
+                reader = crypto.SegmentReader(data_key, head, drive.size(file_name))
+                # compressed segments are found through the index ending the file,
+                # read again when it is larger than the first guess
+                if reader.indexed and not reader.load_index(
+                    drive.read_range(file_name, *reader.index_range())
+                ):
+                    reader.load_index(
+                        drive.read_range(file_name, *reader.index_range())
+                    )
+                start, stop = plaintext_span(offset, length, reader.size)
+                if start == stop:
+                    return bytes(), start, reader.size
+                first, last = reader.ciphertext_range(start, stop - start)
+                ciphertext = drive.read_range(file_name, first, last)
+                plaintext = reader.decrypt(start, stop - start, ciphertext)
+                return plaintext, start, reader.size
+        # chunked and legacy files are read in full
+        plaintext = b"".join(stream_content(file_name, data_key, properties))
+    start, stop = plaintext_span(offset, length, len(plaintext))
+    return plaintext[start:stop], start, len(plaintext)
+
+
+def check_store_options(storage: str = None, compression: str = None):
+    # refuse unknown options while the request can still be answered with them
+    if storage not in (None, "whole", "chunked"):
+        raise Exception(f"unknown storage `{storage}`.")
+    if compression is not None and compression not in crypto.CODECS:
+        raise Exception(f"unknown compression codec `{compression}`.")
+
+
+def store_content(*args, **kwargs):
+    # encrypt a new version while uploading it
+    with metrics.span("encrypt", exclusive=True):
+        return _store_content(*args, **kwargs)
+
+
+def _store_content(
+    file_name: str,
+    data_key: bytes,
+    plaintext: bytes,
+    properties: dict,
+    previous_properties: dict,
+    storage: str = None,
+    compression: str = None,
+    expected_version: str = None,
+):
+    check_store_options(storage, compression)
+    # keep the storage of the previous version unless the request picks another one
+    was_chunked = chunking.is_chunked(previous_properties)
+    storage = storage or ("chunked" if was_chunked else DEFAULT_STORAGE)
+    previous_chunks = (
+        chunking.read_manifest(file_name, data_key) if was_chunked else None
+    )
+
+    if storage == "chunked":
+        chunking.write_chunked(
+            file_name,
+            data_key,
+            plaintext,
+            properties,
+            previous_chunks,
+            compression,
+            expected_version,
+        )
+        return
+
+    if was_chunked:
+        properties = dict(properties or {})
+        properties[chunking.STORAGE_PROPERTY] = None
+    # encrypt the new version into a single buffer and upload straight from it
+    drive.write(
+        file_name,
+        crypto.encrypt_and_digest(data_key, plaintext, compression),
+        properties,
+        expected_version=expected_version,
+    )
+    if previous_chunks:
+        drive.delete_many(list(set(previous_chunks)))
+
+
+def store_stream(
+    file_name: str,
+    data_key: bytes,
+    chunks: Iterator[bytes],
+    properties: dict,
+    previous_properties: dict,
+    compression: str = None,
+    expected_version: str = None,
+):
+    # encrypt streamed plaintext into a spool, then upload that so the upload can be
+    # retried, content stored this way is never chunked
+    with metrics.span("encrypt", exclusive=True):
+        previous_chunks = None
+        if chunking.is_chunked(previous_properties):
+            previous_chunks = chunking.read_manifest(file_name, data_key)
+            properties = dict(properties or {})
+            properties[chunking.STORAGE_PROPERTY] = None
+        with tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE) as spool:
+            for ciphertext in crypto.encrypt_stream(
+                data_key, chunks, compression=compression
+            ):
+                spool.write(ciphertext)
+            drive.write_file(file_name, spool, properties, expected_version)
+        if previous_chunks:
+            drive.delete_many(list(set(previous_chunks)))
+
+
+def request_body_chunks() -> Iterator[bytes]:
+    # the uploaded content as it arrives, the raw body or a multipart form's file
+    content_type = request.mimetype
+    if content_type == "application/octet-stream":
+        return iter(lambda: request.stream.read(UPLOAD_READ_SIZE), b"")
+    if content_type == "multipart/form-data":
+        boundary = request.mimetype_params.get("boundary")
+        if boundary:
+            return multipart_file_chunks(boundary.encode("latin-1"))
+    return None
+
+
+def multipart_file_chunks(boundary: bytes) -> Iterator[bytes]:
+    # data of the first file of a multipart form, parsed incrementally so that no
+    # part of it is buffered or written to disk by the form parser
+    decoder = MultipartDecoder(boundary)
+    in_file, ended = False, False
+    while True:
+        event = decoder.next_event()
+        if isinstance(event, NeedData):
+            if ended:
+                raise Exception("the form data is incomplete.")
+            data = request.stream.read(UPLOAD_READ_SIZE)
+            ended = not data
+            # None tells the decoder the body is over
+            decoder.receive_data(data or None)
+        elif isinstance(event, File):
+            in_file = True
+        elif isinstance(event, Field):
+            in_file = False
+        elif isinstance(event, Data) and in_file:
+            yield event.data
+            if not event.more_data:
+                return
+        elif isinstance(event, Epilogue):
+            raise Exception("the form data has no file.")
+
+
+def store_pending(file_name: str, write: PendingWrite):
+    # store a coalesced update, against the version of the file stored right now
+    previous_properties, version = drive.get_versioned_properties(file_name)
+    store_content(
+        file_name,
+        write.data_key,
+        write.plaintext,
+        write.properties,
+        previous_properties,
+        write.storage,
+        write.compression,
+        version,
+    )
+
+
+def pending_write(file_name: str, credential_bytes: bytes) -> PendingWrite:
+    # the queued update of a file, if the credentials are the ones that queued it
+    write = WRITES.pending(file_name) if WRITES is not None else None
+    if write is None:
+        return None
+    try:
+        crypto.verify_key_check(credential_bytes, write.key_check)
+    except ValueError:
+        # other credentials, e.g. shared secrets, are checked against the drive
+        return None
+    return write
+
+
+def flush_pending(*file_names: str):
+    # store queued updates before an operation that works on the stored file
+    if WRITES is not None:
+        WRITES.flush(file_names)
+
+
+def describe_error(e: Exception):
+    # message and status code reported for a failed operation
+    if isinstance(e, FileNotFoundError) or getattr(e, "status_code", None) == 404:
+        return "the file does not exist.", 404
+    if isinstance(e, ValueError):
+        if "MAC" in str(e):
+            return "password may be incorrect or the file is corrupt.", 401
+        return "unknown error.", 400
+    if isinstance(e, (drive.ConflictError, FileExistsError)):
+        return str(e), 409
+    if isinstance(getattr(e, "status_code", None), int):
+        # a Drive API error left over once the scheduler gave up retrying
+        content = getattr(e, "content", None) or getattr(e, "error_details", None)
+        if scheduler.transient(e.status_code, str(content)):
+            return "Google Drive is busy, try again later.", 503
+        return "Google Drive request failed.", 502
+    return str(e), 400
+
+
+def run_per_file(operation, file_names: list) -> dict:
+    # run an operation for every file concurrently, collecting per-file outcomes
+    operation = metrics.propagate(operation)
+    futures = {name: transfers.submit(operation, name) for name in file_names}
+    results = dict()
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            message, status = describe_error(e)
+            results[name] = {"status": status, "error": message}
+    return results
+
+
+@app.before_request
+def start_profile():
+    # profile sampled requests and those asking for it with the profiling token
+    name = request.url_rule.rule if request.url_rule else request.path
+    g.profile = profiling.start(name, request.headers.get(profiling.HEADER))
+
+
+@app.after_request
+def finish_profile(response):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        name = profile.finish()
+        if profiling.requested(request.headers.get(profiling.HEADER)):
+            response.headers[profiling.HEADER] = name
+    return response
+
+
+@app.teardown_request
+def abandon_profile(error=None):
+    # a request that failed before its response was built still ends its profile
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.finish()
+
+
+@app.before_request
+def start_trace():
+    # every request collects its spans and Drive API calls in a trace
+    g.trace_token = metrics.start_trace()
+    if request.headers.get("Content-Type") == "application/json":
+        with metrics.span("parse"):
+            request.get_json(silent=True)
+
+
+@app.after_request
+def finish_trace(response):
+    token = g.pop("trace_token", None)
+    if token is None:
+        return response
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    trace = metrics.finish_trace(token, endpoint, response.status_code)
+    if SERVER_TIMING and trace is not None:
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.errorhandler(ValueError)
 def handle_verification_failure(e: ValueError):
-    if "MAC" in str(e):
-        return "password may be incorrect or the file is corrupt.", 401
-
-    return "unknown error.", 400
+    return describe_error(e)
 
 
 @app.errorhandler(FileNotFoundError)
 def handle_file_not_found(e):
-    return "the file does not exist.", 404
+    return describe_error(e)
 
 
 @app.errorhandler(Exception)
 def fallback_error(e: Exception):
-    return str(e), 400
+    return describe_error(e)
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -78,6 +545,7 @@ def login():
 
 
 @app.post("/" + Endpoint.Create)
+@with_file_locks
 def create_file():
     if request.headers.get("Content-Type") == "application/json":
         # read filename
@@ -85,12 +553,11 @@ def create_file():
         # prepare credential byte array
         credential_bytes = get_credential_bytes()
 
-        if not drive.exists(file_name):
-            file_bytes = crypto.encrypt_and_digest(credential_bytes, bytes())
-            drive.write(file_name, file_bytes)
-            return "", 201
-        else:
-            return f"the file `{file_name}` already exists.", 409
+        # refused with 409 (FileExistsError) when the name is taken
+        data_key, properties = new_key_slots(credential_bytes)
+        file_bytes = crypto.encrypt_and_digest(data_key, bytes())
+        drive.create(file_name, file_bytes, properties)
+        return "", 201
 
 
 @app.post("/" + Endpoint.Read)
@@ -100,43 +567,111 @@ def read_file():
         file_name = request.json[RequestBodyField.Filename]
         # prepare credential byte array
         credential_bytes = get_credential_bytes()
+        # read only part of the file when a range is given
+        offset = request.json.get(RequestBodyField.Offset)
+        length = request.json.get(RequestBodyField.Length)
+        ranged = offset is not None or length is not None
 
-        # check if the file exists
-        file_data = drive.read(file_name)
-
-        # if file is valid, then encrypt a new version
-        content = crypto.decrypt_and_verify(credential_bytes, file_data)
+        # an update that is not stored yet is served from memory, credentials
+        # matching its key check need no Drive call
+        write = pending_write(file_name, credential_bytes)
+        if write is None:
+            # unwrap the data key and decrypt the file while it is being downloaded
+            properties = drive.get_properties(file_name)
+            if WRITES is not None and WRITES.pending(file_name) is not None:
+                verify_credentials(file_name, credential_bytes, properties=properties)
+                write = WRITES.pending(file_name)
+        if write is not None:
+            plaintext = write.plaintext
+        else:
+            data_key, has_key_slots, key_check = unlock_file(
+                file_name, credential_bytes, properties
+            )
+            if key_check:
+                crypto.verify_key_check(credential_bytes, key_check)
+            if ranged:
+                part, start, size = load_range(
+                    file_name, data_key, properties, offset, length
+                )
+                # a range may cut a character in two
+                content = part.decode("UTF-8", "replace")
+                return {"content": content, "offset": start, "size": size}
+            plaintext = load_content(file_name, data_key, properties)
+            if not has_key_slots and not key_check:
+                # the whole file verified, later update/delete calls can skip the
+                # download
+                remember_key_check(file_name, credential_bytes)
+        if ranged:
+            start, stop = plaintext_span(offset, length, len(plaintext))
+            content = plaintext[start:stop].decode("UTF-8", "replace")
+            return {"content": content, "offset": start, "size": len(plaintext)}
+        content = plaintext.decode("UTF-8")
         # return the content of the file to the user
         return {"content": content}
 
 
 @app.post("/" + Endpoint.Update)
+@with_file_locks
 def update_file():
     if request.headers.get("Content-Type") == "application/json":
         # read filename
         file_name = request.json[RequestBodyField.Filename]
         # read new file contents
         new_contents: str = request.json[RequestBodyField.Content]
+        # read the optional compression codec and storage
+        compression = request.json.get(RequestBodyField.Compression)
+        storage = request.json.get(RequestBodyField.Storage)
         # prepare credential byte array
         credential_bytes = get_credential_bytes()
 
-        # download file
-        file_data = drive.read(file_name)
+        write = pending_write(file_name, credential_bytes)
+        if write is not None:
+            # replace the queued update, its data key and key slots still apply
+            data_key, properties = write.data_key, write.properties
+        else:
+            # the new version only replaces the one read here, see ConflictError
+            previous_properties, version = drive.get_versioned_properties(file_name)
+            data_key, has_key_slots = verify_credentials(
+                file_name, credential_bytes, False, previous_properties
+            )
+            properties = None
+            if not has_key_slots:
+                # move the old file over to a wrapped data key
+                data_key, properties = new_key_slots(credential_bytes)
 
-        # verify that the contents are correct
-        crypto.decrypt_and_verify(credential_bytes, file_data)
-        # if file is valid, then encrypt a new version
-        updated_file_bytes = crypto.encrypt_and_digest(
-            credential_bytes, new_contents.encode("UTF-8")
-        )
+        if WRITES is not None:
+            # stored once the write-behind window of the file is over
+            check_store_options(storage, compression)
+            WRITES.submit(
+                file_name,
+                PendingWrite(
+                    data_key,
+                    new_contents.encode("UTF-8"),
+                    properties,
+                    storage,
+                    compression,
+                    # only ever kept in memory, the fast KDF is enough
+                    crypto.key_check_value(credential_bytes, crypto.KDF_SHA256),
+                ),
+            )
+            return "", 200
 
-        # upload the file with the new contents
-        drive.write(file_name, updated_file_bytes)
+        store_content(
+            file_name,
+            data_key,
+            new_contents.encode("UTF-8"),
+            properties,
+            previous_properties,
+            storage,
+            compression,
+            version,
+        )
 
         return "", 200
 
 
 @app.post("/" + Endpoint.Delete)
+@with_file_locks
 def delete_file():
     if request.headers.get("Content-Type") == "application/json":
         # read filename
@@ -144,18 +679,125 @@ def delete_file():
         # prepare credential byte array
         credential_bytes = get_credential_bytes()
 
-        # download file
-        file_data = drive.read(file_name)
-
-        # verify that the contents are correct
-        crypto.decrypt_and_verify(credential_bytes, file_data)
-        # remove the file
+        # check the credentials against the file metadata
+        properties = drive.get_properties(file_name)
+        data_key, _ = verify_credentials(
+            file_name, credential_bytes, properties=properties
+        )
+        if WRITES is not None:
+            WRITES.discard(file_name)
+        # remove the file, and its chunks if it has any
+        if chunking.is_chunked(properties):
+            chunking.delete_chunks(file_name, data_key)
         drive.delete(file_name)
 
         return "", 204
 
 
+@app.post("/" + Endpoint.Upload)
+@with_file_locks
+def upload_file():
+    # binary content in the request body, encrypted while it arrives; creates the
+    # file or replaces its content
+    chunks = request_body_chunks()
+    if chunks is None:
+        return "the body must be application/octet-stream or multipart/form-data.", 415
+    file_name = request.args[RequestBodyField.Filename]
+    compression = request.headers.get(RequestHeader.Compression)
+    credential_bytes = get_header_credential_bytes()
+
+    # a queued update is older than this upload, it is stored first
+    flush_pending(file_name)
+    try:
+        # the new version only replaces the one read here, see ConflictError
+        previous_properties, version = drive.get_versioned_properties(file_name)
+    except FileNotFoundError:
+        # created only if no other request creates the name meanwhile
+        previous_properties, version = None, drive.NEW_FILE
+        data_key, properties = new_key_slots(credential_bytes)
+        status = 201
+    else:
+        data_key, has_key_slots = verify_credentials(
+            file_name, credential_bytes, False, previous_properties
+        )
+        properties = None
+        if not has_key_slots:
+            data_key, properties = new_key_slots(credential_bytes)
+        status = 200
+
+    store_stream(
+        file_name,
+        data_key,
+        chunks,
+        properties,
+        previous_properties,
+        compression,
+        version,
+    )
+    return "", status
+
+
+@app.get("/" + Endpoint.Download)
+def download_file():
+    # decrypted content streamed as the response body while it is downloaded
+    file_name = request.args[RequestBodyField.Filename]
+    credential_bytes = get_header_credential_bytes()
+
+    filename = urllib.parse.quote(file_name)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename*=UTF-8''{filename}",
+    }
+    # a single byte range is answered from just the segments holding it
+    ranges = request.range.ranges if request.range else []
+    offset, stop = ranges[0] if len(ranges) == 1 else (None, None)
+    length = None if stop is None else stop - offset
+
+    write = pending_write(file_name, credential_bytes)
+    if write is None:
+        flush_pending(file_name)
+        properties = drive.get_properties(file_name)
+        data_key, has_key_slots, key_check = unlock_file(
+            file_name, credential_bytes, properties
+        )
+        if key_check:
+            crypto.verify_key_check(credential_bytes, key_check)
+        if offset is None:
+            chunks = stream_content(file_name, data_key, properties)
+        else:
+            part, start, size = load_range(
+                file_name, data_key, properties, offset, length
+            )
+    elif offset is None:
+        chunks = iter([write.plaintext])
+    else:
+        start, stop = plaintext_span(offset, length, len(write.plaintext))
+        part, size = write.plaintext[start:stop], len(write.plaintext)
+
+    if offset is not None:
+        if not part:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status=416, headers=headers)
+        headers["Content-Range"] = f"bytes {start}-{start + len(part) - 1}/{size}"
+        return Response(
+            bytes(part),
+            status=206,
+            mimetype="application/octet-stream",
+            headers=headers,
+        )
+
+    # errors surfacing with the first bytes still get a proper status code, later
+    # ones (a corrupt segment) abort the response
+    first = next(chunks, b"")
+    return Response(
+        stream_with_context(itertools.chain([first], chunks)),
+        mimetype="application/octet-stream",
+        headers=headers,
+    )
+
+
 @app.post("/" + Endpoint.ChangePassword)
+@with_file_locks
 def change_password():
     if request.headers.get("Content-Type") == "application/json":
         # prepare credential byte array
@@ -164,18 +806,34 @@ def change_password():
         file_name = request.json[RequestBodyField.Filename]
         # read the new password the user wants for the file
         new_password = request.json[RequestBodyField.NewPassword]
-        # read file name
-        file_data = drive.read(file_name)
-        # decrypt the file
-        file_contents = crypto.decrypt_and_verify(credential_bytes, file_data)
         # create new credential bytes
-        credential_bytes = crypto.key_from_password(new_password)
-        # encrypt the file with the new contents
-        new_file_data = crypto.encrypt_and_digest(
-            credential_bytes, file_contents.encode("UTF-8")
-        )
-        # upload this new file to the drive
-        drive.write(file_name, new_file_data)
+        new_credential_bytes = crypto.key_from_password(new_password)
+
+        flush_pending(file_name)
+        data_key, has_key_slots, _ = unlock_file(file_name, credential_bytes)
+        if has_key_slots:
+            # only the wrapped copy of the data key changes, not the content
+            drive.set_properties(
+                file_name,
+                {
+                    crypto.key_property(KeySlot.Password): crypto.wrap_key(
+                        new_credential_bytes, data_key
+                    )
+                },
+            )
+        else:
+            # decrypt, re-encrypt and upload the file segment by segment, the new
+            # version is only committed once the whole old file has been verified
+            data_key, properties = new_key_slots(new_credential_bytes)
+            with metrics.span("reencrypt", exclusive=True):
+                plaintext_chunks = crypto.decrypt_stream(
+                    credential_bytes, drive.read_stream(file_name)
+                )
+                drive.write_stream(
+                    file_name,
+                    crypto.encrypt_stream(data_key, plaintext_chunks),
+                    properties,
+                )
 
         return "", 200
 
@@ -199,7 +857,205 @@ def get_shared_secrets():
         return {RequestBodyField.SharedSecrets: shared_secrets}, 200
 
 
+@app.post("/" + Endpoint.AddSharedSecrets)
+@with_file_locks
+def add_shared_secrets():
+    if request.headers.get("Content-Type") == "application/json":
+        # read filename
+        file_name = request.json[RequestBodyField.Filename]
+        # read share count and threshold from request
+        shares = int(request.json[RequestBodyField.Shares])
+        threshold = int(request.json[RequestBodyField.Threshold])
+        # prepare credential byte array
+        credential_bytes = get_credential_bytes()
+
+        flush_pending(file_name)
+        data_key, has_key_slots, _ = unlock_file(file_name, credential_bytes)
+        if not has_key_slots:
+            return "the file must be updated before adding shared secrets.", 409
+
+        # split an independent secret and wrap the data key under it
+        shared_secret = crypto.generate_data_key()
+        shared_secrets = crypto.create_shared_secrets(shared_secret, shares, threshold)
+        drive.set_properties(
+            file_name,
+            {
+                crypto.key_property(KeySlot.SharedSecrets): crypto.wrap_key(
+                    shared_secret, data_key
+                )
+            },
+        )
+
+        return {RequestBodyField.SharedSecrets: shared_secrets}, 200
+
+
+@app.post("/" + Endpoint.RevokeSharedSecrets)
+@with_file_locks
+def revoke_shared_secrets():
+    if request.headers.get("Content-Type") == "application/json":
+        # read filename
+        file_name = request.json[RequestBodyField.Filename]
+        # prepare credential byte array
+        credential_bytes = get_credential_bytes()
+
+        # only someone who can unlock the file may remove an unlock method
+        flush_pending(file_name)
+        verify_credentials(file_name, credential_bytes)
+        drive.set_properties(
+            file_name, {crypto.key_property(KeySlot.SharedSecrets): None}
+        )
+
+        return "", 204
+
+
+@app.post("/" + Endpoint.BatchRead)
+def batch_read_files():
+    if request.headers.get("Content-Type") == "application/json":
+        # read filenames
+        file_names: list = request.json[RequestBodyField.Filenames]
+        # prepare credential byte array
+        credential_bytes = get_credential_bytes()
+
+        # fetch the key slots of every file in batched metadata requests
+        flush_pending(*file_names)
+        all_properties = drive.get_properties_many(file_names)
+
+        def read_one(file_name: str):
+            properties = all_properties[file_name]
+            if properties is None:
+                raise FileNotFoundError
+            data_key, _, key_check = unlock_file(
+                file_name, credential_bytes, properties
+            )
+            if key_check:
+                crypto.verify_key_check(credential_bytes, key_check)
+            plaintext = load_content(file_name, data_key, properties)
+            return {"status": 200, "content": plaintext.decode("UTF-8")}
+
+        return {RequestBodyField.Files: run_per_file(read_one, file_names)}, 200
+
+
+@app.post("/" + Endpoint.BatchUpdate)
+@with_file_locks
+def batch_update_files():
+    if request.headers.get("Content-Type") == "application/json":
+        # read the new contents of every file
+        new_contents = {
+            entry[RequestBodyField.Filename]: entry[RequestBodyField.Content]
+            for entry in request.json[RequestBodyField.Files]
+        }
+        # read the optional compression codec and storage
+        compression = request.json.get(RequestBodyField.Compression)
+        storage = request.json.get(RequestBodyField.Storage)
+        # prepare credential byte array
+        credential_bytes = get_credential_bytes()
+
+        # fetch the key slots of every file in batched metadata requests
+        flush_pending(*new_contents)
+        all_properties = drive.get_versioned_properties_many(list(new_contents))
+
+        def update_one(file_name: str):
+            if all_properties[file_name] is None:
+                raise FileNotFoundError
+            previous_properties, version = all_properties[file_name]
+            data_key, has_key_slots = verify_credentials(
+                file_name, credential_bytes, False, previous_properties
+            )
+            properties = None
+            if not has_key_slots:
+                # move the old file over to a wrapped data key
+                data_key, properties = new_key_slots(credential_bytes)
+            store_content(
+                file_name,
+                data_key,
+                new_contents[file_name].encode("UTF-8"),
+                properties,
+                previous_properties,
+                storage,
+                compression,
+                version,
+            )
+            return {"status": 200}
+
+        return {RequestBodyField.Files: run_per_file(update_one, new_contents)}, 200
+
+
+@app.post("/" + Endpoint.BatchDelete)
+@with_file_locks
+def batch_delete_files():
+    if request.headers.get("Content-Type") == "application/json":
+        # read filenames
+        file_names: list = request.json[RequestBodyField.Filenames]
+        # prepare credential byte array
+        credential_bytes = get_credential_bytes()
+
+        # fetch the key slots of every file in batched metadata requests
+        all_properties = drive.get_properties_many(file_names)
+
+        def verify_one(file_name: str):
+            properties = all_properties[file_name]
+            if properties is None:
+                raise FileNotFoundError
+            data_key, _ = verify_credentials(
+                file_name, credential_bytes, False, properties
+            )
+            if WRITES is not None:
+                WRITES.discard(file_name)
+            if chunking.is_chunked(properties):
+                chunking.delete_chunks(file_name, data_key)
+            return {"status": 204}
+
+        results = run_per_file(verify_one, file_names)
+        # remove every verified file in batched delete requests
+        verified = [name for name, result in results.items() if result["status"] == 204]
+        for file_name, deleted in drive.delete_many(verified).items():
+            if not deleted:
+                message, status = describe_error(FileNotFoundError())
+                results[file_name] = {"status": status, "error": message}
+
+        return {RequestBodyField.Files: results}, 200
+
+
+@app.post("/" + Endpoint.CollectGarbage)
+@with_file_locks
+def collect_garbage():
+    if request.headers.get("Content-Type") == "application/json":
+        # read filename
+        file_name = request.json[RequestBodyField.Filename]
+        # prepare credential byte array
+        credential_bytes = get_credential_bytes()
+
+        flush_pending(file_name)
+        properties = drive.get_properties(file_name)
+        data_key, _ = verify_credentials(
+            file_name, credential_bytes, properties=properties
+        )
+        deleted = 0
+        if chunking.is_chunked(properties):
+            # remove chunks of this file that its manifest no longer references
+            deleted = chunking.collect_garbage(file_name, data_key)
+
+        return {"deleted": deleted}, 200
+
+
 if __name__ == "__main__":
-    drive.init(debug=DEBUG)
-    app.run(debug=DEBUG)
+    drive.init(
+        debug=configure_logging(DEBUG),
+        pool_size=DRIVE_POOL_SIZE,
+        api_endpoint=DRIVE_API_ENDPOINT,
+    )
+    offload.init(CRYPTO_PROCESSES)
+    if WRITE_BEHIND_DELAY > 0:
+        WRITES = WriteBehind(store_pending, WRITE_BEHIND_DELAY)
+    # SIGTERM stops the server like Ctrl+C does, so queued updates still get stored
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        # requests are served concurrently, each checking out its own Drive service
+        app.run(debug=DEBUG, threaded=True)
+    finally:
+        if WRITES is not None:
+            WRITES.close()
+    transfers.shutdown()
+    chunking.transfers.shutdown()
+    offload.close()
     drive.close()
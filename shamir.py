@@ -0,0 +1,142 @@
+import functools
+import secrets
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+"""
+Shamir secret sharing over a prime field just below 2**256, for 256-bit keys.
+
+A secret is the constant term of a random polynomial of degree `threshold - 1` and
+share i is that polynomial evaluated at x = i, written as "<i>-<hex value>". Any
+`threshold` shares give the secret back by Lagrange interpolation at x = 0. The
+interpolation coefficients only depend on which share indices are combined, so
+they are computed once per index set and cached.
+"""
+
+# credit to https://github.com/lapets for the intuition on computing shamir secrets in the interger domain with python modulo inverse
+
+# prime modulo close to the 256 bit limit of AES-256
+PRIME: int = 2**256 - 189
+
+# Most shares one split may produce, bounds the work a single request can ask for
+MAX_SHARES = 1024
+
+# Index sets whose interpolation coefficients are kept
+LAGRANGE_CACHE_SIZE = 1024
+
+
+class ShareError(Exception):
+    """
+    Invalid split parameters, or shares that cannot be combined.
+    """
+
+
+def _check(share_count: int, threshold: int):
+    if not 1 <= threshold <= share_count:
+        raise ShareError(
+            "the threshold must be between 1 and the number of shares, "
+            f"got {threshold} of {share_count}."
+        )
+    if share_count > MAX_SHARES:
+        raise ShareError(f"share count cannot be greater than {MAX_SHARES}.")
+
+
+def _to_int(secret: bytes) -> int:
+    value = int.from_bytes(secret, "big")
+    if value >= PRIME:
+        raise ShareError("the secret does not fit in the field.")
+    return value
+
+
+def _evaluate(coefficients: Sequence[int], x: int) -> int:
+    # Horner's rule, lowest degree coefficient first
+    y = 0
+    for coefficient in reversed(coefficients):
+        y = (y * x + coefficient) % PRIME
+    return y
+
+
+def split(secret: bytes, share_count: int, threshold: int) -> List[str]:
+    return split_many([secret], share_count, threshold)[0]
+
+
+def split_many(
+    secret_list: Iterable[bytes], share_count: int, threshold: int
+) -> List[List[str]]:
+    # shares of every secret, each with its own random polynomial
+    _check(share_count, threshold)
+    result = []
+    for secret in secret_list:
+        coefficients = [_to_int(secret)] + [
+            secrets.randbelow(PRIME) for _ in range(1, threshold)
+        ]
+        result.append(
+            [f"{x}-{_evaluate(coefficients, x):x}" for x in range(1, share_count + 1)]
+        )
+    return result
+
+
+def parse(shares: Iterable[str]) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    # (indices, values) of "<i>-<hex>" shares, sorted by index
+    points: Dict[int, int] = dict()
+    for count, share in enumerate(shares, 1):
+        # no secret was split in more shares, and combining them is quadratic
+        if count > MAX_SHARES:
+            raise ShareError(f"cannot combine more than {MAX_SHARES} shares.")
+        try:
+            index, value = share.strip().split("-")
+            x, y = int(index), int(value, 16)
+        except ValueError:
+            raise ShareError(f"malformed share `{share}`.")
+        if not 0 < x < PRIME or not 0 <= y < PRIME:
+            raise ShareError(f"share `{share}` is out of range.")
+        if points.setdefault(x, y) != y:
+            raise ShareError(f"conflicting shares for index {x}.")
+    if not points:
+        raise ShareError("no shares given.")
+    indices = tuple(sorted(points))
+    return indices, tuple(points[x] for x in indices)
+
+
+def _batch_inverse(values: Sequence[int]) -> List[int]:
+    # every inverse for the price of one modular exponentiation (Montgomery's trick)
+    prefix = [1] * (len(values) + 1)
+    for i, value in enumerate(values):
+        prefix[i + 1] = prefix[i] * value % PRIME
+    inverse = pow(prefix[-1], PRIME - 2, PRIME)
+    result = [0] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        result[i] = prefix[i] * inverse % PRIME
+        inverse = inverse * values[i] % PRIME
+    return result
+
+
+@functools.lru_cache(maxsize=LAGRANGE_CACHE_SIZE)
+def lagrange_at_zero(indices: Tuple[int, ...]) -> Tuple[int, ...]:
+    # l_i(0) = prod(x_j) / prod(x_j - x_i) over j != i, for sorted unique indices
+    numerators, denominators = [], []
+    for i, x_i in enumerate(indices):
+        numerator = denominator = 1
+        for j, x_j in enumerate(indices):
+            if i != j:
+                numerator = numerator * x_j % PRIME
+                denominator = denominator * (x_j - x_i) % PRIME
+        numerators.append(numerator)
+        denominators.append(denominator)
+    return tuple(
+        n * d % PRIME for n, d in zip(numerators, _batch_inverse(denominators))
+    )
+
+
+def combine(shares: Iterable[str]) -> bytes:
+    return combine_many([shares])[0]
+
+
+def combine_many(share_sets: Iterable[Iterable[str]]) -> List[bytes]:
+    # secrets of many share sets, sets with the same indices share coefficients
+    result = []
+    for shares in share_sets:
+        indices, values = parse(shares)
+        coefficients = lagrange_at_zero(indices)
+        secret = sum(y * l for y, l in zip(values, coefficients)) % PRIME
+        result.append(secret.to_bytes(32, "big"))
+    return result
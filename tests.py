@@ -1,5 +1,10 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+import chunking
+import drive
 from definitions import *
 
 """
@@ -8,6 +13,10 @@ Test File to make sure that the endpoints work correctly before use with the fro
 
 SERVER_URL = "http://127.0.0.1:5000/"
 
+# Drive API stand-in the server uses, if any; the tests tampering with stored
+# ciphertext reach the same drive through drive.py
+DRIVE_API_ENDPOINT = os.environ.get("DRIVE_API_ENDPOINT")
+
 HEADERS = {"Content-Type": "application/json"}
 
 
@@ -25,6 +34,25 @@ def main():
             headers=HEADERS,
         )
 
+    def metric(name: str, *labels: str) -> float:
+        # sum of the server's samples of a metric carrying every given label
+        return sum(
+            float(line.rsplit(" ", 1)[1])
+            for line in requests.get(SERVER_URL + "metrics").text.splitlines()
+            if line.startswith(name + "{") and all(label in line for label in labels)
+        )
+
+    def update_stored(body: dict) -> requests.Response:
+        # an update that is on Drive once this returns, also with write-behind on:
+        # every queued write ends up stored, discarded or dropped
+        response = post(Endpoint.Update, body)
+        while metric("egd_write_behind_total", 'outcome="queued"') > sum(
+            metric("egd_write_behind_total", f'outcome="{outcome}"')
+            for outcome in ("stored", "discarded", "dropped")
+        ):
+            time.sleep(0.1)
+        return response
+
     """ SETUP TESTBED """
 
     test_filename = "example_filename"
@@ -281,6 +309,1156 @@ def main():
 
     assert delete_response.status_code == 204
 
+    # create, update, read and delete several files at once
+
+    batch_filenames = [f"{test_filename}_{i}" for i in range(3)]
+
+    for batch_filename in batch_filenames:
+        create_response = post(
+            Endpoint.Create,
+            {
+                RequestBodyField.Filename: batch_filename,
+                RequestBodyField.Password: test_password,
+            },
+        )
+
+        assert create_response.status_code == 201
+
+    batch_update_response = post(
+        Endpoint.BatchUpdate,
+        {
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Files: [
+                {
+                    RequestBodyField.Filename: batch_filename,
+                    RequestBodyField.Content: batch_filename,
+                }
+                for batch_filename in batch_filenames
+            ],
+        },
+    )
+
+    assert batch_update_response.status_code == 200
+
+    batch_read_response = post(
+        Endpoint.BatchRead,
+        {
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Filenames: batch_filenames + ["not real"],
+        },
+    )
+
+    batch_results = batch_read_response.json()[RequestBodyField.Files]
+    for batch_filename in batch_filenames:
+        assert batch_results[batch_filename]["content"] == batch_filename
+    assert batch_results["not real"]["status"] == 404
+
+    batch_delete_response = post(
+        Endpoint.BatchDelete,
+        {
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Filenames: batch_filenames,
+        },
+    )
+
+    batch_results = batch_delete_response.json()[RequestBodyField.Files]
+    for batch_filename in batch_filenames:
+        assert batch_results[batch_filename]["status"] == 204
+
+    # create more files at once than the server has Drive services, and than it
+    # reserves file ids in one batch
+
+    parallel_filenames = [f"{test_filename}_parallel_{i}" for i in range(120)]
+
+    def create(filename: str) -> int:
+        return post(
+            Endpoint.Create,
+            {
+                RequestBodyField.Filename: filename,
+                RequestBodyField.Password: test_password,
+            },
+        ).status_code
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        statuses = list(executor.map(create, parallel_filenames))
+
+    assert statuses == [201] * len(parallel_filenames)
+
+    batch_delete_response = post(
+        Endpoint.BatchDelete,
+        {
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Filenames: parallel_filenames,
+        },
+    )
+
+    batch_results = batch_delete_response.json()[RequestBodyField.Files]
+    for parallel_filename in parallel_filenames:
+        assert batch_results[parallel_filename]["status"] == 204
+
+    # read byte ranges of a large file stored with the default compression, only
+    # the encrypted segments holding a range are downloaded
+
+    def received_bytes() -> float:
+        # bytes the server has downloaded from Drive so far
+        return metric("egd_drive_bytes_total", 'direction="received"')
+
+    range_filename = f"{test_filename}_range"
+    range_content = " ".join(f"line {i} of a long document" for i in range(100000))
+
+    create_response = post(
+        Endpoint.Create,
+        {
+            RequestBodyField.Filename: range_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert create_response.status_code == 201
+
+    update_response = update_stored(
+        {
+            RequestBodyField.Filename: range_filename,
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Content: range_content,
+        },
+    )
+
+    received = received_bytes()
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: range_filename,
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Offset: 1000000,
+            RequestBodyField.Length: 100,
+        },
+    )
+    range_received = received_bytes() - received
+
+    assert read_response.status_code == 200
+    assert read_response.json()["content"] == range_content[1000000:1000100]
+    assert read_response.json()["size"] == len(range_content)
+
+    received = received_bytes()
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: range_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+    full_received = received_bytes() - received
+
+    assert read_response.status_code == 200
+    assert read_response.json()["content"] == range_content
+    assert 0 < range_received < full_received / 5
+
+    # the tail of the file, through a negative offset and an HTTP Range
+
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: range_filename,
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Offset: -20,
+        },
+    )
+
+    assert read_response.status_code == 200
+    assert read_response.json()["content"] == range_content[-20:]
+
+    download_url = f"{SERVER_URL}{Endpoint.Download}?{RequestBodyField.Filename}="
+
+    download_response = requests.get(
+        download_url + range_filename,
+        headers={RequestHeader.Password: test_password, "Range": "bytes=-20"},
+    )
+
+    assert download_response.status_code == 206
+    assert download_response.content == range_content[-20:].encode()
+    assert download_response.headers["Content-Range"] == (
+        f"bytes {len(range_content) - 20}-{len(range_content) - 1}/{len(range_content)}"
+    )
+
+    # a range starting past the end cannot be satisfied
+
+    download_response = requests.get(
+        download_url + range_filename,
+        headers={
+            RequestHeader.Password: test_password,
+            "Range": f"bytes={len(range_content)}-",
+        },
+    )
+
+    assert download_response.status_code == 416
+    assert download_response.headers["Content-Range"] == f"bytes */{len(range_content)}"
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: range_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
+    # keep more downloads open, unread, than the server has Drive services; other
+    # requests are still served meanwhile
+
+    stream_filename = f"{test_filename}_stream"
+    stream_content = os.urandom(24 * 1024 * 1024)
+
+    upload_response = requests.post(
+        f"{SERVER_URL}{Endpoint.Upload}?{RequestBodyField.Filename}={stream_filename}",
+        headers={
+            RequestHeader.Password: test_password,
+            "Content-Type": "application/octet-stream",
+        },
+        data=stream_content,
+    )
+
+    assert upload_response.status_code == 201
+
+    downloads = [
+        requests.get(
+            download_url + stream_filename,
+            headers={RequestHeader.Password: test_password},
+            stream=True,
+            timeout=60,
+        )
+        for _ in range(20)
+    ]
+    for download_response in downloads:
+        assert download_response.status_code == 200
+        assert download_response.raw.read(1024) == stream_content[:1024]
+
+    download_response = requests.get(
+        download_url + stream_filename,
+        headers={RequestHeader.Password: test_password, "Range": "bytes=-20"},
+        timeout=60,
+    )
+
+    assert download_response.status_code == 206
+    assert download_response.content == stream_content[-20:]
+
+    for download_response in downloads:
+        download_response.close()
+
+    # a download read through to the end
+
+    download_response = requests.get(
+        download_url + stream_filename,
+        headers={RequestHeader.Password: test_password},
+    )
+
+    assert download_response.status_code == 200
+    assert download_response.content == stream_content
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: stream_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
+    # any `threshold` of the shares unlock a file, fewer do not, and more shares than
+    # a secret can be split in are refused before they are combined
+
+    shares_filename = f"{test_filename}_shares"
+
+    create_response = post(
+        Endpoint.Create,
+        {
+            RequestBodyField.Filename: shares_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert create_response.status_code == 201
+
+    update_response = post(
+        Endpoint.Update,
+        {
+            RequestBodyField.Filename: shares_filename,
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Content: test_content1,
+        },
+    )
+
+    assert update_response.status_code == 200
+
+    generate_shared_secrets_response = post(
+        Endpoint.SharedSecrets,
+        {
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Shares: 5,
+            RequestBodyField.Threshold: 3,
+        },
+    )
+
+    generated_secrets = generate_shared_secrets_response.json()[
+        RequestBodyField.SharedSecrets
+    ]
+
+    assert len(generated_secrets) == 5
+
+    for shares, status in (
+        (generated_secrets[:3], 200),
+        (generated_secrets[2:], 200),
+        (generated_secrets[::2], 200),
+        (generated_secrets, 200),
+        (generated_secrets[1:3], 401),
+    ):
+        read_response = post(
+            Endpoint.Read,
+            {
+                RequestBodyField.Filename: shares_filename,
+                RequestBodyField.SharedSecrets: ",".join(shares),
+            },
+        )
+
+        assert read_response.status_code == status
+        if status == 200:
+            assert read_response.json()["content"] == test_content1
+
+    for share_count, threshold in ((2, 3), (0, 0), (2000, 2)):
+        generate_shared_secrets_response = post(
+            Endpoint.SharedSecrets,
+            {
+                RequestBodyField.Password: test_password,
+                RequestBodyField.Shares: share_count,
+                RequestBodyField.Threshold: threshold,
+            },
+        )
+
+        assert generate_shared_secrets_response.status_code == 400
+
+    too_many_secrets = [f"{i}-{i:064x}" for i in range(1, 1100)]
+
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: shares_filename,
+            RequestBodyField.SharedSecrets: ",".join(too_many_secrets),
+        },
+    )
+
+    assert read_response.status_code == 400
+
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: shares_filename,
+            RequestBodyField.SharedSecrets: ",".join(generated_secrets * 100000),
+        },
+    )
+
+    assert read_response.status_code == 400
+
+    # splitting and combining 64 shares is sent to the crypto worker processes,
+    # unless the server runs without them (CRYPTO_PROCESSES=0)
+
+    def offloaded(job: str) -> float:
+        return metric("egd_crypto_job_seconds_count", f'job="{job}"', 'where="process"')
+
+    offloading = metric("egd_crypto_jobs", 'state="processes"') > 0
+    splits, combines = offloaded("split"), offloaded("combine")
+
+    generate_shared_secrets_response = post(
+        Endpoint.SharedSecrets,
+        {
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Shares: 64,
+            RequestBodyField.Threshold: 64,
+        },
+    )
+
+    generated_secrets = generate_shared_secrets_response.json()[
+        RequestBodyField.SharedSecrets
+    ]
+
+    assert len(generated_secrets) == 64
+
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: shares_filename,
+            RequestBodyField.SharedSecrets: ",".join(generated_secrets),
+        },
+    )
+
+    assert read_response.status_code == 200
+    assert read_response.json()["content"] == test_content1
+    assert offloaded("split") - splits == (1 if offloading else 0)
+    assert offloaded("combine") - combines == (1 if offloading else 0)
+
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: shares_filename,
+            RequestBodyField.SharedSecrets: ",".join(generated_secrets[1:]),
+        },
+    )
+
+    assert read_response.status_code == 401
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: shares_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
+    # store a file in content-defined chunks, change its start and read it back; the
+    # chunks of the first version are deleted by the update, not left to collect
+
+    chunked_filename = f"{test_filename}_chunked"
+    chunked_content = "".join(f"line {i} of a chunked document\n" for i in range(30000))
+
+    create_response = post(
+        Endpoint.Create,
+        {
+            RequestBodyField.Filename: chunked_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert create_response.status_code == 201
+
+    for content in (chunked_content, "a new first line\n" + chunked_content):
+        update_response = post(
+            Endpoint.Update,
+            {
+                RequestBodyField.Filename: chunked_filename,
+                RequestBodyField.Password: test_password,
+                RequestBodyField.Content: content,
+                RequestBodyField.Storage: "chunked",
+            },
+        )
+
+        assert update_response.status_code == 200
+
+        read_response = post(
+            Endpoint.Read,
+            {
+                RequestBodyField.Filename: chunked_filename,
+                RequestBodyField.Password: test_password,
+            },
+        )
+
+        assert read_response.status_code == 200
+        assert read_response.json()["content"] == content
+
+    collect_response = post(
+        Endpoint.CollectGarbage,
+        {
+            RequestBodyField.Filename: chunked_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert collect_response.status_code == 200
+    assert collect_response.json()["deleted"] == 0
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: chunked_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
+    # stored ciphertext that was truncated or altered is refused rather than read,
+    # whole or in part
+
+    drive.init(
+        api_endpoint=DRIVE_API_ENDPOINT,
+        use_cache=False,
+        blob_cache_dir=None,
+        name_index_ttl=None,
+    )
+
+    tamper_filename = f"{test_filename}_tamper"
+    tamper_content = "".join(f"line {i} of a segmented file\n" for i in range(20000))
+
+    create_response = post(
+        Endpoint.Create,
+        {
+            RequestBodyField.Filename: tamper_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert create_response.status_code == 201
+
+    for compression in ("none", "zlib"):
+        update_response = update_stored(
+            {
+                RequestBodyField.Filename: tamper_filename,
+                RequestBodyField.Password: test_password,
+                RequestBodyField.Content: tamper_content,
+                RequestBodyField.Compression: compression,
+            },
+        )
+
+        assert update_response.status_code == 200
+
+        stored = bytes(drive.read(tamper_filename))
+
+        def flipped(position: int) -> bytes:
+            return (
+                stored[:position]
+                + bytes([stored[position] ^ 1])
+                + stored[position + 1 :]
+            )
+
+        # a range read only authenticates the segments holding the range
+        for tampered, offsets in (
+            (stored[:-1], (None, -10)),
+            (stored[:-1000], (None, -10)),
+            (stored[: len(stored) // 2], (None, -10)),
+            (stored + stored[-100:], (None, -10)),
+            (flipped(len(stored) - 30), (None, -10)),
+            (flipped(len(stored) // 2), (None,)),
+        ):
+            drive.write(tamper_filename, tampered)
+
+            for offset in offsets:
+                read_response = post(
+                    Endpoint.Read,
+                    {
+                        RequestBodyField.Filename: tamper_filename,
+                        RequestBodyField.Password: test_password,
+                        RequestBodyField.Offset: offset,
+                    },
+                )
+
+                assert read_response.status_code == 401
+
+        drive.write(tamper_filename, stored)
+
+        read_response = post(
+            Endpoint.Read,
+            {
+                RequestBodyField.Filename: tamper_filename,
+                RequestBodyField.Password: test_password,
+            },
+        )
+
+        assert read_response.status_code == 200
+        assert read_response.json()["content"] == tamper_content
+
+    # a file another client created since the server listed the names on the drive
+    # is taken all the same: it is neither created again nor overwritten without
+    # its credentials
+
+    other_filename = f"{test_filename}_other"
+    drive.create(other_filename, stored, drive.get_properties(tamper_filename))
+
+    create_response = post(
+        Endpoint.Create,
+        {
+            RequestBodyField.Filename: other_filename,
+            RequestBodyField.Password: test_updated_password,
+        },
+    )
+
+    assert create_response.status_code == 409
+
+    upload_response = requests.post(
+        f"{SERVER_URL}{Endpoint.Upload}?{RequestBodyField.Filename}={other_filename}",
+        headers={
+            RequestHeader.Password: test_updated_password,
+            "Content-Type": "application/octet-stream",
+        },
+        data=b"not the owner",
+    )
+
+    assert upload_response.status_code == 401
+
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: other_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert read_response.status_code == 200
+    assert read_response.json()["content"] == tamper_content
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: other_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
+    # chunks of a chunked file are encrypted under the same data key, yet one can
+    # not stand in for another
+
+    update_response = update_stored(
+        {
+            RequestBodyField.Filename: tamper_filename,
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Content: tamper_content,
+            RequestBodyField.Storage: "chunked",
+        },
+    )
+
+    assert update_response.status_code == 200
+
+    first, second = drive.find_by_property(chunking.CHUNK_OF_PROPERTY, tamper_filename)[
+        :2
+    ]
+    first_stored, second_stored = bytes(drive.read(first)), bytes(drive.read(second))
+    drive.write(first, second_stored)
+    drive.write(second, first_stored)
+
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: tamper_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert read_response.status_code == 401
+
+    drive.write(first, first_stored)
+    drive.write(second, second_stored)
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: tamper_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
+    # changing the password or adding and revoking file-specific shared secrets
+    # rewrites a key slot, never the encrypted content
+
+    slots_filename = f"{test_filename}_slots"
+
+    create_response = post(
+        Endpoint.Create,
+        {
+            RequestBodyField.Filename: slots_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert create_response.status_code == 201
+
+    update_response = update_stored(
+        {
+            RequestBodyField.Filename: slots_filename,
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Content: test_content1,
+        },
+    )
+
+    assert update_response.status_code == 200
+
+    stored_checksum = drive.lookup(slots_filename)["md5Checksum"]
+
+    change_password_response = post(
+        Endpoint.ChangePassword,
+        {
+            RequestBodyField.Filename: slots_filename,
+            RequestBodyField.Password: test_password,
+            RequestBodyField.NewPassword: test_updated_password,
+        },
+    )
+
+    assert change_password_response.status_code == 200
+
+    add_shared_secrets_response = post(
+        Endpoint.AddSharedSecrets,
+        {
+            RequestBodyField.Filename: slots_filename,
+            RequestBodyField.Password: test_updated_password,
+            RequestBodyField.Shares: 3,
+            RequestBodyField.Threshold: 2,
+        },
+    )
+
+    assert add_shared_secrets_response.status_code == 200
+
+    file_secrets = add_shared_secrets_response.json()[RequestBodyField.SharedSecrets]
+
+    assert drive.lookup(slots_filename)["md5Checksum"] == stored_checksum
+
+    for credentials, status in (
+        ({RequestBodyField.Password: test_password}, 401),
+        ({RequestBodyField.Password: test_updated_password}, 200),
+        ({RequestBodyField.SharedSecrets: ",".join(file_secrets[1:])}, 200),
+        ({RequestBodyField.SharedSecrets: file_secrets[0]}, 401),
+    ):
+        read_response = post(
+            Endpoint.Read,
+            {RequestBodyField.Filename: slots_filename, **credentials},
+        )
+
+        assert read_response.status_code == status
+        if status == 200:
+            assert read_response.json()["content"] == test_content1
+
+    revoke_shared_secrets_response = post(
+        Endpoint.RevokeSharedSecrets,
+        {
+            RequestBodyField.Filename: slots_filename,
+            RequestBodyField.Password: test_updated_password,
+        },
+    )
+
+    assert revoke_shared_secrets_response.status_code == 204
+
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: slots_filename,
+            RequestBodyField.SharedSecrets: ",".join(file_secrets[1:]),
+        },
+    )
+
+    assert read_response.status_code == 401
+    assert drive.lookup(slots_filename)["md5Checksum"] == stored_checksum
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: slots_filename,
+            RequestBodyField.Password: test_updated_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
+    # wrong credentials are refused by updates and deletes without downloading the
+    # content, and change nothing
+
+    check_filename = f"{test_filename}_check"
+
+    create_response = post(
+        Endpoint.Create,
+        {
+            RequestBodyField.Filename: check_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert create_response.status_code == 201
+
+    update_response = post(
+        Endpoint.Update,
+        {
+            RequestBodyField.Filename: check_filename,
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Content: range_content,
+        },
+    )
+
+    assert update_response.status_code == 200
+
+    downloads = metric("egd_drive_calls_total", 'call="media"')
+
+    assert downloads > 0
+
+    update_response = post(
+        Endpoint.Update,
+        {
+            RequestBodyField.Filename: check_filename,
+            RequestBodyField.Password: test_updated_password,
+            RequestBodyField.Content: test_content2,
+        },
+    )
+
+    assert update_response.status_code == 401
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: check_filename,
+            RequestBodyField.Password: test_updated_password,
+        },
+    )
+
+    assert delete_response.status_code == 401
+    assert metric("egd_drive_calls_total", 'call="media"') == downloads
+
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: check_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert read_response.status_code == 200
+    assert read_response.json()["content"] == range_content
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: check_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
+    # keys derived from a credential are cached, a repeated read derives none while
+    # a new (wrong) password still costs a derivation
+
+    kdf_filename = f"{test_filename}_kdf"
+
+    create_response = post(
+        Endpoint.Create,
+        {
+            RequestBodyField.Filename: kdf_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert create_response.status_code == 201
+
+    derivations = []
+    for password, status in (
+        (test_password, 200),
+        (test_password, 200),
+        (test_updated_password, 401),
+    ):
+        read_response = post(
+            Endpoint.Read,
+            {
+                RequestBodyField.Filename: kdf_filename,
+                RequestBodyField.Password: password,
+            },
+        )
+
+        assert read_response.status_code == status
+        derivations.append(metric("egd_crypto_job_seconds_count", 'job="kdf"'))
+
+    assert derivations[0] == derivations[1] < derivations[2]
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: kdf_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
+    # rapid successive updates read back as the newest one; with write-behind on
+    # (WRITE_BEHIND_DELAY) they are also coalesced into fewer stores
+
+    rapid_filename = f"{test_filename}_rapid"
+
+    create_response = post(
+        Endpoint.Create,
+        {
+            RequestBodyField.Filename: rapid_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert create_response.status_code == 201
+
+    queued = metric("egd_write_behind_total", 'outcome="queued"')
+    coalesced = metric("egd_write_behind_total", 'outcome="coalesced"')
+
+    for i in range(10):
+        update_response = post(
+            Endpoint.Update,
+            {
+                RequestBodyField.Filename: rapid_filename,
+                RequestBodyField.Password: test_password,
+                RequestBodyField.Content: f"{test_content2} {i}",
+            },
+        )
+
+        assert update_response.status_code == 200
+
+        read_response = post(
+            Endpoint.Read,
+            {
+                RequestBodyField.Filename: rapid_filename,
+                RequestBodyField.Password: test_password,
+            },
+        )
+
+        assert read_response.json()["content"] == f"{test_content2} {i}"
+
+    if metric("egd_write_behind_total", 'outcome="queued"') > queued:
+        assert metric("egd_write_behind_total", 'outcome="coalesced"') > coalesced
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: rapid_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: rapid_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert read_response.status_code == 404
+
+    # concurrent updates of one file are taken one after the other by its lock,
+    # every one of them succeeds and the file holds one of the versions written
+
+    locked_filename = f"{test_filename}_locked"
+    locked_contents = [f"{test_content1} {i}" for i in range(16)]
+
+    create_response = post(
+        Endpoint.Create,
+        {
+            RequestBodyField.Filename: locked_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert create_response.status_code == 201
+
+    def update(content: str) -> int:
+        return post(
+            Endpoint.Update,
+            {
+                RequestBodyField.Filename: locked_filename,
+                RequestBodyField.Password: test_password,
+                RequestBodyField.Content: content,
+            },
+        ).status_code
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        statuses = list(executor.map(update, locked_contents))
+
+    assert statuses == [200] * len(locked_contents)
+
+    read_response = post(
+        Endpoint.Read,
+        {
+            RequestBodyField.Filename: locked_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert read_response.status_code == 200
+    assert read_response.json()["content"] in locked_contents
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: locked_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
+    # compression codecs; unknown codecs and storages are refused, even when
+    # updates are queued by write-behind
+
+    codecs_filename = f"{test_filename}_codecs"
+
+    create_response = post(
+        Endpoint.Create,
+        {
+            RequestBodyField.Filename: codecs_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert create_response.status_code == 201
+
+    update_response = post(
+        Endpoint.Update,
+        {
+            RequestBodyField.Filename: codecs_filename,
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Content: test_content1,
+        },
+    )
+
+    assert update_response.status_code == 200
+
+    # compressible text is stored smaller than it is by either codec, and every
+    # codec reads back whole and in part
+    codecs_content = "".join(f"line {i} of a compressible file\n" for i in range(20000))
+
+    for compression in ("none", "zlib", "lzma"):
+        update_response = update_stored(
+            {
+                RequestBodyField.Filename: codecs_filename,
+                RequestBodyField.Password: test_password,
+                RequestBodyField.Content: codecs_content,
+                RequestBodyField.Compression: compression,
+            },
+        )
+
+        assert update_response.status_code == 200
+
+        stored_size = int(drive.lookup(codecs_filename)["size"])
+        if compression == "none":
+            assert stored_size > len(codecs_content)
+        else:
+            assert stored_size < len(codecs_content) / 2
+
+        read_response = post(
+            Endpoint.Read,
+            {
+                RequestBodyField.Filename: codecs_filename,
+                RequestBodyField.Password: test_password,
+            },
+        )
+
+        assert read_response.json()["content"] == codecs_content
+
+        read_response = post(
+            Endpoint.Read,
+            {
+                RequestBodyField.Filename: codecs_filename,
+                RequestBodyField.Password: test_password,
+                RequestBodyField.Offset: 300000,
+                RequestBodyField.Length: 100,
+            },
+        )
+
+        assert read_response.json()["content"] == codecs_content[300000:300100]
+
+    update_response = post(
+        Endpoint.Update,
+        {
+            RequestBodyField.Filename: codecs_filename,
+            RequestBodyField.Password: test_password,
+            RequestBodyField.Content: test_content1,
+        },
+    )
+
+    assert update_response.status_code == 200
+
+    for field, value in (
+        (RequestBodyField.Compression, "brotli"),
+        (RequestBodyField.Storage, "folded"),
+    ):
+        update_response = post(
+            Endpoint.Update,
+            {
+                RequestBodyField.Filename: codecs_filename,
+                RequestBodyField.Password: test_password,
+                RequestBodyField.Content: test_content2,
+                field: value,
+            },
+        )
+
+        assert update_response.status_code == 400
+
+        read_response = post(
+            Endpoint.Read,
+            {
+                RequestBodyField.Filename: codecs_filename,
+                RequestBodyField.Password: test_password,
+            },
+        )
+
+        assert read_response.json()["content"] == test_content1
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: codecs_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
+    # reads find the file in the metadata cache; with the ciphertext cache on,
+    # reading an unchanged file again downloads nothing, and an update is never
+    # answered from the older cached copy
+
+    cached_filename = f"{test_filename}_cached"
+    caching = metric("egd_ciphertext_cache", 'stat="max_bytes"') > 0
+
+    create_response = post(
+        Endpoint.Create,
+        {
+            RequestBodyField.Filename: cached_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert create_response.status_code == 201
+
+    for content in (test_content1, test_content2):
+        update_response = update_stored(
+            {
+                RequestBodyField.Filename: cached_filename,
+                RequestBodyField.Password: test_password,
+                RequestBodyField.Content: content,
+            },
+        )
+
+        assert update_response.status_code == 200
+
+        for _ in range(2):
+            downloads = metric("egd_drive_calls_total", 'call="media"')
+            hits = metric("egd_ciphertext_cache", 'stat="hits"')
+            misses = metric("egd_metadata_cache", 'stat="misses"')
+
+            read_response = post(
+                Endpoint.Read,
+                {
+                    RequestBodyField.Filename: cached_filename,
+                    RequestBodyField.Password: test_password,
+                },
+            )
+
+            assert read_response.json()["content"] == content
+            # the file is looked up by name from the metadata cache
+            assert metric("egd_metadata_cache", 'stat="misses"') == misses
+
+        if caching:
+            assert metric("egd_drive_calls_total", 'call="media"') == downloads
+            assert metric("egd_ciphertext_cache", 'stat="hits"') == hits + 1
+
+    delete_response = post(
+        Endpoint.Delete,
+        {
+            RequestBodyField.Filename: cached_filename,
+            RequestBodyField.Password: test_password,
+        },
+    )
+
+    assert delete_response.status_code == 204
+
 
 if __name__ == "__main__":
     main()
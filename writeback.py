@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional
+
+import metrics
+
+"""
+Write-behind queue coalescing rapid successive updates of the same file.
+
+An update is held in memory for `delay` seconds, counted from the first update of the
+window; updates of the same file arriving in that window replace it, so only the
+newest content is encrypted and uploaded. Until it is stored the pending version is
+what reads of the file should return, and `close()` stores everything still queued.
+"""
+
+# Tries of a write before it is dropped, a failed write waits one more window
+MAX_ATTEMPTS = 3
+
+log = logging.getLogger("writeback")
+
+OUTCOMES = metrics.register(
+    metrics.Counter(
+        "egd_write_behind_total",
+        "Updates handled by the write-behind queue, by outcome.",
+        ("outcome",),
+    )
+)
+
+
+class PendingWrite:
+    """
+    Newest content of a file waiting to be stored, and what is needed to store it.
+
+    ``key_check`` is a key check value of the credentials that queued the write, it
+    lets later requests with the same credentials skip the Drive metadata calls.
+    """
+
+    def __init__(
+        self,
+        data_key: bytes,
+        plaintext: bytes,
+        properties: Optional[dict],
+        storage: Optional[str],
+        compression: Optional[str],
+        key_check: str,
+    ):
+        self.data_key = data_key
+        self.plaintext = plaintext
+        self.properties = properties
+        self.storage = storage
+        self.compression = compression
+        self.key_check = key_check
+        # monotonic time the write is stored at
+        self.due = 0.0
+        self.attempts = 0
+        self.cancelled = False
+
+
+class WriteBehind:
+    """
+    Pending writes per file, handed to ``store(file_name, write)`` by a background
+    thread once their window is over.
+
+    At most one write of a file is being stored at a time; an update arriving
+    meanwhile waits for its own window and the end of that store.
+    """
+
+    def __init__(
+        self,
+        store: Callable[[str, PendingWrite], None],
+        delay: float,
+        workers: int = 4,
+    ):
+        self.store = store
+        self.delay = delay
+        # file name -> write waiting for its window
+        self._queued: Dict[str, PendingWrite] = dict()
+        # file name -> write handed to `store`
+        self._storing: Dict[str, PendingWrite] = dict()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._flusher = threading.Thread(target=self._run, daemon=True)
+        self._flusher.start()
+
+    def submit(self, file_name: str, write: PendingWrite):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("the write-behind queue has been closed.")
+            previous = self._queued.get(file_name)
+            if previous is None:
+                write.due = time.monotonic() + self.delay
+                OUTCOMES.inc(outcome="queued")
+            else:
+                # the window is not extended, so a busy file is still stored regularly
+                write.due = previous.due
+                OUTCOMES.inc(outcome="coalesced")
+            self._queued[file_name] = write
+            self._condition.notify_all()
+
+    def pending(self, file_name: str) -> Optional[PendingWrite]:
+        # the newest version of a file that is not known to be stored yet
+        with self._condition:
+            return self._queued.get(file_name) or self._storing.get(file_name)
+
+    def flush(self, file_names: Optional[Iterable[str]] = None):
+        # store the queued writes of some files (or all) now, waits until they are
+        with self._condition:
+            if file_names is None:
+                file_names = set(self._queued) | set(self._storing)
+            file_names = list(file_names)
+            for file_name in file_names:
+                if file_name in self._queued:
+                    self._queued[file_name].due = 0.0
+            self._condition.notify_all()
+            self._condition.wait_for(
+                lambda: not any(
+                    name in self._queued or name in self._storing for name in file_names
+                )
+            )
+
+    def discard(self, file_name: str):
+        # forget the queued write of a file about to be deleted
+        with self._condition:
+            if self._queued.pop(file_name, None) is not None:
+                OUTCOMES.inc(outcome="discarded")
+            storing = self._storing.get(file_name)
+            if storing is not None:
+                storing.cancelled = True
+            self._condition.wait_for(lambda: file_name not in self._storing)
+
+    def close(self):
+        # store everything still queued, then stop
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._flusher.join()
+        self._executor.shutdown()
+
+    def _run(self):
+        with self._condition:
+            while not self._closed:
+                now = time.monotonic()
+                timeout = None
+                for file_name, write in list(self._queued.items()):
+                    if file_name in self._storing:
+                        # woken up again once the running store is done
+                        continue
+                    if write.due <= now:
+                        del self._queued[file_name]
+                        self._storing[file_name] = write
+                        self._executor.submit(self._store, file_name, write)
+                    elif timeout is None or write.due - now < timeout:
+                        timeout = write.due - now
+                self._condition.wait(timeout)
+
+    def _store(self, file_name: str, write: PendingWrite):
+        write.attempts += 1
+        try:
+            self.store(file_name, write)
+            outcome = "stored"
+        except Exception as e:
+            outcome = "failed"
+            log.error(
+                "storing <%s> failed (attempt %s of %s): %s",
+                file_name,
+                write.attempts,
+                MAX_ATTEMPTS,
+                e,
+            )
+        with self._condition:
+            del self._storing[file_name]
+            if outcome == "failed":
+                if write.cancelled or file_name in self._queued:
+                    # deleted or replaced meanwhile, this version is not needed anymore
+                    pass
+                elif write.attempts < MAX_ATTEMPTS:
+                    write.due = time.monotonic() + self.delay * write.attempts
+                    self._queued[file_name] = write
+                else:
+                    outcome = "dropped"
+                    log.error("dropping the pending update of <%s>.", file_name)
+            OUTCOMES.inc(outcome=outcome)
+            self._condition.notify_all()